@@ -1,5 +1,6 @@
 from .ooi_postgres import model
-from .ooi_postgres.postgres_data import find_modified_bins_by_jobname, find_last_job_time, find_previous_bin, find_next_bin
+from .ooi_postgres.postgres_data import find_modified_bins_by_jobname, find_last_job_time, find_previous_bin, find_next_bin, \
+    find_modified_bins_with_neighbors
 
 
 # __all__ = [fetch_bin, model, find_modified_bins_since, find_last_job_time, find_previous_bin, find_next_bin, ProvTuple]
\ No newline at end of file
@@ -0,0 +1,131 @@
+import struct
+from itertools import izip
+
+import msgpack
+import numpy as np
+
+# 0xc1 is never used by msgpack so binary cells can be told apart from msgpack encoded cells
+MAGIC = b'\xc1'
+# magic, dtype string length, number of dimensions
+HEADER = struct.Struct('<cBB')
+BINARY_KINDS = 'biufc'
+
+
+def _header(dtype, shape):
+    descr = dtype.str.encode('ascii')
+    return HEADER.pack(MAGIC, len(descr), len(shape)) + descr + struct.pack('<%dI' % len(shape), *shape)
+
+
+def _parse_header(value):
+    _, descr_size, ndim = HEADER.unpack_from(value)
+    offset = HEADER.size
+    dtype = np.dtype(value[offset:offset + descr_size].decode('ascii'))
+    offset += descr_size
+    shape = struct.unpack_from('<%dI' % ndim, value, offset)
+    return dtype, shape, offset + 4 * ndim
+
+
+def _little_endian(array):
+    dtype = array.dtype.newbyteorder('<') if array.dtype.byteorder == '>' else array.dtype
+    return np.ascontiguousarray(array, dtype=dtype)
+
+
+def is_binary(value):
+    return value[:1] == MAGIC
+
+
+def encode_cell(array):
+    """
+    Encode a single numeric array as a binary cell: a dtype/shape header followed by the
+    raw little-endian data
+    """
+    array = _little_endian(np.asarray(array))
+    return _header(array.dtype, array.shape) + array.tobytes()
+
+
+def encode_cells(block):
+    """
+    Encode each row of an (N, ...) array as a binary cell. The block is converted to
+    little-endian bytes in one pass and every cell shares the same header.
+    Non numeric blocks (e.g. ragged object arrays) are encoded with msgpack.
+    """
+    block = np.asarray(block)
+    if block.dtype.kind not in BINARY_KINDS:
+        return [msgpack.packb(x) for x in block.tolist()]
+    block = _little_endian(block)
+    header = _header(block.dtype, block.shape[1:])
+    raw = block.tobytes()
+    size = block[0].nbytes if len(block) else 0
+    return [header + raw[i * size:(i + 1) * size] for i in xrange(len(block))]
+
+
+def decode_cell(value):
+    """
+    Decode a binary or msgpack encoded cell. Binary cells are returned as read-only
+    views on value without copying.
+    """
+    if value is None:
+        return None
+    if is_binary(value):
+        dtype, shape, offset = _parse_header(value)
+        return np.frombuffer(value, dtype=dtype, offset=offset).reshape(shape)
+    return np.array(msgpack.unpackb(value))
+
+
+def decode_cells(values):
+    """
+    Decode a column of cells into an (N, ...) array when every cell is binary with the same
+    dtype and shape, otherwise into an object array of the decoded cells
+    """
+    values = list(values)
+    if values and all(v is not None and is_binary(v) for v in values):
+        headers = set(v[:_parse_header(v)[2]] for v in values)
+        if len(headers) == 1:
+            dtype, shape, offset = _parse_header(values[0])
+            data = b''.join(v[offset:] for v in values)
+            return np.frombuffer(data, dtype=dtype).reshape((len(values),) + shape)
+
+    decoded = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        decoded[i] = decode_cell(value)
+    return decoded
+
+
+def decode_columns(rows, indices):
+    """
+    Decode the cells of the given columns of a list of row tuples. A column holding any binary
+    cell is decoded in full, columns of msgpack cells only are left for the caller to unpack.
+    """
+    binary = [i for i in indices if any(isinstance(row[i], bytes) and is_binary(row[i]) for row in rows)]
+    if not binary:
+        return rows
+    rows = [list(row) for row in rows]
+    for i in binary:
+        for row, value in izip(rows, decode_cells([row[i] for row in rows])):
+            row[i] = value
+    return [tuple(row) for row in rows]
+
+
+def pack_columns(rows, indices):
+    """
+    Encode the binary or decoded array cells of the given columns of a list of row tuples with
+    msgpack, for consumers which unpack every array cell with msgpack. Rows without such cells
+    are returned unchanged.
+    """
+    def unpacked(value):
+        if isinstance(value, np.ndarray):
+            return value
+        if isinstance(value, bytes) and is_binary(value):
+            return decode_cell(value)
+        return None
+
+    packed = [i for i in indices if any(unpacked(row[i]) is not None for row in rows)]
+    if not packed:
+        return rows
+    rows = [list(row) for row in rows]
+    for i in packed:
+        for row in rows:
+            array = unpacked(row[i])
+            if array is not None:
+                row[i] = msgpack.packb(array.tolist())
+    return [tuple(row) for row in rows]
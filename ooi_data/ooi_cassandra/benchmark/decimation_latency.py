@@ -0,0 +1,84 @@
+"""
+Points per second reduced by each plot sampling strategy on the bundled BOTPT bin: min/max and LTTB
+decimation (in one call and streamed per bin) against the existing linspace (sample_full_bins),
+sample_n_points and sample_n_bins strategies. The bin is split into one minute bins to emulate the
+per bin queries of the sampling strategies, only the client side selection is timed.
+
+    python -m ooi_data.ooi_cassandra.benchmark.decimation_latency
+"""
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+from ooi_data.ooi_cassandra.sampling import LTTB, MINMAX, StreamingDecimator, decimate, plan_sample_points
+
+DATA_FILE = os.path.join(os.path.dirname(__file__), '..', 'test', 'botpt_nano_sample_bin_3682368000.nc')
+NUM_POINTS = 1000
+BINSIZE = 60
+REPEAT = 5
+
+
+def linspace(times, values, bins):
+    return np.linspace(0, times.size - 1, NUM_POINTS).astype(int)
+
+
+def sample_n_points(times, values, bins):
+    # plan the sample times onto the bins then take the last row at or before each query time
+    numbers, starts, stops = bins
+    plan = plan_sample_points(np.linspace(times[0], times[-1], NUM_POINTS), numbers, stops - starts,
+                              times[starts], times[stops - 1])
+    query_times = np.array([t for _, t in plan.queries])
+    return np.searchsorted(times, query_times, side='right') - 1
+
+
+def sample_n_bins(times, values, bins):
+    # the first row of evenly spaced bins
+    _, starts, _ = bins
+    return starts[np.linspace(0, starts.size - 1, min(NUM_POINTS, starts.size)).astype(int)]
+
+
+def decimated(method):
+    def sample(times, values, bins):
+        return decimate(times, values, NUM_POINTS, method)
+    return sample
+
+
+def streamed(method):
+    def sample(times, values, bins):
+        decimator = StreamingDecimator(times[0], np.nextafter(times[-1], np.inf), NUM_POINTS, method)
+        rows = np.arange(times.size)
+        for start, stop in zip(bins[1], bins[2]):
+            decimator.add(times[start:stop], values[start:stop], rows[start:stop])
+        return decimator.rows()
+    return sample
+
+
+STRATEGIES = [('linspace', linspace),
+              ('sample_n_points', sample_n_points),
+              ('sample_n_bins', sample_n_bins),
+              (MINMAX, decimated(MINMAX)),
+              (LTTB, decimated(LTTB)),
+              ('streaming ' + MINMAX, streamed(MINMAX)),
+              ('streaming ' + LTTB, streamed(LTTB))]
+
+
+def main():
+    ds = xr.open_dataset(DATA_FILE, decode_times=False)
+    times = ds.time.values.astype(np.float64)
+    values = ds.bottom_pressure.values.astype(np.float64)
+    numbers, starts = np.unique((times // BINSIZE).astype(np.int64), return_index=True)
+    bins = (numbers, starts, np.append(starts[1:], times.size))
+
+    print '%d points in %d bins reduced to %d points' % (times.size, numbers.size, NUM_POINTS)
+    for name, sample in STRATEGIES:
+        now = time.time()
+        for _ in xrange(REPEAT):
+            selected = sample(times, values, bins)
+        elapsed = (time.time() - now) / REPEAT
+        print '%-18s %5d points in %.4f secs %12d points/sec' % (name, len(selected), elapsed, times.size / elapsed)
+
+
+if __name__ == '__main__':
+    main()
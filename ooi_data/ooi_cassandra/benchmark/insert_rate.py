@@ -0,0 +1,75 @@
+"""
+Rows per second written by insert_dataframe for one 3 hour bin of 20 Hz BOTPT data, comparing
+the legacy (iterrows) path with the columnar path, unbatched and in UNLOGGED batches.
+The driver session is mocked so only the client side cost of building the rows (and batches) is measured,
+binding and sending them in the driver is not.
+
+    python -m ooi_data.ooi_cassandra.benchmark.insert_rate
+"""
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+from mock import patch
+
+from ooi_data.ooi_cassandra.cassandra_data import insert_dataframe
+from ooi_data.ooi_cassandra.cassandra_session import SessionManager
+
+BINSIZE = 3600 * 3
+SIZE = BINSIZE * 20
+COLUMNS = ['bin', 'time', 'deployment', 'id', 'bottom_pressure', 'press_trans_temp', 'sensor_id', 'provenance']
+# (name, columnar, batch_size)
+VARIANTS = [('legacy', False, None), ('columnar', True, None), ('columnar batched', True, 100)]
+
+
+def make_botpt_dataframe(size):
+    times = 3682368000 + np.arange(size) / 20.0
+    return pd.DataFrame({'time': times,
+                         'bottom_pressure': np.random.random(size),
+                         'press_trans_temp': np.ones(size),
+                         'sensor_id': ['NANO'] * size,
+                         'provenance': [uuid.uuid4()] * size})
+
+
+def execute_concurrent_with_args(session, statement, parameters, **kwargs):
+    # consume the bound values as the driver would
+    return [(True, None) for _ in parameters]
+
+
+class BatchStatement(object):
+    def __init__(self, batch_type=None):
+        self.rows = []
+
+    def add(self, statement, parameters):
+        self.rows.append(parameters)
+
+
+def execute_concurrent(session, statements_and_parameters, **kwargs):
+    return [(True, None) for _ in statements_and_parameters]
+
+
+def insert_rate(columnar, batch_size):
+    dataframe = make_botpt_dataframe(SIZE)
+    with patch.object(SessionManager, 'prepare'), \
+            patch.object(SessionManager, 'session'), \
+            patch.object(SessionManager, 'get_query_columns', return_value=COLUMNS), \
+            patch('ooi_data.ooi_cassandra.cassandra_data.update_last_records'), \
+            patch('ooi_data.ooi_cassandra.cassandra_data.update_bin_counts'), \
+            patch('ooi_data.ooi_cassandra.cassandra_data.execute_concurrent_with_args', execute_concurrent_with_args), \
+            patch('ooi_data.ooi_cassandra.cassandra_data.execute_concurrent', execute_concurrent), \
+            patch('ooi_data.ooi_cassandra.cassandra_data.BatchStatement', BatchStatement):
+        now = time.time()
+        insert_dataframe('subsite', 'node', 'sensor', 'streamed', 'botpt_nano_sample', 0, BINSIZE, dataframe,
+                         columnar=columnar, batch_size=batch_size)
+        return SIZE / (time.time() - now)
+
+
+def main():
+    print 'insert_dataframe, %d rows (one 3 hour bin of 20 Hz BOTPT data)' % SIZE
+    for name, columnar, batch_size in VARIANTS:
+        print '%-18s %10d rows/sec' % (name, insert_rate(columnar, batch_size))
+
+
+if __name__ == '__main__':
+    main()
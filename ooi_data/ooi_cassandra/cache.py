@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size bounded least recently used cache with hit/miss counters.
+    get_or_load provides single-flight loading: concurrent callers missing the same key
+    wait for a single call to the loader instead of each loading the value.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _get(self, key):
+        # caller must hold the lock
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def _put(self, key, value):
+        # caller must hold the lock
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                return self._get(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get_or_load(self, key, loader):
+        while True:
+            with self._lock:
+                if key in self._data:
+                    self.hits += 1
+                    return self._get(key)
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # another thread is loading this key, wait for it and check again
+            event.wait()
+
+        try:
+            value = loader(key)
+            self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / total if total else 0.0}
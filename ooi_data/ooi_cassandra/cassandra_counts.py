@@ -0,0 +1,112 @@
+import logging
+import random
+from collections import namedtuple
+from itertools import izip
+
+from cassandra.concurrent import execute_concurrent_with_args
+
+from .cassandra_session import prepare_if_exists
+
+log = logging.getLogger(__name__)
+
+BinCountDrift = namedtuple('BinCountDrift', ['bin', 'metadata_count', 'counter_count', 'row_count'])
+
+BIN_COUNT_TABLE = 'stream_bin_count'
+# Number of rows in each bin of a stream, kept up to date by the insert and delete paths
+CREATE_BIN_COUNT_TABLE = """
+CREATE TABLE IF NOT EXISTS stream_bin_count (
+    subsite text,
+    node text,
+    sensor text,
+    method text,
+    stream text,
+    bin bigint,
+    count counter,
+    PRIMARY KEY((subsite, node, sensor, method, stream), bin)
+);
+"""
+UPDATE_BIN_COUNT = 'UPDATE stream_bin_count SET count = count + ? ' \
+                   'WHERE subsite=? AND node=? AND sensor=? AND method=? AND stream=? AND bin=?'
+SELECT_BIN_COUNTS = 'SELECT bin, count FROM stream_bin_count ' \
+                    'WHERE subsite=? AND node=? AND sensor=? AND method=? AND stream=? AND bin IN ?'
+COUNT_ROWS = 'SELECT COUNT(*) FROM %s WHERE subsite=? AND node=? AND sensor=? AND bin=? AND method=?'
+
+
+def update_bin_counts(session_manager, subsite, node, sensor, method, stream, deltas):
+    """
+    Add the per bin row count changes in deltas (a dictionary of bin to change) to the bin counts
+    """
+    deltas = {b: int(d) for b, d in deltas.iteritems() if d}
+    if not deltas:
+        return
+    statement = prepare_if_exists(session_manager, UPDATE_BIN_COUNT, BIN_COUNT_TABLE)
+    if statement is None:
+        return
+    args = [(delta, subsite, node, sensor, method, stream, b) for b, delta in deltas.iteritems()]
+    results = execute_concurrent_with_args(session_manager.session(), statement, args, raise_on_first_error=False)
+    failed = [a[-1] for a, (success, _) in izip(args, results) if not success]
+    if failed:
+        # counter updates are not idempotent and are not retried, the drift is found by verify_bin_counts
+        log.warn('Unable to update bin counts of %s for bins %r', stream, failed)
+
+
+def fetch_bin_counts(session_manager, subsite, node, sensor, method, stream, bins):
+    """
+    Return a dictionary of bin to row count, bins without a count are omitted
+    """
+    statement = prepare_if_exists(session_manager, SELECT_BIN_COUNTS, BIN_COUNT_TABLE)
+    if statement is None:
+        return {}
+    rows = session_manager.execute(statement, (subsite, node, sensor, method, stream, list(bins)))
+    return {b: count for b, count in rows}
+
+
+def count_rows(session_manager, subsite, node, sensor, method, stream, bin_number):
+    """
+    Count the rows of a bin with a full partition scan, only used to verify the bin counts
+    """
+    statement = session_manager.prepare(COUNT_ROWS % stream)
+    return list(session_manager.execute(statement, (subsite, node, sensor, bin_number, method)))[0][0]
+
+
+def verify_bin_counts(session_manager, metadata_records, sample_size=None, scan=False):
+    """
+    Compare the bin counts with the counts of the partition metadata records (PartitionMetadatum)
+    of a single stream. A random sample of sample_size records is checked when specified.
+    If scan is True the rows of each checked bin are also counted.
+    Returns a BinCountDrift for each bin where the counts disagree.
+    """
+    metadata_records = list(metadata_records)
+    if sample_size is not None and sample_size < len(metadata_records):
+        metadata_records = random.sample(metadata_records, sample_size)
+    if not metadata_records:
+        return []
+
+    first = metadata_records[0]
+    key = (first.subsite, first.node, first.sensor, first.method, first.stream)
+    counts = fetch_bin_counts(session_manager, *(key + ([r.bin for r in metadata_records],)))
+
+    drift = []
+    for record in metadata_records:
+        counter_count = counts.get(record.bin, 0)
+        row_count = count_rows(session_manager, *(key + (record.bin,))) if scan else None
+        if counter_count != record.count or (scan and row_count != record.count):
+            drift.append(BinCountDrift(record.bin, record.count, counter_count, row_count))
+
+    if drift:
+        log.warn('Bin count drift in %d of %d bins of %r: %r', len(drift), len(metadata_records), key, drift)
+    else:
+        log.info('Bin counts match for %d bins of %r', len(metadata_records), key)
+    return drift
+
+
+def reconcile_bin_counts(session_manager, metadata_records, drift):
+    """
+    Adjust the bin counts found by verify_bin_counts to the scanned row count when available,
+    otherwise to the partition metadata count
+    """
+    if not drift:
+        return
+    first = metadata_records[0]
+    deltas = {d.bin: (d.metadata_count if d.row_count is None else d.row_count) - d.counter_count for d in drift}
+    update_bin_counts(session_manager, first.subsite, first.node, first.sensor, first.method, first.stream, deltas)
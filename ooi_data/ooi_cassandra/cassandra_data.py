@@ -1,15 +1,25 @@
 import datetime
 import logging
+import os
 import uuid
+from collections import deque, namedtuple
+from itertools import islice, izip, repeat
+from operator import attrgetter
 
 import numpy as np
 import pandas as pd
-from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+from cassandra.query import BatchStatement, BatchType
 
-from cassandra_session import SessionManager
+from cassandra_counts import update_bin_counts
+from cassandra_index import invalidate_last_records, last_records, make_refdes, update_last_records
+from cassandra_session import SessionManager, stream_statements
 
 NTP_OFFSET = (datetime.datetime(1970, 1, 1) - datetime.datetime(1900, 1, 1)).total_seconds()
 
+# Rows removed by delete_range and the bounds of the rows remaining in the partition
+DeletedRange = namedtuple('DeletedRange', ['count', 'first', 'last'])
+
 
 log = logging.getLogger()
 
@@ -18,39 +28,175 @@ def get_bin_number(timestamp, binsize):
     return int(timestamp / binsize) * binsize
 
 
-def fetch_bin(subsite, node, sensor, method, stream, bin_number, cols, min_time=None, max_time=None):
-    log.info('fetch_bin(%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-             subsite, node, sensor, method, stream, bin_number, cols, min_time, max_time)
+def get_bin_numbers(timestamps, binsize):
+    """
+    Vectorized get_bin_number, returns an int64 array of bin numbers for an array of timestamps
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    return (timestamps / binsize).astype(np.int64) * binsize
+
+
+def make_uuids(size):
+    """
+    Generate size random (version 4) UUIDs from a single block of random bytes
+    """
+    raw = np.frombuffer(os.urandom(16 * size), dtype=np.uint8).reshape(size, 16).copy()
+    # set the version (4) and variant (RFC 4122) bits as uuid.uuid4 does
+    raw[:, 6] = (raw[:, 6] & 0x0f) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3f) | 0x80
+    raw = raw.tobytes()
+    return [uuid.UUID(bytes=raw[i:i + 16]) for i in xrange(0, size * 16, 16)]
+
+
+def column_values(values):
+    """
+    Convert a column array to a list of driver-friendly python values in one pass.
+    Only object columns (which may contain ndarray cells) are converted cell by cell.
+    """
+    if values.dtype != object:
+        return values.tolist()
+    return [v.tolist() if isinstance(v, np.ndarray) else v for v in values]
+
+
+def bin_slices(sorted_bins):
+    """
+    Return a list of (bin_number, start, stop) slices for each distinct bin in an array of sorted bin numbers
+    """
+    bin_numbers, starts = np.unique(sorted_bins, return_index=True)
+    stops = np.append(starts[1:], sorted_bins.size)
+    return zip(bin_numbers.tolist(), starts.tolist(), stops.tolist())
+
+
+def execute_batched(session, statement, values, batch_size, concurrency=50):
+    """
+    Execute statement for each set of values, packing consecutive rows into UNLOGGED batches
+    of at most batch_size rows. All values must belong to the same partition so that each
+    batch is applied as a single mutation.
+    Returns a boolean array indicating the success of each row.
+    """
+    values = list(values)
+    starts = range(0, len(values), batch_size)
+    batches = []
+    for start in starts:
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for row in values[start:start + batch_size]:
+            batch.add(statement, row)
+        batches.append((batch, None))
+
+    results = execute_concurrent(session, batches, concurrency=concurrency, raise_on_first_error=False)
+    success_mask = np.zeros(len(values), dtype=bool)
+    for start, (success, result) in izip(starts, results):
+        if success:
+            success_mask[start:start + batch_size] = True
+        else:
+            log.error('Batch write of %d rows failed: %r', len(values[start:start + batch_size]), result)
+    return success_mask
+
+
+def execute_partition(statement, values, batch_size=None):
+    """
+    Execute statement for each set of values belonging to a single partition.
+    If batch_size is specified rows are written in UNLOGGED batches, otherwise one statement per row.
+    Returns a boolean array indicating the success of each row.
+    """
+    session = SessionManager.session()
+    if batch_size:
+        return execute_batched(session, statement, values, batch_size)
+    results = execute_concurrent_with_args(session, statement, values, concurrency=200, raise_on_first_error=False)
+    return np.array([success for success, _ in results], dtype=bool)
+
+
+def _bin_statement(stream, cols, min_time=None, max_time=None):
     s = 'select %s from %s where subsite=? and node=? and sensor=? and method=? and bin=?' % (','.join(cols),
                                                                                               stream)
+    if min_time is not None:
+        s += ' and time >= ?'
+    if max_time is not None:
+        s += ' and time < ?'
+    return s
+
 
+def _bin_query(subsite, node, sensor, method, stream, bin_number, cols, min_time=None, max_time=None):
     args = [subsite, node, sensor, method, bin_number]
     if min_time is not None:
-        s += ' and time >= ?'
         args.append(min_time)
     if max_time is not None:
-        s += ' and time < ?'
         args.append(max_time)
 
-    ps = SessionManager.prepare(s)
-    result = SessionManager.execute_numpy(ps, args)
-    return pd.concat((pd.DataFrame(r, columns=cols) for r in result)).sort_values('time')
+    return SessionManager.prepare(_bin_statement(stream, cols, min_time, max_time)).bind(args)
 
 
-def insert_dataframe(subsite, node, sensor, method, stream, deployment, binsize, dataframe):
-    log.info('insert_dataframe(%s, %s, %s, %s, %s, %s, %s, <DATAFRAME>)',
-             subsite, node, sensor,method, stream, deployment, binsize)
+def iter_bin(subsite, node, sensor, method, stream, bin_number, cols, min_time=None, max_time=None,
+             fetch_size=None):
+    """
+    Fetch a bin one driver page at a time, yielding a DataFrame per page.
+    Only one page is held in memory at a time.
+    Rows within a partition are returned in clustering (method, time) order and
+    method is fixed, so the chunks are yielded in time order without sorting.
+    """
+    log.info('iter_bin(%s, %s, %s, %s, %s, %s, %s, %s, %s, fetch_size=%s)',
+             subsite, node, sensor, method, stream, bin_number, cols, min_time, max_time, fetch_size)
+    bound = _bin_query(subsite, node, sensor, method, stream, bin_number, cols, min_time, max_time)
+    if fetch_size is not None:
+        bound.fetch_size = fetch_size
+
+    for page in SessionManager.execute_numpy(bound):
+        yield pd.DataFrame(page, columns=cols)
 
-    metadata_cols = SessionManager.get_query_columns(stream)
-    data_cols = [col for col in dataframe.columns if col in metadata_cols]
-    fixed_cols = ['subsite', 'node', 'sensor', 'method', 'deployment']
-    fixed_values = "'%s', '%s', '%s', '%s', %d" % (subsite, node, sensor, method, deployment)
-    variable_cols = ['bin', 'id'] + data_cols
 
-    statement = "INSERT INTO %s (%s, %s) VALUES (%s, %s)" % (
-        stream, ','.join(fixed_cols), ','.join(variable_cols), fixed_values, ','.join(('?' for _ in variable_cols)))
+def fetch_bin(subsite, node, sensor, method, stream, bin_number, cols, min_time=None, max_time=None):
+    log.info('fetch_bin(%s, %s, %s, %s, %s, %s, %s, %s, %s)',
+             subsite, node, sensor, method, stream, bin_number, cols, min_time, max_time)
+    pages = list(iter_bin(subsite, node, sensor, method, stream, bin_number, cols, min_time, max_time))
+    if not pages:
+        return pd.DataFrame(columns=cols)
+    # pages are already in time order
+    return pd.concat(pages, ignore_index=True)
+
+
+def fetch_range(stream_key, start, stop, cols, partitions, max_in_flight=8):
+    """
+    Fetch all rows of a stream with start <= time < stop as a single DataFrame.
+    The bins to query are chosen from partitions (PartitionMetadatum records), all bin queries
+    are issued asynchronously with at most max_in_flight outstanding requests.
+    Bins do not overlap in time and each bin is returned in time order, so the per-bin results
+    are merged by concatenating them in bin order.
+    """
+    partitions = sorted({p.bin: p for p in partitions if p is not None and p.first < stop and p.last >= start}.values(),
+                        key=attrgetter('bin'))
+    log.info('fetch_range(%s, %s, %s, %s, %d partitions, max_in_flight=%d) bins: %s', stream_key.stream, start, stop,
+             cols, len(partitions), max_in_flight, [p.bin for p in partitions])
+
+    queries = (_bin_query(stream_key.subsite, stream_key.node, stream_key.sensor, stream_key.method, stream_key.stream,
+                          p.bin, cols, start, stop) for p in partitions)
+    pending = deque(SessionManager.execute_numpy_async(query) for query in islice(queries, max_in_flight))
+
+    pages = []
+    while pending:
+        result = pending.popleft().result()
+        query = next(queries, None)
+        if query is not None:
+            pending.append(SessionManager.execute_numpy_async(query))
+        pages.extend(pd.DataFrame(page, columns=cols) for page in result)
+
+    if not pages:
+        return pd.DataFrame(columns=cols)
+    return pd.concat(pages, ignore_index=True)
+
+
+def insert_dataframe(subsite, node, sensor, method, stream, deployment, binsize, dataframe, columnar=False,
+                     batch_size=None):
+    log.info('insert_dataframe(%s, %s, %s, %s, %s, %s, %s, <DATAFRAME>, columnar=%s, batch_size=%s)',
+             subsite, node, sensor, method, stream, deployment, binsize, columnar, batch_size)
+
+    statement, data_cols = _insert_statement(stream, dataframe.columns)
+    fixed_values = [subsite, node, sensor, method, deployment]
+    variable_cols = ['bin', 'id'] + data_cols
     ps = SessionManager.prepare(statement)
 
+    if columnar:
+        return _insert_columnar(ps, stream, binsize, dataframe, fixed_values, data_cols, batch_size)
+
     # add bin number to dataframe
     dataframe['bin'] = [get_bin_number(t, binsize) for t in dataframe.time.values]
     # add unique UUID to each row in dataframe
@@ -58,7 +204,7 @@ def insert_dataframe(subsite, node, sensor, method, stream, deployment, binsize,
 
     def values_generator(df_group):
         for index, row in df_group.iterrows():
-            vals = []
+            vals = list(fixed_values)
             for col in variable_cols:
                 val = row[col]
                 if isinstance(val, np.ndarray):
@@ -67,13 +213,14 @@ def insert_dataframe(subsite, node, sensor, method, stream, deployment, binsize,
             yield vals
 
     inserted = {}
+    written = []
     for bin_number, group in dataframe.groupby('bin'):
         first = group.time.min()
         last = group.time.max()
         count = group.time.size
         log.info('Inserting into %s bin %d first: %.2f last: %.2f count: %d', stream, bin_number, first, last, count)
-        results = execute_concurrent_with_args(SessionManager.session(), ps, values_generator(group), concurrency=200)
-        success_mask = [success for success, _ in results]
+        success_mask = execute_partition(ps, values_generator(group), batch_size)
+        written.append(group[success_mask])
         if not all(success_mask):
             log.error('Unable to insert all records, failed records: %r', group[np.logical_not(success_mask)])
             first = group.time[success_mask].min()
@@ -82,15 +229,105 @@ def insert_dataframe(subsite, node, sensor, method, stream, deployment, binsize,
 
         inserted[bin_number] = {'first': first, 'last': last, 'count': count}
 
+    if written:
+        written = pd.concat(written)
+        _index_last_record(fixed_values, stream, written.time.values, written.bin.values, list(written.id.values))
+    _count_inserted(fixed_values, stream, inserted)
+    return inserted
+
+
+def _insert_statement(stream, columns):
+    """
+    Return the insert statement for the columns of stream found in columns, and the data columns
+    in statement (schema) order so the statement text does not depend on the order of columns
+    """
+    columns = set(columns)
+    fixed_cols = ['subsite', 'node', 'sensor', 'method', 'deployment']
+    data_cols = [col for col in SessionManager.get_query_columns(stream)
+                 if col in columns and col not in fixed_cols + ['bin', 'id']]
+    # the partition key is bound rather than formatted into the statement so that the statement is
+    # shared by all reference designators and the driver can route each insert to a replica
+    cols = fixed_cols + ['bin', 'id'] + data_cols
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (stream, ','.join(cols), ','.join('?' for _ in cols))
+    return statement, data_cols
+
+
+def _count_inserted(fixed_values, stream, inserted):
+    subsite, node, sensor, method, _ = fixed_values
+    update_bin_counts(SessionManager, subsite, node, sensor, method, stream,
+                      {bin_number: each['count'] for bin_number, each in inserted.iteritems()})
+
+
+def _index_last_record(fixed_values, stream, times, bins, ids):
+    """
+    Update the last record index with the latest of the rows written for the (single) deployment
+    """
+    subsite, node, sensor, method, deployment = fixed_values
+    records = last_records(np.full(len(ids), deployment), times, bins, ids)
+    update_last_records(SessionManager, make_refdes(subsite, node, sensor), method, stream, records)
+
+
+def _insert_columnar(ps, stream, binsize, dataframe, fixed_values, data_cols, batch_size):
+    """
+    Insert the dataframe by building bound parameters directly from the column arrays.
+    The dataframe is not modified.
+    """
+    bins = get_bin_numbers(dataframe.time.values, binsize)
+    # stable sort rows by bin so each bin is a contiguous slice of every column
+    order = np.argsort(bins, kind='mergesort')
+    bins = bins[order]
+    times = dataframe.time.values[order]
+    ids = make_uuids(times.size)
+    columns = [column_values(dataframe[col].values[order]) for col in data_cols]
+
+    inserted = {}
+    written = np.zeros(times.size, dtype=bool)
+    for bin_number, start, stop in bin_slices(bins):
+        group_times = times[start:stop]
+        first = group_times.min()
+        last = group_times.max()
+        count = group_times.size
+        log.info('Inserting into %s bin %d first: %.2f last: %.2f count: %d', stream, bin_number, first, last, count)
+
+        values = izip(*([repeat(value, count) for value in fixed_values + [bin_number]] +
+                        [ids[start:stop]] + [col[start:stop] for col in columns]))
+        success_mask = execute_partition(ps, values, batch_size)
+        written[start:stop] = success_mask
+        if not success_mask.all():
+            log.error('Unable to insert all records into %s bin %d, failed records: %d',
+                      stream, bin_number, count - success_mask.sum())
+            if not success_mask.any():
+                continue
+            first = group_times[success_mask].min()
+            last = group_times[success_mask].max()
+            count = int(success_mask.sum())
+
+        inserted[bin_number] = {'first': first, 'last': last, 'count': count}
+
+    written = np.flatnonzero(written)
+    _index_last_record(fixed_values, stream, times[written], bins[written], [ids[i] for i in written])
+    _count_inserted(fixed_values, stream, inserted)
     return inserted
 
 
 def delete_dataframe(dataframe, metadata_record):
+    """
+    Delete the rows of dataframe (time, deployment and id columns) from the partition described
+    by metadata_record. Only rows present in the partition are deleted, a delete of a missing row
+    succeeds as well and would otherwise be subtracted from the bin count.
+    Returns the number of rows deleted.
+    """
     log.info('delete_dataframe(<DATAFRAME>, %s)', metadata_record)
+    if dataframe.empty:
+        return 0
     query = 'delete from %s where subsite=? and node=? and sensor=? ' \
             'and bin=? and method=? and time=? and deployment=? and id=?' % metadata_record.stream
     query = SessionManager.prepare(query)
 
+    existing = _existing_keys(metadata_record, dataframe.time.min(), dataframe.time.max())
+    keys = izip(dataframe.time.values, dataframe.deployment.values, dataframe.id.values)
+    dataframe = dataframe[np.array([k in existing for k in keys], dtype=bool)]
+
     def values_generator(df):
         for index, row in df.iterrows():
             args = (metadata_record.subsite, metadata_record.node, metadata_record.sensor,
@@ -99,4 +336,105 @@ def delete_dataframe(dataframe, metadata_record):
 
     sess = SessionManager.session()
     results = execute_concurrent_with_args(sess, query, values_generator(dataframe), concurrency=200)
-    return sum((success for success, _ in results if success))
\ No newline at end of file
+    deleted = np.array([success for success, _ in results], dtype=bool)
+    count = int(deleted.sum())
+    if count:
+        _count_deleted(metadata_record, count)
+        deleted_ids = set(dataframe.id.values[deleted])
+        _invalidate_last_records(metadata_record, lambda r: r.id in deleted_ids)
+    return count
+
+
+def _existing_keys(metadata_record, first, last):
+    """
+    Return the set of (time, deployment, id) keys of the rows with first <= time <= last in the
+    partition described by metadata_record
+    """
+    statement = 'select time, deployment, id from %s where subsite=? and node=? and sensor=? ' \
+                'and bin=? and method=? and time>=? and time<=?' % metadata_record.stream
+    rows = SessionManager.execute(SessionManager.prepare(statement),
+                                  (metadata_record.subsite, metadata_record.node, metadata_record.sensor,
+                                   metadata_record.bin, metadata_record.method, first, last))
+    return {tuple(row) for row in rows}
+
+
+def delete_range(metadata_record, first, last):
+    """
+    Delete all rows with first <= time <= last from the partition described by metadata_record
+    (a PartitionMetadatum) with a single clustering range delete.
+    Returns a DeletedRange holding the number of rows deleted and the first and last times of
+    the remaining rows (None if the partition is now empty).
+
+    When the range covers the whole partition the count is taken from the partition metadata.
+    The partition metadata and bin counts only hold per bin totals, so a partial overlap still
+    counts the deleted slice. When the slice removes the start or end of the partition the new
+    bound is read from the single row following or preceding the slice.
+    """
+    log.info('delete_range(%s, %s, %s)', metadata_record, first, last)
+    if last < metadata_record.first or first > metadata_record.last:
+        return DeletedRange(0, metadata_record.first, metadata_record.last)
+
+    key = (metadata_record.subsite, metadata_record.node, metadata_record.sensor,
+           metadata_record.bin, metadata_record.method)
+    count_statement, delete_statement, before_statement, after_statement = _range_statements(metadata_record.stream)
+
+    if first <= metadata_record.first and last >= metadata_record.last:
+        remaining_first = remaining_last = None
+        count = metadata_record.count
+    else:
+        count = list(SessionManager.execute(SessionManager.prepare(count_statement), key + (first, last)))[0][0]
+        remaining_first, remaining_last = metadata_record.first, metadata_record.last
+        if first <= metadata_record.first:
+            remaining_first = _bound(after_statement, key + (last,))
+        if last >= metadata_record.last:
+            remaining_last = _bound(before_statement, key + (first,))
+
+    if count:
+        SessionManager.execute(SessionManager.prepare(delete_statement), key + (first, last))
+        _count_deleted(metadata_record, count)
+        _invalidate_last_records(metadata_record, lambda r: r.bin == metadata_record.bin and first <= r.time <= last)
+    return DeletedRange(count, remaining_first, remaining_last)
+
+
+def _bound(statement, args):
+    rows = list(SessionManager.execute(SessionManager.prepare(statement), args))
+    return rows[0][0] if rows else None
+
+
+def _count_deleted(metadata_record, count):
+    update_bin_counts(SessionManager, metadata_record.subsite, metadata_record.node, metadata_record.sensor,
+                      metadata_record.method, metadata_record.stream, {metadata_record.bin: -count})
+
+
+def _invalidate_last_records(metadata_record, deleted):
+    invalidate_last_records(SessionManager, make_refdes(metadata_record.subsite, metadata_record.node,
+                                                        metadata_record.sensor),
+                            metadata_record.method, metadata_record.stream, deleted)
+
+
+def _range_statements(stream):
+    key = 'where subsite=? and node=? and sensor=? and bin=? and method=?'
+    where = key + ' and time>=? and time<=?'
+    return ('select count(*) from %s %s' % (stream, where),
+            'delete from %s %s' % (stream, where),
+            'select time from %s %s and time<? order by method desc, time desc limit 1' % (stream, key),
+            'select time from %s %s and time>? order by method, time limit 1' % (stream, key))
+
+
+def warm_up(fetch=None, insert=None, delete=()):
+    """
+    Prepare the statements a job executes, typically at service start. fetch and insert map each
+    stream to the columns fetched (by fetch_range / fetch_bin) or inserted (by insert_dataframe),
+    None for all columns. delete lists the streams delete_range is used on.
+    """
+    def fetch_statements(stream):
+        cols = fetch[stream] or SessionManager.get_query_columns(stream)
+        return [_bin_statement(stream, cols), _bin_statement(stream, cols, min_time=0, max_time=0)]
+
+    def insert_statements(stream):
+        return [_insert_statement(stream, insert[stream] or SessionManager.get_query_columns(stream))[0]]
+
+    statements = stream_statements(fetch or {}, fetch_statements)
+    statements.extend(stream_statements(insert or {}, insert_statements))
+    statements.extend(stream_statements(delete, _range_statements))
+    SessionManager.warm_up(statements)
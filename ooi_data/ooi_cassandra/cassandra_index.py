@@ -0,0 +1,123 @@
+import logging
+from collections import namedtuple
+from itertools import izip
+
+import numpy as np
+from cassandra.concurrent import execute_concurrent_with_args
+
+from .cassandra_session import prepare_if_exists
+
+log = logging.getLogger(__name__)
+
+LastRecord = namedtuple('LastRecord', ['deployment', 'time', 'bin', 'id'])
+
+LAST_RECORD_TABLE = 'stream_last_record'
+# The last record of each deployment of a stream. Entries are created and replaced with lightweight
+# transactions conditional on the data time so the latest record wins regardless of the order writes are applied.
+CREATE_LAST_RECORD_TABLE = """
+CREATE TABLE IF NOT EXISTS stream_last_record (
+    refdes text,
+    method text,
+    stream text,
+    deployment int,
+    time double,
+    bin bigint,
+    id uuid,
+    PRIMARY KEY((refdes, method, stream), deployment)
+);
+"""
+CREATE_LAST_RECORD = 'INSERT INTO stream_last_record (refdes, method, stream, deployment, time, bin, id) ' \
+                     'VALUES (?, ?, ?, ?, ?, ?, ?) IF NOT EXISTS'
+UPDATE_LAST_RECORD = 'UPDATE stream_last_record SET time=?, bin=?, id=? ' \
+                     'WHERE refdes=? AND method=? AND stream=? AND deployment=? IF time < ?'
+SELECT_LAST_RECORDS = 'SELECT deployment, time, bin, id FROM stream_last_record ' \
+                      'WHERE refdes=? AND method=? AND stream=? AND deployment IN ?'
+SELECT_STREAM_LAST_RECORDS = 'SELECT deployment, time, bin, id FROM stream_last_record ' \
+                             'WHERE refdes=? AND method=? AND stream=?'
+DELETE_LAST_RECORD = 'DELETE FROM stream_last_record ' \
+                     'WHERE refdes=? AND method=? AND stream=? AND deployment=? IF id = ?'
+
+
+def make_refdes(subsite, node, sensor):
+    return '-'.join((subsite, node, sensor))
+
+
+def _applied(result):
+    # the first column of a lightweight transaction result is [applied]
+    return next(iter(result))[0]
+
+
+def last_records(deployments, times, bins, ids):
+    """
+    Return a LastRecord holding the row with the latest time for each deployment
+    """
+    deployments = np.asarray(deployments)
+    times = np.asarray(times)
+    if not times.size:
+        return []
+    order = np.lexsort((times, deployments))
+    sorted_deployments = deployments[order]
+    last = order[np.r_[sorted_deployments[1:] != sorted_deployments[:-1], True]]
+    return [LastRecord(int(deployments[i]), float(times[i]), int(bins[i]), ids[i]) for i in last]
+
+
+def update_last_records(session_manager, refdes, method, stream, records):
+    """
+    Record the last record of each deployment written to a stream. Failures are logged and
+    otherwise ignored, the lookback falls back to scanning when the index is missing or stale.
+    """
+    if not records:
+        return
+    create = prepare_if_exists(session_manager, CREATE_LAST_RECORD, LAST_RECORD_TABLE)
+    if create is None:
+        return
+    update = session_manager.prepare(UPDATE_LAST_RECORD)
+    args = [(refdes, method, stream, r.deployment, r.time, r.bin, r.id) for r in records]
+    results = execute_concurrent_with_args(session_manager.session(), create, args, raise_on_first_error=False)
+    failed = []
+    existing = []
+    for r, (success, result) in izip(records, results):
+        if not success:
+            failed.append(r)
+        elif not _applied(result):
+            existing.append(r)
+
+    # replace existing entries only with a later record
+    if existing:
+        args = [(r.time, r.bin, r.id, refdes, method, stream, r.deployment, r.time) for r in existing]
+        results = execute_concurrent_with_args(session_manager.session(), update, args, raise_on_first_error=False)
+        failed.extend(r for r, (success, _) in izip(existing, results) if not success)
+    if failed:
+        log.warn('Unable to update last record index for %s %s %s: %r', refdes, method, stream, failed)
+
+
+def fetch_last_records(session_manager, refdes, method, stream, deployments):
+    """
+    Return a dictionary of deployment to LastRecord for the indexed deployments
+    """
+    statement = prepare_if_exists(session_manager, SELECT_LAST_RECORDS, LAST_RECORD_TABLE)
+    if statement is None:
+        return {}
+    rows = session_manager.execute(statement, (refdes, method, stream, list(deployments)))
+    return {row[0]: LastRecord(*row) for row in rows}
+
+
+def invalidate_last_records(session_manager, refdes, method, stream, deleted):
+    """
+    Remove the entries pointing at rows which have been deleted, deleted(record) returns True for
+    a LastRecord whose row was deleted. An entry is only removed if it still holds the deleted row.
+    The lookback scans for deployments without an entry until the next insert recreates it.
+    """
+    statement = prepare_if_exists(session_manager, SELECT_STREAM_LAST_RECORDS, LAST_RECORD_TABLE)
+    if statement is None:
+        return
+    stale = [r for r in (LastRecord(*row) for row in session_manager.execute(statement, (refdes, method, stream)))
+             if deleted(r)]
+    if not stale:
+        return
+    statement = session_manager.prepare(DELETE_LAST_RECORD)
+    args = [(refdes, method, stream, r.deployment, r.id) for r in stale]
+    results = execute_concurrent_with_args(session_manager.session(), statement, args, raise_on_first_error=False)
+    failed = [r for r, (success, _) in izip(stale, results) if not success]
+    if failed:
+        log.warn('Unable to invalidate last record index for %s %s %s: %r', refdes, method, stream, failed)
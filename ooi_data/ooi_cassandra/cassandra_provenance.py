@@ -1,9 +1,18 @@
+import base64
+import json
 import logging
+import time
 import uuid
+import zlib
 from collections import namedtuple
+from itertools import izip
+from operator import itemgetter
 
+import numpy as np
+from cassandra import InvalidRequest
 from cassandra.concurrent import execute_concurrent_with_args
 
+from .cache import LRUCache
 from .cassandra_session import SessionManager
 
 logging.getLogger('cassandra').setLevel(logging.WARNING)
@@ -14,6 +23,127 @@ ProvTuple = namedtuple('provenance_tuple', ['subsite', 'sensor', 'node', 'method
 
 L0_DATASET = 'select * from dataset_l0_provenance where subsite=? and node=? and ' \
              'sensor=? and method=? and deployment=? and id=?'
+L0_DATASET_IN = 'select * from dataset_l0_provenance where subsite=? and node=? and ' \
+                'sensor=? and method=? and deployment=? and id in ?'
+# number of ids per IN query
+PROVENANCE_CHUNK_SIZE = 100
+# position of the id in a dataset_l0_provenance row
+ID_INDEX = ProvTuple._fields.index('id')
+
+l0_stream_columns = ['time', 'id', 'driver_class', 'driver_host', 'driver_module', 'driver_version', 'event_json']
+StreamProvTuple = namedtuple('stream_provenance_tuple', l0_stream_columns)
+
+L0_STREAM_ONE = """SELECT {:s} FROM streaming_l0_provenance
+WHERE refdes = ? AND method = ? and time <= ? ORDER BY time DESC LIMIT 1""".format(', '.join(l0_stream_columns))
+
+L0_STREAM_RANGE = """SELECT {:s} FROM streaming_l0_provenance
+WHERE refdes = ? AND method = ? and time >= ? and time <= ?""".format(', '.join(l0_stream_columns))
+
+# Process wide cache of dataset_l0_provenance rows keyed by (refdes, method, deployment, id).
+# Ids which were not found are cached as a timestamped miss so they are looked up again after
+# PROVENANCE_NEGATIVE_TTL seconds in case the provenance is written later.
+PROVENANCE_CACHE_SIZE = 10000
+PROVENANCE_NEGATIVE_TTL = 300
+provenance_cache = LRUCache(PROVENANCE_CACHE_SIZE)
+
+
+class _Missing(object):
+    __slots__ = ['expires']
+
+    def __init__(self, expires):
+        self.expires = expires
+
+
+# Namespace of the content addressed provenance ids, changing it changes every derived id
+PROVENANCE_NAMESPACE = uuid.UUID('5f1c7c2e-8a4b-5d6e-9b3a-0c2d4e6f8a1b')
+# Encoded provenance larger than this many bytes is compressed when compression is requested
+PROVENANCE_COMPRESS_THRESHOLD = 4096
+COMPRESSED_PREFIX = 'zlib:'
+
+# Streaming provenance interval tables keyed by (refdes, method), reloaded after PROVENANCE_STREAM_TTL
+# seconds as new driver provenance records may be written while a stream is live
+PROVENANCE_STREAM_CACHE_SIZE = 256
+PROVENANCE_STREAM_TTL = 300
+streaming_provenance_cache = LRUCache(PROVENANCE_STREAM_CACHE_SIZE)
+
+
+def provenance_cache_stats():
+    return provenance_cache.stats()
+
+
+def _provenance_key(subsite, node, sensor, method, deployment, prov_id):
+    return '-'.join((subsite, node, sensor)), method, deployment, prov_id
+
+
+def _query_l0_provenance(session_manager, partition, prov_ids):
+    """
+    Query the provenance rows of prov_ids with IN queries of up to PROVENANCE_CHUNK_SIZE ids,
+    falling back to one query per id if the table does not allow IN on id.
+    Returns a dictionary of id to row for the ids found and the set of ids which could not be queried.
+    """
+    try:
+        query = session_manager.prepare(L0_DATASET_IN)
+    except InvalidRequest:
+        return _query_l0_provenance_by_id(session_manager, partition, prov_ids)
+
+    chunks = [partition + (prov_ids[i:i + PROVENANCE_CHUNK_SIZE],)
+              for i in xrange(0, len(prov_ids), PROVENANCE_CHUNK_SIZE)]
+    found = {}
+    failed = set()
+    results = execute_concurrent_with_args(session_manager.session(), query, chunks, raise_on_first_error=False)
+    for chunk, (success, rows) in izip(chunks, results):
+        if success:
+            found.update((row[ID_INDEX], row) for row in rows)
+        else:
+            log.warn('Provenance lookup failed: %r', rows)
+            failed.update(chunk[-1])
+    return found, failed
+
+
+def _query_l0_provenance_by_id(session_manager, partition, prov_ids):
+    query = session_manager.prepare(L0_DATASET)
+    results = execute_concurrent_with_args(session_manager.session(), query,
+                                           [partition + (prov_id,) for prov_id in prov_ids],
+                                           raise_on_first_error=False)
+    found = {}
+    failed = set()
+    for prov_id, (success, rows) in izip(prov_ids, results):
+        if not success:
+            log.warn('Provenance lookup failed: %r', rows)
+            failed.add(prov_id)
+            continue
+        rows = list(rows)
+        if rows:
+            found[prov_id] = rows[0]
+    return found, failed
+
+
+def lookup_l0_provenance(session_manager, subsite, node, sensor, method, deployment, prov_ids):
+    """
+    Return a dictionary of provenance id to dataset_l0_provenance row for the ids which exist.
+    Rows and misses are cached, only ids not in the cache are queried. Ids whose query failed are
+    not cached so they are looked up again by the next call.
+    """
+    partition = (subsite, node, sensor, method, deployment)
+    found = {}
+    to_query = []
+    now = time.time()
+    for prov_id in prov_ids:
+        cached = provenance_cache.get(_provenance_key(*(partition + (prov_id,))))
+        if cached is None or (isinstance(cached, _Missing) and cached.expires < now):
+            to_query.append(prov_id)
+        elif not isinstance(cached, _Missing):
+            found[prov_id] = cached
+
+    if to_query:
+        rows, failed = _query_l0_provenance(session_manager, partition, to_query)
+        missing = _Missing(now + PROVENANCE_NEGATIVE_TTL)
+        for prov_id in to_query:
+            if prov_id in failed:
+                continue
+            provenance_cache.put(_provenance_key(*(partition + (prov_id,))), rows.get(prov_id, missing))
+        found.update(rows)
+    return found
 
 
 def fetch_l0_provenance(stream_key, provenance_values, deployment):
@@ -35,20 +165,15 @@ def fetch_l0_provenance(stream_key, provenance_values, deployment):
             except ValueError:
                 pass
 
-    provenance_arguments = [
-        (stream_key.subsite, stream_key.node, stream_key.sensor,
-         stream_key.method, deployment, prov_id) for prov_id in prov_ids]
+    rows = lookup_l0_provenance(SessionManager, stream_key.subsite, stream_key.node, stream_key.sensor,
+                                stream_key.method, deployment, prov_ids)
+    records = [ProvTuple(*row) for row in rows.itervalues()]
 
-    query = SessionManager.prepare(L0_DATASET)
-    results = execute_concurrent_with_args(SessionManager.session(), query, provenance_arguments)
-    results = [list(rows) for success, rows in results if success]
-    records = [ProvTuple(*rows[0]) for rows in results if len(rows) > 0]
-
-    if len(provenance_arguments) != len(records):
-        log.warn("Could not find %d provenance entries", len(provenance_arguments) - len(records))
+    if len(prov_ids) != len(records):
+        log.warn("Could not find %d provenance entries", len(prov_ids) - len(records))
 
     prov_dict = {
-        str(row.id): {'filename': row.filename,
+        str(row.id): {'filename': decode_provenance_filename(row.filename),
                       'parsername': row.parsername,
                       'parserversion': row.parserversion}
         for row in records}
@@ -61,3 +186,109 @@ def insert_l0_provenance(provenance_record):
     query = 'insert into dataset_l0_provenance (%s) values (%s)' % (fields, placeholders)
     query = SessionManager.prepare(query)
     SessionManager.execute_lazy(query, provenance_record)
+    # replace any cached miss for this id
+    provenance_cache.put(_provenance_key(provenance_record.subsite, provenance_record.node,
+                                         provenance_record.sensor, provenance_record.method,
+                                         provenance_record.deployment, provenance_record.id),
+                         tuple(provenance_record))
+
+
+def insert_l0_provenance_once(provenance_record):
+    """
+    Insert provenance_record unless a record with the same id already exists in its partition.
+    Intended for content addressed records (see content_provenance_id) where an existing id
+    means an identical record. Returns True if the record was inserted.
+    """
+    r = provenance_record
+    if lookup_l0_provenance(SessionManager, r.subsite, r.node, r.sensor, r.method, r.deployment, [r.id]):
+        log.debug('Provenance %s already exists', r.id)
+        return False
+    insert_l0_provenance(provenance_record)
+    return True
+
+
+def content_provenance_id(provenance, version):
+    """
+    Derive a deterministic provenance id from the input provenance (any JSON serializable value,
+    e.g. the dictionary returned by fetch_l0_provenance) and the version of the processing code
+    """
+    content = json.dumps([provenance, version], sort_keys=True, separators=(',', ':'))
+    return uuid.uuid5(PROVENANCE_NAMESPACE, content)
+
+
+def encode_provenance_filename(provenance, compress=False):
+    """
+    Encode provenance as JSON for the filename column. If compress is True payloads larger than
+    PROVENANCE_COMPRESS_THRESHOLD are stored zlib compressed and base64 encoded behind a prefix.
+    """
+    encoded = json.dumps(provenance, sort_keys=True)
+    if compress and len(encoded) > PROVENANCE_COMPRESS_THRESHOLD:
+        encoded = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(encoded))
+    return encoded
+
+
+def decode_provenance_filename(filename):
+    """
+    Undo the compression of encode_provenance_filename, other values are returned unchanged
+    """
+    if filename and filename.startswith(COMPRESSED_PREFIX):
+        return zlib.decompress(base64.b64decode(filename[len(COMPRESSED_PREFIX):]))
+    return filename
+
+
+class ProvenanceIntervals(object):
+    """
+    Table of the streaming provenance records in effect over [start, stop]. Each record applies
+    from its time until the time of the next record.
+    """
+    def __init__(self, start, stop, records, loaded=None):
+        self.start = start
+        self.stop = stop
+        # one record per time, in time order
+        records = sorted({r[0]: r for r in records}.itervalues(), key=itemgetter(0))
+        self.records = [StreamProvTuple(*r) for r in records]
+        self.times = np.array([r.time for r in self.records], dtype=np.float64)
+        self.loaded = time.time() if loaded is None else loaded
+
+    def covers(self, start, stop):
+        return self.start <= start and stop <= self.stop and time.time() - self.loaded < PROVENANCE_STREAM_TTL
+
+    def assign(self, times):
+        """
+        Return the index of the record in effect at each time, -1 where no record precedes the time
+        """
+        return np.searchsorted(self.times, np.asarray(times, dtype=np.float64), side='right') - 1
+
+
+def load_provenance_intervals(session_manager, refdes, method, start, stop):
+    """
+    Load the streaming provenance record in effect at start and all records up to stop
+    """
+    session = session_manager.session()
+    first = session_manager.prepare(L0_STREAM_ONE)
+    records = list(session.execute(first, (refdes, method, start)))
+    in_range = session_manager.prepare(L0_STREAM_RANGE)
+    records.extend(session.execute(in_range, (refdes, method, start, stop)))
+    return ProvenanceIntervals(start, stop, records)
+
+
+def resolve_streaming_provenance(session_manager, refdes, method, times):
+    """
+    Return the streaming provenance interval table covering times and the index of the record
+    in effect for each time. Interval tables are cached per (refdes, method) and extended when
+    a request falls outside the cached range.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    if not times.size:
+        return ProvenanceIntervals(0, 0, []), np.array([], dtype=np.int64)
+    start, stop = times.min(), times.max()
+
+    key = (refdes, method)
+    intervals = streaming_provenance_cache.get(key)
+    if intervals is None or not intervals.covers(start, stop):
+        if intervals is not None and intervals.start <= stop and start <= intervals.stop:
+            # overlapping requests extend the cached range
+            start, stop = min(start, intervals.start), max(stop, intervals.stop)
+        intervals = load_provenance_intervals(session_manager, refdes, method, start, stop)
+        streaming_provenance_cache.put(key, intervals)
+    return intervals, intervals.assign(times)
@@ -0,0 +1,88 @@
+import logging
+import uuid
+from itertools import izip
+
+import numpy as np
+from cassandra.concurrent import execute_concurrent
+from cassandra.query import BatchStatement, BatchType
+
+from .cassandra_data import bin_slices
+
+log = logging.getLogger(__name__)
+
+# One row per particle, the results of each parameter's QC tests are packed into a single
+# flag vector (bit n set when test n passed) stored under the parameter name
+CREATE_QC_RESULTS_TABLE = """
+CREATE TABLE IF NOT EXISTS qc_results_packed (
+    subsite text,
+    node text,
+    sensor text,
+    bin bigint,
+    stream text,
+    deployment int,
+    id uuid,
+    results map<text, bigint>,
+    PRIMARY KEY((subsite, node, sensor, bin), stream, deployment, id)
+);
+"""
+UPDATE_QC_RESULTS = 'UPDATE qc_results_packed SET results[?] = ? ' \
+                    'WHERE subsite=? AND node=? AND sensor=? AND bin=? AND stream=? AND deployment=? AND id=?'
+
+
+class QcResultsWriter(object):
+    """
+    Write QC results grouped by (subsite, node, sensor, bin) partition. Each partition is written
+    in UNLOGGED single partition batches of at most batch_size particles with no more than
+    max_in_flight batches outstanding. Success and failure counts are kept per parameter.
+    """
+    def __init__(self, session_manager, pk, batch_size=100, max_in_flight=16):
+        self.session_manager = session_manager
+        self.pk = pk
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.counts = {}
+
+    def _batches(self, statement, param_name, flags, ids, bins, deployments):
+        subsite, node, sensor, stream = (self.pk.get(k) for k in ('subsite', 'node', 'sensor', 'stream'))
+        order = np.argsort(bins, kind='mergesort')
+        sorted_bins = bins[order]
+        for bin_number, start, stop in bin_slices(sorted_bins):
+            for batch_start in xrange(start, stop, self.batch_size):
+                rows = order[batch_start:min(batch_start + self.batch_size, stop)].tolist()
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for i in rows:
+                    batch.add(statement, (param_name, flags[i], subsite, node, sensor, bin_number, stream,
+                                          deployments[i], ids[i]))
+                yield len(rows), (batch, None)
+
+    def write(self, param_name, qc_results_values, particle_ids, particle_bins, particle_deploys):
+        """
+        Store the packed QC results of param_name for each particle, returns the number of particles written
+        """
+        flags = np.asarray(qc_results_values, dtype=np.int64).tolist()
+        ids = [i if isinstance(i, uuid.UUID) else uuid.UUID(i) for i in particle_ids]
+        bins = np.asarray(particle_bins, dtype=np.int64)
+        deployments = np.asarray(particle_deploys, dtype=np.int32).tolist()
+
+        statement = self.session_manager.prepare(UPDATE_QC_RESULTS)
+        sizes = []
+
+        def batches():
+            for size, batch in self._batches(statement, param_name, flags, ids, bins, deployments):
+                sizes.append(size)
+                yield batch
+
+        results = execute_concurrent(self.session_manager.session(), batches(), concurrency=self.max_in_flight,
+                                     raise_on_first_error=False)
+        written = failed = 0
+        for size, (success, result) in izip(sizes, results):
+            if success:
+                written += size
+            else:
+                failed += size
+                log.error('Failed to store QC results of %s for %d particles: %r', param_name, size, result)
+
+        counts = self.counts.setdefault(param_name, {'success': 0, 'failed': 0})
+        counts['success'] += written
+        counts['failed'] += failed
+        return written
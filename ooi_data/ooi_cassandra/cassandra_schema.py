@@ -0,0 +1,79 @@
+import logging
+import threading
+from collections import namedtuple
+from itertools import izip
+
+import numpy as np
+from cassandra.query import _clean_column_name
+
+log = logging.getLogger(__name__)
+
+TableSchema = namedtuple('TableSchema', ['name', 'columns', 'cql_types', 'dtypes', 'encoded_arrays'])
+
+# numpy dtypes for the fixed width CQL types, everything else is stored as object
+CQL_DTYPES = {
+    'double': np.float64,
+    'float': np.float32,
+    'bigint': np.int64,
+    'counter': np.int64,
+    'int': np.int32,
+    'smallint': np.int16,
+    'tinyint': np.int8,
+    'boolean': np.bool_,
+}
+
+# partition key columns which are supplied by the stream key rather than queried
+KEY_COLUMNS = ['subsite', 'node', 'sensor', 'method']
+
+
+class SchemaRegistry(object):
+    """
+    Per table cache of the ordered columns, their CQL types, the matching numpy dtypes and
+    the columns holding encoded (blob) arrays.
+    The driver replaces a table's metadata object when it receives a schema change event,
+    an entry is rebuilt whenever the cached metadata object is no longer the current one.
+    """
+    def __init__(self, cluster, keyspace):
+        self.cluster = cluster
+        self.keyspace = keyspace
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, table):
+        table_metadata = self.cluster.metadata.keyspaces[self.keyspace].tables[table]
+        cached = self._tables.get(table)
+        if cached is not None and cached[0] is table_metadata:
+            return cached[1]
+
+        with self._lock:
+            schema = self._build(table, table_metadata)
+            self._tables[table] = (table_metadata, schema)
+        log.info('Loaded schema for %s', table)
+        return schema
+
+    @staticmethod
+    def _build(table, table_metadata):
+        columns = []
+        cql_types = []
+        for name, column in table_metadata.columns.iteritems():
+            columns.append(_clean_column_name(name))
+            cql_types.append(column.cql_type)
+        dtypes = [np.dtype(CQL_DTYPES.get(cql_type, object)) for cql_type in cql_types]
+        encoded_arrays = frozenset(c for c, t in izip(columns, cql_types) if t == 'blob')
+        return TableSchema(table, columns, cql_types, dtypes, encoded_arrays)
+
+    def query_columns(self, table):
+        """
+        Return the column names of table excluding the stream key columns
+        """
+        return [c for c in self.get(table).columns if c not in KEY_COLUMNS]
+
+    def dtypes(self, table, cols):
+        schema = self.get(table)
+        lookup = dict(izip(schema.columns, schema.dtypes))
+        return [lookup[c] for c in cols]
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
@@ -1,62 +1,194 @@
 import logging
-from multiprocessing import BoundedSemaphore
+from functools import partial
+from multiprocessing import BoundedSemaphore, Pool
 
-from cassandra import ConsistencyLevel
+from cassandra import ConsistencyLevel, InvalidRequest
 from cassandra.cluster import Cluster
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
 from cassandra.protocol import NumpyProtocolHandler, LazyProtocolHandler
-from cassandra.query import _clean_column_name, tuple_factory, named_tuple_factory
+from cassandra.query import tuple_factory, named_tuple_factory
+
+from .cache import LRUCache
+from .cassandra_schema import SchemaRegistry
+
+log = logging.getLogger(__name__)
+
+
+def stream_statements(streams, statements):
+    """
+    Collect the statements(stream) of each stream, for warming up a statement registry
+    """
+    collected = []
+    for stream in streams:
+        collected.extend(statements(stream))
+    return collected
+
+
+class StatementRegistry(object):
+    """
+    Bounded cache of prepared statements keyed by CQL text.
+    Statements are prepared at most once at a time, concurrent requests for the same
+    statement wait for the in-flight prepare. Least recently used statements are evicted.
+    """
+    def __init__(self, prepare, maxsize=1000):
+        self._prepare = prepare
+        self._cache = LRUCache(maxsize)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, statement):
+        return statement in self._cache
+
+    def prepare(self, statement):
+        return self._cache.get_or_load(statement, self._prepare)
+
+    def warm_up(self, statements):
+        """
+        Prepare all statements, typically at service start
+        """
+        for statement in statements:
+            self.prepare(statement)
+        log.info('Prepared statement registry warmed up: %r', self.stats())
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def prepare_if_exists(session_manager, statement, table):
+    """
+    Prepare statement, logging a warning and returning None when it can not be prepared because
+    table is missing. Used for the optional index tables which are not present in every keyspace.
+    """
+    try:
+        return session_manager.prepare(statement)
+    except InvalidRequest:
+        log.warn('Unable to prepare statement, is %s missing? %s', table, statement)
+
+
+# Cluster constructor settings copied to worker processes when create_pool is passed a cluster
+# without a cluster_factory
+CLUSTER_SETTINGS = ('port', 'protocol_version', 'compression', 'auth_provider', 'ssl_options',
+                    'load_balancing_policy', 'reconnection_policy', 'default_retry_policy',
+                    'conviction_policy_factory', 'connection_class', 'metrics_enabled', 'sockopts', 'cql_version',
+                    'executor_threads', 'max_schema_agreement_wait', 'control_connection_timeout',
+                    'idle_heartbeat_interval', 'schema_event_refresh_window', 'topology_event_refresh_window',
+                    'connect_timeout')
+
+
+def make_cluster(contact_points, cluster_kwargs):
+    cluster_kwargs = dict(cluster_kwargs)
+    # route each statement directly to a replica of its (bound) partition key
+    cluster_kwargs.setdefault('load_balancing_policy', TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    return Cluster(contact_points, **cluster_kwargs)
+
+
+def cluster_settings(cluster):
+    """
+    Return the constructor kwargs of an existing cluster
+    """
+    return {name: getattr(cluster, name) for name in CLUSTER_SETTINGS if hasattr(cluster, name)}
 
 
 class SessionManager(object):
-    _prepared_statement_cache = {}
+    _statement_registry = None
+    _schema_registry = None
     _multiprocess_lock = BoundedSemaphore(4)
+    statement_cache_size = 1000
+    __pool = None
 
     @staticmethod
-    def init(contact_points, keyspace, **kwargs):
+    def init(contact_points, keyspace, process_count=None, **kwargs):
         consistency = ConsistencyLevel.LOCAL_ONE
-        cluster = Cluster(contact_points, **kwargs)
-        SessionManager.create_pool(cluster, keyspace, consistency_level=consistency)
+        cluster_factory = partial(make_cluster, contact_points, kwargs)
+        SessionManager.create_pool(cluster_factory(), keyspace, consistency_level=consistency,
+                                   process_count=process_count, cluster_factory=cluster_factory)
 
     @classmethod
     def create_pool(cls, cluster, keyspace, consistency_level=None, fetch_size=None,
-                    default_timeout=None, process_count=None):
-        # cls.__pool = Pool(processes=process_count, initializer=cls._setup,
-        #                   initargs=(cluster, keyspace, consistency_level, fetch_size, default_timeout))
+                    default_timeout=None, process_count=None, cluster_factory=None):
+        if process_count:
+            # The driver cannot be shared across a fork. The parent's Cluster object already exists
+            # (it is only connected after the pool starts) and must not be used by the workers, so each
+            # worker builds its own Cluster and Session (and prepared statement cache) with
+            # cluster_factory, by default from the constructor settings of the parent cluster.
+            if cluster_factory is None:
+                cluster_factory = partial(make_cluster, cluster.contact_points, cluster_settings(cluster))
+            cls.__pool = Pool(processes=process_count, initializer=cls._setup_worker,
+                              initargs=(cluster_factory, keyspace, consistency_level, fetch_size, default_timeout))
         cls._setup(cluster, keyspace, consistency_level, fetch_size, default_timeout)
 
+    @classmethod
+    def _setup_worker(cls, cluster_factory, keyspace, consistency_level, fetch_size, default_timeout):
+        cls.__pool = None
+        cls._setup(cluster_factory(), keyspace, consistency_level, fetch_size, default_timeout)
+
     @classmethod
     def _setup(cls, cluster, keyspace, consistency_level, fetch_size, default_timeout):
         cls.cluster = cluster
-        cls._prepared_statement_cache = {}
 
         with cls._multiprocess_lock:
+            # numpy and row decoded queries each get a dedicated session so that they can be
+            # executed concurrently without swapping the decoder on a shared session
             cls.__session = cls.cluster.connect(keyspace)
+            cls.__numpy_session = cls.cluster.connect(keyspace)
 
+        cls.__session.row_factory = named_tuple_factory
+        cls.__session.client_protocol_handler = LazyProtocolHandler
+        cls.__numpy_session.row_factory = tuple_factory
+        cls.__numpy_session.client_protocol_handler = NumpyProtocolHandler
+
+        for session in (cls.__session, cls.__numpy_session):
             if consistency_level is not None:
-                cls.__session.default_consistency_level = consistency_level
+                session.default_consistency_level = consistency_level
             if fetch_size is not None:
-                cls.__session.default_fetch_size = fetch_size
+                session.default_fetch_size = fetch_size
             if default_timeout is not None:
-                cls.__session.default_timeout = default_timeout
+                session.default_timeout = default_timeout
+
+        cls._statement_registry = StatementRegistry(cls.__session.prepare, cls.statement_cache_size)
+        cls._schema_registry = SchemaRegistry(cluster, keyspace)
 
     @classmethod
     def prepare(cls, statement):
-        if statement not in cls._prepared_statement_cache:
-            cls._prepared_statement_cache[statement] = cls.__session.prepare(statement)
-        return cls._prepared_statement_cache[statement]
+        return cls._statement_registry.prepare(statement)
+
+    @classmethod
+    def warm_up(cls, statements):
+        cls._statement_registry.warm_up(statements)
+
+    @classmethod
+    def statement_stats(cls):
+        return cls._statement_registry.stats()
 
-    def close_pool(self):
-        self.pool.close()
-        self.pool.join()
+    @classmethod
+    def close_pool(cls):
+        if cls.__pool is not None:
+            cls.__pool.close()
+            cls.__pool.join()
+            cls.__pool = None
+
+    @classmethod
+    def map_bins(cls, func, bins, chunksize=1):
+        """
+        Apply func to each bin, spreading the calls across the worker processes if a pool was created,
+        otherwise calling it in this process. func must be a module level function, in a worker it uses
+        that worker's own session. Results are pickled back to the parent so func should return numpy
+        arrays or DataFrames rather than lists of rows.
+        Returns the results in the order of bins.
+        """
+        if cls.__pool is None:
+            return [func(b) for b in bins]
+        return cls.__pool.map(func, bins, chunksize)
 
     @classmethod
     def get_query_columns(cls, table):
-        # grab the column names from our metadata
-        cols = cls.cluster.metadata.keyspaces[cls.__session.keyspace].tables[table].columns.keys()
-        cols = map(_clean_column_name, cols)
-        unneeded = ['subsite', 'node', 'sensor', 'method']
-        cols = [c for c in cols if c not in unneeded]
-        return cols
+        # grab the column names from our cached schema metadata
+        return cls._schema_registry.query_columns(table)
+
+    @classmethod
+    def get_schema(cls, table):
+        return cls._schema_registry.get(table)
 
     @classmethod
     def execute_lazy(cls, *args, **kwargs):
@@ -64,13 +196,11 @@ class SessionManager(object):
 
     @classmethod
     def execute_numpy(cls, *args, **kwargs):
-        try:
-            cls.__session.row_factory = tuple_factory
-            cls.__session.client_protocol_handler = NumpyProtocolHandler
-            return cls.__session.execute(*args, **kwargs)
-        finally:
-            cls.__session.row_factory = named_tuple_factory
-            cls.__session.client_protocol_handler = LazyProtocolHandler
+        return cls.__numpy_session.execute(*args, **kwargs)
+
+    @classmethod
+    def execute_numpy_async(cls, *args, **kwargs):
+        return cls.__numpy_session.execute_async(*args, **kwargs)
 
     @classmethod
     def execute(cls, *args, **kwargs):
@@ -80,6 +210,10 @@ class SessionManager(object):
     def session(cls):
         return cls.__session
 
+    @classmethod
+    def numpy_session(cls):
+        return cls.__numpy_session
+
     @classmethod
     def pool(cls):
         return cls.__pool
@@ -1,7 +1,7 @@
 import logging
 import time
 import uuid
-from collections import deque, namedtuple
+from collections import namedtuple
 from itertools import izip
 from multiprocessing import BoundedSemaphore
 
@@ -10,36 +10,49 @@ import numpy
 from cassandra import ConsistencyLevel
 from cassandra.cluster import Cluster, PagedResult
 from cassandra.concurrent import execute_concurrent_with_args
-from cassandra.query import _clean_column_name, tuple_factory, BatchStatement
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import tuple_factory
 
 import engine
 from util.common import log_timing
 from util.datamodel import to_xray_dataset
 from util.metadata_service import (CASS_LOCATION_NAME, get_location_metadata_by_store, get_location_metadata,
                                    metadata_service_api)
+from .array_codec import decode_columns, encode_cells, pack_columns
+from .cassandra_counts import count_rows, fetch_bin_counts, update_bin_counts
+from .cassandra_data import execute_batched
+from .cassandra_index import fetch_last_records, last_records, update_last_records
+from .cassandra_provenance import (L0_STREAM_ONE, L0_STREAM_RANGE, StreamProvTuple, decode_provenance_filename,
+                                   l0_stream_columns, lookup_l0_provenance, resolve_streaming_provenance)
+from .cassandra_qc import QcResultsWriter
+from .cassandra_schema import SchemaRegistry
+from .cassandra_session import StatementRegistry, stream_statements
+from .sampling import (StreamingDecimator, bin_bounds, column, dedup_rows, format_plan, plan_sample_points,
+                       sort_rows)
 
 logging.getLogger('cassandra').setLevel(logging.WARNING)
 log = logging.getLogger(__name__)
 
-l0_stream_columns = ['time', 'id', 'driver_class', 'driver_host', 'driver_module', 'driver_version', 'event_json']
 ProvTuple = namedtuple('provenance_tuple',
                        ['subsite', 'sensor', 'node', 'method', 'deployment', 'id', 'file_name', 'parser_name',
                         'parser_version'])
-StreamProvTuple = namedtuple('stream_provenance_tuple', l0_stream_columns)
 
-L0_DATASET = """select * from dataset_l0_provenance
-where subsite=? and node=? and sensor=? and method=? and deployment=? and id=?"""
-
-L0_STREAM_ONE = """SELECT {:s} FROM streaming_l0_provenance
-WHERE refdes = ? AND method = ? and time <= ? ORDER BY time DESC LIMIT 1""".format(', '.join(l0_stream_columns))
-
-L0_STREAM_RANGE = """SELECT {:s} FROM streaming_l0_provenance
-WHERE refdes = ? AND method = ? and time >= ? and time <= ?""".format(', '.join(l0_stream_columns))
+# All partition key columns are bound so the driver can route each query to a replica
+PARTITION_WHERE = "where subsite=? and node=? and sensor=? and bin=? and method=?"
+UNLIMITED_QUERY = "select %s from %s " + PARTITION_WHERE + " and time>=? and time<=?"
+BIN_FIRST_QUERY = "select %s from %s " + PARTITION_WHERE + " order by method, time limit 1"
+FIRST_AFTER_QUERY = "select %s from %s " + PARTITION_WHERE + " and time >= ? ORDER BY method ASC, time ASC LIMIT 1"
+N_BEFORE_QUERY = "select %s from %s " + PARTITION_WHERE + " and time <= ? ORDER BY method DESC, time DESC LIMIT ?"
+PARTITION_KEYS_QUERY = "select %s from %s " + PARTITION_WHERE
+POINT_QUERY = "select %s from %s " + PARTITION_WHERE + " and time=? and deployment=? and id=?"
+CREATE_ROWS_QUERY = "INSERT INTO %s (subsite, node, sensor, bin, method, time, deployment, id) " \
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) IF NOT EXISTS"
 
 
 # noinspection PyUnresolvedReferences
 class SessionManager(object):
-    _prepared_statement_cache = {}
+    _statement_registry = None
+    _schema_registry = None
     _multiprocess_lock = BoundedSemaphore(4)
 
     @classmethod
@@ -61,13 +74,21 @@ class SessionManager(object):
             cls.__session.default_fetch_size = fetch_size
         if default_timeout is not None:
             cls.__session.default_timeout = default_timeout
-        cls._prepared_statement_cache = {}
+        cls._statement_registry = StatementRegistry(cls.__session.prepare,
+                                                    engine.app.config.get('CASSANDRA_STATEMENT_CACHE_SIZE', 1000))
+        cls._schema_registry = SchemaRegistry(cluster, keyspace)
 
     @classmethod
     def prepare(cls, statement):
-        if statement not in cls._prepared_statement_cache:
-            cls._prepared_statement_cache[statement] = cls.__session.prepare(statement)
-        return cls._prepared_statement_cache[statement]
+        return cls._statement_registry.prepare(statement)
+
+    @classmethod
+    def warm_up(cls, statements):
+        cls._statement_registry.warm_up(statements)
+
+    @classmethod
+    def statement_stats(cls):
+        return cls._statement_registry.stats()
 
     def close_pool(self):
         self.pool.close()
@@ -75,12 +96,12 @@ class SessionManager(object):
 
     @classmethod
     def get_query_columns(cls, table):
-        # grab the column names from our metadata
-        cols = cls.cluster.metadata.keyspaces[cls.__session.keyspace].tables[table].columns.keys()
-        cols = map(_clean_column_name, cols)
-        unneeded = ['subsite', 'node', 'sensor', 'method']
-        cols = [c for c in cols if c not in unneeded]
-        return cols
+        # grab the column names from our cached schema metadata
+        return cls._schema_registry.query_columns(table)
+
+    @classmethod
+    def get_schema(cls, table):
+        return cls._schema_registry.get(table)
 
     @classmethod
     def execute(cls, *args, **kwargs):
@@ -105,7 +126,8 @@ def _init():
             engine.app.config['CASSANDRA_CONTACT_POINTS'],
             control_connection_timeout=engine.app.config['CASSANDRA_CONNECT_TIMEOUT'],
             compression=True,
-            protocol_version=3)
+            protocol_version=3,
+            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
     SessionManager.create_pool(cluster,
                                engine.app.config['CASSANDRA_KEYSPACE'],
                                consistency_level=consistency,
@@ -116,85 +138,107 @@ def _init():
 
 @log_timing(log)
 def get_cass_lookback_dataset(stream_key, start_time, data_bin, deployments, request_id):
-    # try to fetch the first n times to ensure we get a deployment value in there.
-    cols, rows = fetch_with_func(query_n_before, stream_key,
-                                 [(data_bin, start_time, engine.app.config['LOOKBACK_QUERY_LIMIT'])])
-    needed = set(deployments)
+    cols = SessionManager.get_query_columns(stream_key.stream.name)
     dep_idx = cols.index('deployment')
-    ret_rows = []
+    # the indexed last record of a deployment is the record the scan of data_bin would find if it is
+    # in data_bin and precedes the start time
+    records = fetch_last_records(SessionManager, stream_key.as_refdes(), stream_key.method, stream_key.stream.name,
+                                 deployments)
+    point_args = [(r.bin, r.time, r.deployment, r.id) for r in records.itervalues()
+                  if r.bin == data_bin and r.time <= start_time]
+    ret_rows = _query_partitions(stream_key, POINT_QUERY, point_args, cols) if point_args else []
+    needed = set(deployments) - {r[dep_idx] for r in ret_rows}
+    if not needed:
+        return _to_xray_dataset(stream_key, cols, ret_rows, request_id)
+
+    # try to fetch the first n times to ensure we get a deployment value in there.
+    log.info('Last record index missing deployments %s for %s, scanning', sorted(needed), stream_key.as_refdes())
+    _, rows = fetch_with_func(query_n_before, stream_key,
+                              [(data_bin, start_time, engine.app.config['LOOKBACK_QUERY_LIMIT'])], cols)
     for r in rows:
         if r[dep_idx] in needed:
             ret_rows.append(r)
             needed.remove(r[dep_idx])
-    return to_xray_dataset(cols, ret_rows, stream_key, request_id)
+    return _to_xray_dataset(stream_key, cols, ret_rows, request_id)
 
 
-@log_timing(log)
-def query_bin_first(stream_key, bins, cols=None):
-    # attempt to find one data point beyond the requested start/stop times
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' order by method, time limit 1" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node,
-             stream_key.sensor, stream_key.method)
-    query = SessionManager.prepare(query)
+def _encoded_indices(stream_key, cols):
+    encoded = SessionManager.get_schema(stream_key.stream.name).encoded_arrays
+    return [i for i, c in enumerate(cols) if c in encoded]
+
+
+def _decode_arrays(stream_key, cols, rows):
+    # binary array cells are decoded here, msgpack cells are left for the caller to unpack
+    return decode_columns(rows, _encoded_indices(stream_key, cols))
+
+
+def _to_xray_dataset(stream_key, cols, rows, request_id):
+    # to_xray_dataset unpacks every array<quantity> cell with msgpack, so binary and decoded cells are packed for it
+    return to_xray_dataset(cols, pack_columns(rows, _encoded_indices(stream_key, cols)), stream_key, request_id)
+
+
+def _bind_partition(stream_key, args):
+    """
+    Prefix each set of (bin, ...) query arguments with the partition key of stream_key
+    so that the driver can compute a routing key from the bound values
+    """
+    return [(stream_key.subsite, stream_key.node, stream_key.sensor, a[0], stream_key.method) + tuple(a[1:])
+            for a in args]
+
+
+def _query_partitions(stream_key, template, args, cols):
+    query = SessionManager.prepare(template % (','.join(cols), stream_key.stream.name))
     result = []
-    # prepare the arguments for cassandra. Each need to be in their own list
-    bins = [[x] for x in bins]
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, bins, concurrency=50):
+    for success, rows in execute_concurrent_with_args(SessionManager.session(), query,
+                                                      _bind_partition(stream_key, args), concurrency=50):
         if success:
             result.extend(list(rows))
     return result
 
 
+@log_timing(log)
+def query_bin_first(stream_key, bins, cols=None):
+    # attempt to find one data point beyond the requested start/stop times
+    return _query_partitions(stream_key, BIN_FIRST_QUERY, [(x,) for x in bins], cols)
+
+
 @log_timing(log)
 def query_first_after(stream_key, times_and_bins, cols):
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' and time >= ? ORDER BY method ASC, time ASC LIMIT 1" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node, stream_key.sensor,
-             stream_key.method)
-    query = SessionManager.prepare(query)
-    result = []
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, times_and_bins, concurrency=50):
-        if success:
-            result.extend(list(rows))
-    return result
+    return _query_partitions(stream_key, FIRST_AFTER_QUERY, times_and_bins, cols)
 
 
 @log_timing(log)
 def query_n_before(stream_key, query_arguments, cols):
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' and time <= ? ORDER BY method DESC, time DESC LIMIT ?" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node,
-             stream_key.sensor, stream_key.method)
-    query = SessionManager.prepare(query)
-    result = []
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, query_arguments, concurrency=50):
-        if success:
-            result.extend(list(rows))
-    return result
+    return _query_partitions(stream_key, N_BEFORE_QUERY, query_arguments, cols)
 
 
 @log_timing(log)
 def query_full_bin(stream_key, bins_and_limit, cols):
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' and time >= ? and time <= ?" % \
-            (', '.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node,
-             stream_key.sensor, stream_key.method)
-    query = SessionManager.prepare(query)
-    result = []
-    for success, rows in execute_concurrent_with_args(SessionManager.session(), query, bins_and_limit, concurrency=50):
-        if success:
-            result.extend(list(rows))
-    return result
+    return _query_partitions(stream_key, UNLIMITED_QUERY, bins_and_limit, cols)
 
 
 @log_timing(log)
 def fetch_concurrent(stream_key, cols, times, concurrency=50):  # TODO: remove - unused
-    query = "select %s from %s where subsite='%s' and node='%s' and sensor='%s' and bin=? and method='%s' and time>=? and time<=?" % \
-            (','.join(cols), stream_key.stream.name, stream_key.subsite, stream_key.node, stream_key.sensor,
-             stream_key.method)
-    query = SessionManager.prepare(query)
-    results = execute_concurrent_with_args(SessionManager.session(), query, times, concurrency=concurrency)
+    query = SessionManager.prepare(UNLIMITED_QUERY % (','.join(cols), stream_key.stream.name))
+    results = execute_concurrent_with_args(SessionManager.session(), query, _bind_partition(stream_key, times),
+                                           concurrency=concurrency)
     results = [list(r[1]) if type(r[1]) == PagedResult else r[1] for r in results if r[0]]
     return results
 
 
+def warm_up(stream_names):
+    """
+    Prepare the standard query and insert statements for each stream, typically at service start
+    """
+    def statements(stream_name):
+        cols = ','.join(SessionManager.get_query_columns(stream_name))
+        queries = [template % (cols, stream_name)
+                   for template in (BIN_FIRST_QUERY, FIRST_AFTER_QUERY, N_BEFORE_QUERY, UNLIMITED_QUERY)]
+        return queries + [_insert_statement(stream_name), CREATE_ROWS_QUERY % stream_name]
+
+    SessionManager.warm_up(stream_statements(stream_names, statements))
+
+
 @log_timing(log)
 def fetch_l0_provenance(stream_key, provenance_values, deployment):
     """
@@ -213,19 +257,16 @@ def fetch_l0_provenance(stream_key, provenance_values, deployment):
         except ValueError:
             pass
 
-    provenance_arguments = [
-        (stream_key.subsite, stream_key.node, stream_key.sensor,
-         stream_key.method, deployment, prov_id) for prov_id in prov_ids]
-
-    query = SessionManager.prepare(L0_DATASET)
-    results = execute_concurrent_with_args(SessionManager.session(), query, provenance_arguments)
-    records = [ProvTuple(*rows[0]) for success, rows in results if success and len(rows) > 0]
+    # shares the process wide provenance cache with cassandra_provenance
+    rows = lookup_l0_provenance(SessionManager, stream_key.subsite, stream_key.node, stream_key.sensor,
+                                stream_key.method, deployment, prov_ids)
+    records = [ProvTuple(*row) for row in rows.itervalues()]
 
-    if len(provenance_arguments) != len(records):
-        log.warn("Could not find %d provenance entries", len(provenance_arguments) - len(records))
+    if len(prov_ids) != len(records):
+        log.warn("Could not find %d provenance entries", len(prov_ids) - len(records))
 
     prov_dict = {
-        str(row.id): {'file_name': row.file_name,
+        str(row.id): {'file_name': decode_provenance_filename(row.file_name),
                       'parser_name': row.parser_name,
                       'parser_version': row.parser_version}
         for row in records}
@@ -233,16 +274,39 @@ def fetch_l0_provenance(stream_key, provenance_values, deployment):
 
 
 @log_timing(log)
-def fetch_nth_data(stream_key, time_range, num_points=1000, location_metadata=None, request_id=None):
+def fetch_streaming_provenance(stream_key, times):
+    """
+    Fetch the streaming_l0_provenance records in effect for each particle time.
+    Returns a dictionary of provenance id to record and the provenance id of each particle
+    (None where no record precedes the particle).
+    """
+    intervals, index = resolve_streaming_provenance(SessionManager, stream_key.as_refdes(), stream_key.method, times)
+    prov_ids = [str(r.id) for r in intervals.records]
+    prov_dict = {str(r.id): r._asdict() for r in intervals.records}
+    for record in prov_dict.itervalues():
+        del record['id']
+    particle_ids = [prov_ids[i] if i >= 0 else None for i in index.tolist()]
+    return prov_dict, particle_ids
+
+
+@log_timing(log)
+def fetch_nth_data(stream_key, time_range, num_points=1000, location_metadata=None, request_id=None,
+                   decimation=None, parameter=None):
     """
     Given a time range, generate evenly spaced times over the specified interval. Fetch a single
     result from either side of each point in time.
+    If decimation ('minmax' or 'lttb') is specified every bin is read and reduced to num_points
+    using the values of parameter so spikes and events are preserved.
     :param stream_key:
     :param time_range:
     :param num_points:
+    :param decimation: optional decimation method
+    :param parameter: numeric parameter to decimate on, required with decimation
     :return:
     """
     cols = SessionManager.get_query_columns(stream_key.stream.name)
+    if decimation is not None and parameter not in cols:
+        raise ValueError('Decimation requires a stored parameter, got %r' % parameter)
 
     if location_metadata is None:
         location_metadata, _, _ = get_location_metadata(stream_key, time_range)
@@ -258,6 +322,11 @@ def fetch_nth_data(stream_key, time_range, num_points=1000, location_metadata=No
                 "CASS: Estimated points (%d) / the requested  number (%d) is less than ratio %f.  Returning all points.",
                 estimated_particles, num_points, engine.app.config['UI_FULL_RETURN_RATIO'])
         _, results = fetch_all_data(stream_key, time_range, location_metadata)
+    elif decimation is not None:
+        log.info("CASS: Decimating (%s) %d bins to %d points on %s.", decimation, len(location_metadata.bin_list),
+                 num_points, parameter)
+        _, results = sample_decimated(stream_key, time_range, num_points, location_metadata.bin_list,
+                                      parameter, decimation, cols)
     # We have a small amount of bins with data so we can read them all
     elif estimated_particles < engine.app.config['UI_FULL_SAMPLE_LIMIT'] \
             and data_ratio < engine.app.config['UI_FULL_SAMPLE_RATIO']:
@@ -275,18 +344,10 @@ def fetch_nth_data(stream_key, time_range, num_points=1000, location_metadata=No
 
     # dedup data before return values
     size = len(results)
-    to_return = []
-    uuids = set()
-    uuid_index = cols.index('id')
-    for row in results:
-        my_uuid = row[uuid_index]
-        if my_uuid in uuids:
-            continue
-        uuids.add(my_uuid)
-        to_return.append(row)
+    to_return = dedup_rows(results, cols.index('id'))
     log.info("Removed %d duplicates from data", size - len(to_return))
     log.info("Returning %s rows from %s fetch", len(to_return), stream_key.as_refdes())
-    return to_xray_dataset(cols, to_return, stream_key, request_id)
+    return _to_xray_dataset(stream_key, cols, to_return, request_id)
 
 
 @log_timing(log)
@@ -299,8 +360,7 @@ def sample_full_bins(stream_key, time_range, num_points, metadata_bins, cols=Non
         results = all_data
     else:
         indexes = numpy.linspace(0, len(all_data) - 1, num_points).astype(int)
-        selected_data = numpy.array(all_data)[indexes].tolist()
-        results = selected_data
+        results = [all_data[i] for i in indexes]
     return cols, results
 
 
@@ -312,7 +372,7 @@ def sample_n_bins(stream_key, time_range, num_points, metadata_bins, cols=None):
     # Get the first data point for all of the bins in the middle
     metadata_bins = metadata_bins[1:-1]
     indexes = numpy.linspace(0, len(metadata_bins) - 1, num_points - 2).astype(int)
-    bins_to_use = numpy.array(metadata_bins)[indexes].tolist()
+    bins_to_use = [metadata_bins[i] for i in indexes]
     cols, rows = fetch_with_func(query_first_after, stream_key, [(sb, time_range.start)], cols=cols)
     results.extend(rows)
 
@@ -323,9 +383,7 @@ def sample_n_bins(stream_key, time_range, num_points, metadata_bins, cols=None):
     # Get the last data point
     _, rows = fetch_with_func(query_n_before, stream_key, [(lb, time_range.stop, 1)], cols=cols)
     results.extend(rows)
-    tindex = cols.index('time')
-    results = sorted(results, key=lambda dat: dat[tindex])
-    return cols, results
+    return cols, sort_rows(results, cols.index('time'))
 
 
 @log_timing(log)
@@ -335,36 +393,45 @@ def sample_n_points(stream_key, time_range, num_points, metadata_bins, bin_infor
     cols, rows = fetch_with_func(query_first_after, stream_key, [(metadata_bins[0], time_range.start)], cols=cols)
     results.extend(rows)
 
-    # create a set to keep track of queries and avoid duplicates
-    queries = set()
-    # We want to know start and stop time of each bin that has data
-    metadata_bins = [(x, bin_information[x][1], bin_information[x][2]) for x in metadata_bins]
-    metadata_bins.sort()
-    bin_queue = deque(metadata_bins)
-    # Create our time array of sampling times
+    # map the sampling times onto the bins holding data
+    bins, counts, firsts, lasts = bin_bounds(bin_information, metadata_bins)
     times = numpy.linspace(time_range.start, time_range.stop, num_points)
-    # Get the first bin that has data within the range
-    current = bin_queue.popleft()
-    for t in times:
-        # Are we currently within the range of data in the bin if so add a sampling point
-        if current[1] <= t < current[2]:
-            queries.add((current[0], t, 1))
-        else:
-            # can we roll over to the next one?
-            if len(bin_queue) > 0 and bin_queue[0][1] <= t:
-                current = bin_queue.popleft()
-                queries.add((current[0], t, 1))
-            # otherwise get the last sample from the last bin we had
-            else:
-                queries.add((current[0], current[2], 1))
-    times = list(queries)
-    times.append((metadata_bins[-1][0], time_range.stop, 1))
+    plan = plan_sample_points(times, bins, counts, firsts, lasts)
+    log.info("CASS: Planned %d queries over %d bins for %d points (%d merged, %d in gaps)",
+             len(plan.queries), len(plan.bins), num_points, plan.merged, plan.gaps)
+    log.debug("CASS: Sample plan\n%s", format_plan(plan))
+    times = [(b, t, 1) for b, t in plan.queries]
+    times.append((int(bins[-1]), time_range.stop, 1))
     _, lin_sampled = fetch_with_func(query_n_before, stream_key, times, cols)
     results.extend(lin_sampled)
     # Sort the data
+    return cols, sort_rows(results, cols.index('time'))
+
+
+@log_timing(log)
+def sample_decimated(stream_key, time_range, num_points, metadata_bins, parameter, method, cols=None):
+    # Read each bin in the time range and fold it into the decimator, bins are fetched concurrently
+    # but consumed in order so only a bounded number of bins is held in memory at once
+    if cols is None:
+        cols = SessionManager.get_query_columns(stream_key.stream.name)
     tindex = cols.index('time')
-    results = sorted(results, key=lambda dat: dat[tindex])
-    return cols, results
+    vindex = cols.index(parameter)
+    decimator = StreamingDecimator(time_range.start, time_range.stop, num_points, method)
+
+    query = SessionManager.prepare(UNLIMITED_QUERY % (','.join(cols), stream_key.stream.name))
+    args = _bind_partition(stream_key, [(bin_num, time_range.start, time_range.stop) for bin_num in metadata_bins])
+    concurrency = engine.app.config.get('CASSANDRA_BIN_CONCURRENCY', 8)
+    for success, result in execute_concurrent_with_args(SessionManager.session(), query, args,
+                                                        concurrency=concurrency, results_generator=True):
+        rows = list(result)
+        if not rows:
+            continue
+        times = column(rows, tindex)
+        values = numpy.fromiter((numpy.nan if row[vindex] is None else row[vindex] for row in rows),
+                                numpy.float64, len(rows))
+        decimator.add(times, values, rows)
+
+    return cols, decimator.rows()
 
 
 def fetch_with_func(f, stream_key, args, cols=None):
@@ -383,11 +450,12 @@ def fetch_bin(stream_key, time_bin):
     base = "select %s from %s where subsite=? and node=? and sensor=? and bin=? and method=?" \
            % (','.join(cols), stream_key.stream.name)
     query = SessionManager.prepare(base)
-    return cols, list(SessionManager.execute(query, (stream_key.subsite,
-                                                     stream_key.node,
-                                                     stream_key.sensor,
-                                                     time_bin,
-                                                     stream_key.method)))
+    rows = list(SessionManager.execute(query, (stream_key.subsite,
+                                               stream_key.node,
+                                               stream_key.sensor,
+                                               time_bin,
+                                               stream_key.method)))
+    return cols, _decode_arrays(stream_key, cols, rows)
 
 
 # Fetch all records in the time_range by querying for every time bin in the time_range
@@ -403,24 +471,33 @@ def fetch_all_data(stream_key, time_range, location_metadata=None):
         location_metadata = get_location_metadata_by_store(stream_key, time_range, CASS_LOCATION_NAME)
     cols = SessionManager.get_query_columns(stream_key.stream.name)
 
+    # query all bins concurrently, results are returned in bin order
+    query = SessionManager.prepare(UNLIMITED_QUERY % (','.join(cols), stream_key.stream.name))
+    args = _bind_partition(stream_key, [(bin_num, time_range.start, time_range.stop)
+                                        for bin_num in location_metadata.bin_list])
+    concurrency = engine.app.config.get('CASSANDRA_BIN_CONCURRENCY', 8)
     rows = []
-    for bin_num in location_metadata.bin_list:
-        rows.extend(execute_unlimited_query(stream_key, cols, bin_num, time_range))
+    results = execute_concurrent_with_args(SessionManager.session(), query, args, concurrency=concurrency,
+                                           raise_on_first_error=False)
+    for bin_num, (success, result) in izip(location_metadata.bin_list, results):
+        # a missing bin would silently truncate the dataset, fail the request as fetch_range does
+        if not success:
+            log.error('Unable to fetch bin %d of %s: %r', bin_num, stream_key.as_refdes(), result)
+            raise result
+        rows.extend(result)
 
-    return cols, rows
+    return cols, _decode_arrays(stream_key, cols, rows)
 
 
 @log_timing(log)
 def get_full_cass_dataset(stream_key, time_range, location_metadata=None, request_id=None):
     cols, rows = fetch_all_data(stream_key, time_range, location_metadata)
-    return to_xray_dataset(cols, rows, stream_key, request_id)
+    return _to_xray_dataset(stream_key, cols, rows, request_id)
 
 
 @log_timing(log)
 def execute_unlimited_query(stream_key, cols, time_bin, time_range):
-    base = ("select %s from %s where subsite=? and node=? and sensor=? and bin=? " +
-            "and method=? and time>=? and time<=?") % (','.join(cols), stream_key.stream.name)
-    query = SessionManager.prepare(base)
+    query = SessionManager.prepare(UNLIMITED_QUERY % (','.join(cols), stream_key.stream.name))
     return list(SessionManager.execute(query, (stream_key.subsite,
                                                stream_key.node,
                                                stream_key.sensor,
@@ -431,21 +508,68 @@ def execute_unlimited_query(stream_key, cols, time_bin, time_range):
 
 
 def _get_stream_row_count(stream_key, data_bin):
-    COUNT_QUERY = "SELECT COUNT(*) FROM {:s} WHERE subsite = ? and node = ? and sensor = ? and bin = ? and method = ?"
-    count_query = SessionManager.prepare(COUNT_QUERY.format(stream_key.stream.name))
-    return SessionManager.execute(
-        count_query, (stream_key.subsite, stream_key.node, stream_key.sensor, data_bin, stream_key.method)
-    )[0][0]
+    # use the maintained bin count, only scan the partition for bins without a count
+    counts = fetch_bin_counts(SessionManager, stream_key.subsite, stream_key.node, stream_key.sensor,
+                              stream_key.method, stream_key.stream.name, [data_bin])
+    if data_bin in counts:
+        return counts[data_bin]
+    return count_rows(SessionManager, stream_key.subsite, stream_key.node, stream_key.sensor, stream_key.method,
+                      stream_key.stream.name, data_bin)
+
+
+def _insert_statement(stream_name):
+    # the first query column is bin which is part of the partition key
+    dynamic_cols = SessionManager.get_query_columns(stream_name)[1:]
+    cols = ['subsite', 'node', 'sensor', 'bin', 'method'] + dynamic_cols
+    return 'INSERT INTO {:s} ({:s}) VALUES ({:s})'.format(stream_name, ', '.join(cols), ', '.join('?' for _ in cols))
+
+
+def _row_keys(times, deployments, ids):
+    """
+    Pack the (time, deployment, id) clustering keys of each row into fixed width byte strings
+    """
+    keys = numpy.empty(len(ids), dtype=[('time', '<f8'), ('deployment', '<i4'), ('id', 'S16')])
+    keys['time'] = times
+    keys['deployment'] = deployments
+    keys['id'] = [i.bytes for i in ids]
+    return keys.view('S28')
+
+
+def _existing_rows(stream_key, data_bin, times, deployments, ids):
+    """
+    Read the clustering keys present in the partition once and return a mask of the rows which already exist
+    """
+    cols = ['time', 'deployment', 'id']
+    rows = _query_partitions(stream_key, PARTITION_KEYS_QUERY, [(data_bin,)], cols)
+    if not rows:
+        return numpy.zeros(len(ids), dtype=bool)
+    existing_times, existing_deployments, existing_ids = izip(*rows)
+    existing = _row_keys(existing_times, existing_deployments, existing_ids)
+    return numpy.in1d(_row_keys(times, deployments, ids), existing)
+
+
+def _write_rows(query, rows, batch_size=None):
+    """
+    Write rows with query, returning a mask of the rows written successfully
+    """
+    if batch_size:
+        return execute_batched(SessionManager.session(), query, rows, batch_size)
+    results = execute_concurrent_with_args(SessionManager.session(), query, rows, concurrency=50,
+                                           raise_on_first_error=False)
+    return numpy.array([success for success, _ in results], dtype=bool)
 
 
 @log_timing(log)
-def insert_dataset(stream_key, dataset):
+def insert_dataset(stream_key, dataset, batch_size=None, bulk_upsert=False):
     """
     Insert an xray dataset back into CASSANDRA.
     First we check to see if there is data in the bin, if there is we either overwrite and update
     the values or fail and let the user known why
     :param stream_key: Stream that we are updating
     :param dataset: xray dataset we are updating
+    :param batch_size: if specified, write the (single partition) rows in UNLOGGED batches of this size
+    :param bulk_upsert: if True read the existing row keys of the bin once and write each row a single time
+                        instead of creating rows with lightweight transactions before updating them
     :return:
     """
     # All of the bins on SAN data will be the same in the netcdf file take the first
@@ -463,18 +587,21 @@ def insert_dataset(stream_key, dataset):
         log.error(error_message)
         return error_message
     # get the data in the correct format
-    cols = SessionManager.get_query_columns(stream_key.stream.name)
-    dynamic_cols = cols[1:]
-    key_cols = ['subsite', 'node', 'sensor', 'bin', 'method']
-    cols = key_cols + dynamic_cols
+    dynamic_cols = SessionManager.get_query_columns(stream_key.stream.name)[1:]
+    schema = SessionManager.get_schema(stream_key.stream.name)
+    dtypes = dict(izip(schema.columns, schema.dtypes))
     arrays = {p.name for p in stream_key.stream.parameters
               if not p.is_function and p.parameter_type == 'array<quantity>'}
     data_lists['bin'] = [data_bin] * size
     # id and provenance are expected to be UUIDs so convert them to uuids
     data_lists['id'] = [uuid.UUID(x) for x in dataset['id'].values]
     data_lists['provenance'] = [uuid.UUID(x) for x in dataset['provenance'].values]
+    binary_arrays = engine.app.config.get('CASSANDRA_BINARY_ARRAYS', False)
     for i in arrays:
-        data_lists[i] = [msgpack.packb(x) for x in dataset[i].values.tolist()]
+        if binary_arrays:
+            data_lists[i] = encode_cells(dataset[i].values)
+        else:
+            data_lists[i] = [msgpack.packb(x) for x in dataset[i].values.tolist()]
     for dc in dynamic_cols:
         # if it is in the dataset and not already in the datalist we need to put it in the list
         if dc in dataset and dc not in data_lists:
@@ -483,65 +610,66 @@ def insert_dataset(stream_key, dataset):
                 temp_val[temp_val == dataset[dc].attrs['_FillValue']] = None
                 data_lists[dc] = temp_val
             else:
-                data_lists[dc] = dataset[dc].values
+                values = dataset[dc].values
+                # convert to the column's CQL type in one pass when no values can be truncated or wrapped
+                if dtypes[dc] != object and numpy.can_cast(values.dtype, dtypes[dc], casting='safe'):
+                    values = values.astype(dtypes[dc])
+                data_lists[dc] = values.tolist()
 
     # if we don't have metadata for the bin or we want to overwrite the values from cassandra continue
     if bin_meta is not None:
         log.warn("Data present in Cassandra bin %s for %s.  Overwriting old and adding new data.", data_bin,
                  stream_key.as_refdes())
 
-    # get the query to insert information
-    col_names = ', '.join(cols)
-    # Take subsite, node, sensor, ?, and method
-    key_str = "'{:s}', '{:s}', '{:s}', ?, '{:s}'".format(stream_key.subsite, stream_key.node, stream_key.sensor,
-                                                         stream_key.method)
-    # and the rest as ? for thingskey_cols[:3] +['?'] + key_cols[4:] + ['?' for _ in cols]
-    data_str = ', '.join(['?' for _ in dynamic_cols])
-    full_str = '{:s}, {:s}'.format(key_str, data_str)
-    query = 'INSERT INTO {:s} ({:s}) VALUES ({:s})'.format(stream_key.stream.name, col_names, full_str)
-    query = SessionManager.prepare(query)
+    # get the query to insert information, every column including the partition key is bound
+    query = SessionManager.prepare(_insert_statement(stream_key.stream.name))
 
     # make the data list
-    to_insert = []
-    data_names = ['bin'] + dynamic_cols
-    for i in range(size):
-        row = [data_lists[col][i] for col in data_names]
-        to_insert.append(row)
-
-    ###############################################################
-    # Build & execute query to create rows and count the new rows #
-    ###############################################################
-    primary_key_columns = ['subsite', 'node', 'sensor', 'bin', 'method', 'time', 'deployment', 'id']
-    create_rows_columns = ', '.join(primary_key_columns)
-    # Fill in (subsite, node, sensor, method) leaving (bin, time, deployment, id) to be bound
-    create_rows_values = "'{:s}', '{:s}', '{:s}', ?, '{:s}', ?, ?, ?".format(
-        stream_key.subsite, stream_key.node, stream_key.sensor, stream_key.method
-    )
-    create_rows_query = 'INSERT INTO {:s} ({:s}) VALUES ({:s}) IF NOT EXISTS'.format(
-        stream_key.stream.name, create_rows_columns, create_rows_values
-    )
-    create_rows_query = SessionManager.prepare(create_rows_query)
-    # We only want (bin, time, deployment, id)
-    create_rows_data = numpy.array(to_insert)[:, :4]
-    # Execute query
-    insert_count = 0
-    fails = 0
-    for success, result in execute_concurrent_with_args(SessionManager.session(), create_rows_query, create_rows_data, concurrency=50, raise_on_first_error=False):
-        if not success:
-            fails += 1
-        elif result[0][0]:
-            insert_count += 1
-    if fails > 0:
-        log.warn("Failed to create %d rows within Cassandra bin %d for %s!", fails, data_bin, stream_key.as_refdes())
-
-    # Update previously existing rows and new mostly empty rows
-    fails = 0
-    for success, _ in execute_concurrent_with_args(SessionManager.session(), query, to_insert, concurrency=50, raise_on_first_error=False):
-        if not success:
-            fails += 1
-    if fails > 0:
-        log.warn("Failed to update %d rows within Cassandra bin %d for %s!", fails, data_bin, stream_key.as_refdes())
-    update_count = len(to_insert) - fails - insert_count
+    to_insert = _bind_partition(stream_key, izip(data_lists['bin'], *[data_lists[col] for col in dynamic_cols]))
+
+    if bulk_upsert:
+        # new rows are those whose keys are not already in the partition, every row is written once
+        is_new = ~_existing_rows(stream_key, data_bin, dataset['time'].values, dataset['deployment'].values,
+                                 data_lists['id'])
+        written = _write_rows(query, to_insert, batch_size)
+        fails = len(to_insert) - written.sum()
+        if fails > 0:
+            log.warn("Failed to write %d rows within Cassandra bin %d for %s!", fails, data_bin,
+                     stream_key.as_refdes())
+        insert_count = int((written & is_new).sum())
+        update_count = int((written & ~is_new).sum())
+    else:
+        ###############################################################
+        # Build & execute query to create rows and count the new rows #
+        ###############################################################
+        create_rows_query = SessionManager.prepare(CREATE_ROWS_QUERY % stream_key.stream.name)
+        # We only want (subsite, node, sensor, bin, method, time, deployment, id)
+        create_rows_data = [row[:8] for row in to_insert]
+        # Execute query
+        insert_count = 0
+        fails = 0
+        for success, result in execute_concurrent_with_args(SessionManager.session(), create_rows_query, create_rows_data, concurrency=50, raise_on_first_error=False):
+            if not success:
+                fails += 1
+            elif result[0][0]:
+                insert_count += 1
+        if fails > 0:
+            log.warn("Failed to create %d rows within Cassandra bin %d for %s!", fails, data_bin, stream_key.as_refdes())
+
+        # Update previously existing rows and new mostly empty rows
+        written = _write_rows(query, to_insert, batch_size)
+        fails = len(to_insert) - written.sum()
+        if fails > 0:
+            log.warn("Failed to update %d rows within Cassandra bin %d for %s!", fails, data_bin, stream_key.as_refdes())
+        update_count = len(to_insert) - fails - insert_count
+
+    # record the latest row written for each deployment
+    written = numpy.flatnonzero(written)
+    records = last_records(dataset['deployment'].values[written], dataset['time'].values[written],
+                           numpy.full(written.size, data_bin), [data_lists['id'][i] for i in written])
+    update_last_records(SessionManager, stream_key.as_refdes(), stream_key.method, stream_key.stream.name, records)
+    update_bin_counts(SessionManager, stream_key.subsite, stream_key.node, stream_key.sensor, stream_key.method,
+                      stream_key.stream.name, {data_bin: insert_count})
 
     # Index the new data into the metadata record
     first = dataset['time'].min()
@@ -562,19 +690,10 @@ def store_qc_results(qc_results_values, pk, particle_ids, particle_bins, particl
     start_time = time.clock()
     if engine.app.config['QC_RESULTS_STORAGE_SYSTEM'] == CASS_LOCATION_NAME:
         log.info('Storing QC results in Cassandra.')
-        insert_results = SessionManager.prepare(
-                "insert into ooi.qc_results "
-                "(subsite, node, sensor, bin, deployment, stream, id, parameter, results) "
-                "values (?, ?, ?, ?, ?, ?, ?, ?, ?)")
-
-        batch = BatchStatement()
-        for (qc_results, particle_id, particle_bin, particle_deploy) in izip(qc_results_values, particle_ids,
-                                                                             particle_bins, particle_deploys):
-            batch.add(insert_results, (pk.get('subsite'), pk.get('node'), pk.get('sensor'),
-                                       particle_bin, particle_deploy, pk.get('stream'),
-                                       uuid.UUID(particle_id), param_name, str(qc_results)))
-        SessionManager.session().execute_async(batch)
-        log.info("QC results stored in {} seconds.".format(time.clock() - start_time))
+        writer = QcResultsWriter(SessionManager, pk,
+                                 max_in_flight=engine.app.config.get('QC_RESULTS_MAX_IN_FLIGHT', 16))
+        writer.write(param_name, qc_results_values, particle_ids, particle_bins, particle_deploys)
+        log.info("QC results stored in {} seconds: {}".format(time.clock() - start_time, writer.counts))
     elif engine.app.config['QC_RESULTS_STORAGE_SYSTEM'] == 'log':
         log.info('Writing QC results to log file.')
         qc_log = logging.getLogger('qc.results')
@@ -0,0 +1,248 @@
+import logging
+from collections import namedtuple
+from operator import itemgetter
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MINMAX = 'minmax'
+LTTB = 'lttb'
+DECIMATION_METHODS = (MINMAX, LTTB)
+
+# queries are (bin, time) pairs, the remaining fields are per planned bin
+SamplePlan = namedtuple('SamplePlan', ['queries', 'bins', 'points', 'query_counts', 'estimated_rows',
+                                       'merged', 'gaps'])
+
+
+def column(rows, index, dtype=np.float64):
+    """
+    Extract one fixed width column from a list of row tuples
+    """
+    return np.fromiter(map(itemgetter(index), rows), dtype, len(rows))
+
+
+def sort_rows(rows, time_index):
+    """
+    Return rows sorted (stably) on the time column
+    """
+    order = np.argsort(column(rows, time_index), kind='mergesort')
+    return [rows[i] for i in order.tolist()]
+
+
+def dedup_rows(rows, id_index):
+    """
+    Return rows with duplicate UUIDs removed, keeping the first occurrence and the original order
+    """
+    # compare the UUIDs as fixed width 16 byte strings rather than hashing UUID objects
+    ids = np.fromiter((row[id_index].bytes for row in rows), 'S16', len(rows))
+    _, first = np.unique(ids, return_index=True)
+    first.sort()
+    return [rows[i] for i in first.tolist()]
+
+
+def bin_bounds(bin_information, bins):
+    """
+    Return sorted arrays of bin numbers, row counts, first and last times for the given bins.
+    bin_information maps each bin to its (count, first, last) partition metadata.
+    """
+    bins = sorted(bins)
+    info = [bin_information[b] for b in bins]
+    counts = np.array([i[0] for i in info], dtype=np.int64)
+    firsts = np.array([i[1] for i in info], dtype=np.float64)
+    lasts = np.array([i[2] for i in info], dtype=np.float64)
+    return np.array(bins, dtype=np.int64), counts, firsts, lasts
+
+
+def plan_sample_points(times, bins, counts, firsts, lasts):
+    """
+    Map sorted sample times onto the bins holding data. Each sample becomes a query for the last
+    row at or before the sample time in the bin with the latest first time not after the sample.
+    Samples falling in a gap after a bin query the last row of that bin, samples before the first
+    bin are dropped. Rows are assumed evenly spaced within a bin, consecutive samples which would
+    return the same row are merged into a single query.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    index = np.searchsorted(firsts, times, side='right') - 1
+    valid = index >= 0
+    times = times[valid]
+    index = index[valid]
+
+    in_gap = times > lasts[index]
+    query_times = np.where(in_gap, lasts[index], times)
+
+    # estimated row within the bin returned for each query
+    spacing = (lasts - firsts) / np.maximum(counts - 1, 1)
+    spacing[spacing <= 0] = np.inf
+    slots = np.floor((query_times - firsts[index]) / spacing[index])
+    keep = np.ones(times.size, dtype=bool)
+    keep[:-1] = (index[1:] != index[:-1]) | (slots[1:] != slots[:-1])
+
+    queries = zip(bins[index[keep]].tolist(), query_times[keep].tolist())
+    used = np.unique(index)
+    points = np.bincount(index, minlength=bins.size)[used]
+    query_counts = np.bincount(index[keep], minlength=bins.size)[used]
+    return SamplePlan(queries, bins[used], points, query_counts, counts[used],
+                      int(times.size - keep.sum()), int(in_gap.sum()))
+
+
+def format_plan(plan):
+    """
+    Compact, one line per bin description of a sample plan
+    """
+    lines = ['bin points queries est_rows']
+    for row in zip(plan.bins, plan.points, plan.query_counts, plan.estimated_rows):
+        lines.append('%d %d %d %d' % row)
+    return '\n'.join(lines)
+
+
+def lttb_indices(times, values, num_points):
+    """
+    Largest-triangle-three-buckets downsampling of time ordered points.
+    Returns the (sorted) indices of the num_points points selected.
+    """
+    size = times.size
+    if num_points >= size:
+        return np.arange(size)
+    if num_points < 3:
+        return np.array([0, size - 1][:max(num_points, 0)], dtype=np.int64)
+
+    # first and last points are always kept, the rest are split into num_points - 2 buckets
+    edges = np.linspace(1, size - 1, num_points - 1).astype(int)
+    selected = np.empty(num_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = size - 1
+    a = 0
+    for i in xrange(num_points - 2):
+        start, stop = edges[i], edges[i + 1]
+        # average of the next bucket (or the last point) is the third vertex of the triangle
+        if i < num_points - 3:
+            next_start, next_stop = edges[i + 1], edges[i + 2]
+            avg_time = times[next_start:next_stop].mean()
+            avg_value = values[next_start:next_stop].mean()
+        else:
+            avg_time = times[-1]
+            avg_value = values[-1]
+
+        bucket_times = times[start:stop]
+        bucket_values = values[start:stop]
+        areas = np.abs((times[a] - avg_time) * (bucket_values - values[a]) -
+                       (times[a] - bucket_times) * (avg_value - values[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+class StreamingDecimator(object):
+    """
+    Reduce time ordered chunks of rows to about num_points rows for plotting while preserving
+    spikes and events in the value parameter.
+
+    The requested time range is split into equal width buckets. For each bucket the rows holding
+    the minimum and maximum value are kept (minmax) or, for largest-triangle-three-buckets (lttb),
+    the first, last, minimum and maximum rows are kept as candidates and LTTB is run over the
+    candidates when the result is requested. Memory is bounded by the number of buckets rather
+    than by the amount of data added.
+    """
+    def __init__(self, start, stop, num_points, method=MINMAX):
+        if method not in DECIMATION_METHODS:
+            raise ValueError('Unknown decimation method: %r' % method)
+        self.method = method
+        self.num_points = num_points
+        self.start = start
+        self.buckets = max(num_points // 2, 1) if method == MINMAX else max(num_points, 1)
+        self.width = float(stop - start) / self.buckets or 1.0
+        self.rows_added = 0
+
+        size = self.buckets
+        self.min_values = np.full(size, np.inf)
+        self.max_values = np.full(size, -np.inf)
+        self.first_times = np.full(size, np.inf)
+        self.last_times = np.full(size, -np.inf)
+        # (time, value, row) of each candidate
+        self.min_rows = np.empty(size, dtype=object)
+        self.max_rows = np.empty(size, dtype=object)
+        self.first_rows = np.empty(size, dtype=object)
+        self.last_rows = np.empty(size, dtype=object)
+
+    def add(self, times, values, rows):
+        """
+        Add a chunk of rows with their times and (numeric) values
+        """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        self.rows_added += times.size
+
+        keep = ~np.isnan(values)
+        buckets = np.floor((times - self.start) / self.width).astype(np.int64)
+        keep &= (buckets >= 0) & (buckets < self.buckets)
+        if not keep.any():
+            return
+        index = np.flatnonzero(keep)
+        buckets = buckets[index]
+
+        # per bucket minimum and maximum values within this chunk
+        self._update(buckets, index, values[index], times, values, rows, self.min_values, self.max_values,
+                     self.min_rows, self.max_rows)
+        if self.method == LTTB:
+            self._update(buckets, index, times[index], times, values, rows, self.first_times, self.last_times,
+                         self.first_rows, self.last_rows)
+
+    @staticmethod
+    def _update(buckets, index, keys, times, values, rows, lows, highs, low_rows, high_rows):
+        order = np.lexsort((keys, buckets))
+        sorted_buckets = buckets[order]
+        starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        stops = np.r_[starts[1:], sorted_buckets.size] - 1
+        touched = sorted_buckets[starts]
+
+        low_positions = order[starts]
+        high_positions = order[stops]
+        low_keys = keys[low_positions]
+        high_keys = keys[high_positions]
+
+        replace_low = low_keys < lows[touched]
+        replace_high = high_keys > highs[touched]
+        lows[touched[replace_low]] = low_keys[replace_low]
+        highs[touched[replace_high]] = high_keys[replace_high]
+
+        # only the replaced candidates need their rows copied out of this chunk
+        for bucket, position in zip(touched[replace_low], index[low_positions[replace_low]]):
+            low_rows[bucket] = (times[position], values[position], rows[position])
+        for bucket, position in zip(touched[replace_high], index[high_positions[replace_high]]):
+            high_rows[bucket] = (times[position], values[position], rows[position])
+
+    def _candidates(self):
+        candidates = {}
+        groups = [self.min_rows, self.max_rows]
+        if self.method == LTTB:
+            groups += [self.first_rows, self.last_rows]
+        for group in groups:
+            for candidate in group[np.not_equal(group, None)]:
+                # key on time and value, one row per distinct point
+                candidates[candidate[:2]] = candidate
+        return [candidates[key] for key in sorted(candidates)]
+
+    def rows(self):
+        """
+        Return the selected rows in time order
+        """
+        candidates = self._candidates()
+        if self.method == LTTB and len(candidates) > self.num_points:
+            times = np.array([c[0] for c in candidates])
+            values = np.array([c[1] for c in candidates])
+            candidates = [candidates[i] for i in lttb_indices(times, values, self.num_points)]
+        log.info('Decimated %d rows to %d using %s', self.rows_added, len(candidates), self.method)
+        return [c[2] for c in candidates]
+
+
+def decimate(times, values, num_points, method=MINMAX):
+    """
+    Decimate complete arrays of times and values, returning the sorted indices of the selected points
+    """
+    times = np.asarray(times, dtype=np.float64)
+    if not times.size:
+        return np.array([], dtype=np.int64)
+    decimator = StreamingDecimator(times.min(), np.nextafter(times.max(), np.inf), num_points, method)
+    decimator.add(times, values, np.arange(times.size))
+    return np.array(decimator.rows(), dtype=np.int64)
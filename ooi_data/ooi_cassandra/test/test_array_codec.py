@@ -0,0 +1,77 @@
+import unittest
+
+import msgpack
+import numpy as np
+
+from ..array_codec import (decode_cell, decode_cells, decode_columns, encode_cell, encode_cells, is_binary,
+                           pack_columns)
+
+
+class ArrayCodecUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.block = np.random.random((100, 256)).astype(np.float32)
+
+    def test_round_trip(self):
+        cells = encode_cells(self.block)
+        self.assertEqual(len(cells), 100)
+        self.assertTrue(all(is_binary(c) for c in cells))
+        np.testing.assert_array_equal(decode_cell(cells[5]), self.block[5])
+        decoded = decode_cells(cells)
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_array_equal(decoded, self.block)
+
+    def test_zero_copy(self):
+        cell = encode_cell(np.arange(12, dtype=np.int32).reshape(3, 4))
+        decoded = decode_cell(cell)
+        self.assertEqual(decoded.shape, (3, 4))
+        self.assertFalse(decoded.flags.owndata)
+        self.assertFalse(decoded.flags.writeable)
+
+    def test_big_endian(self):
+        array = np.arange(5, dtype='>i8')
+        cell = encode_cell(array)
+        self.assertEqual(cell[-8:], np.int64(4).astype('<i8').tobytes())
+        np.testing.assert_array_equal(decode_cell(cell), array)
+
+    def test_msgpack_cells(self):
+        # cells written before the binary format must stay readable
+        legacy = [msgpack.packb([1.5, 2.5]), msgpack.packb([3.5])]
+        np.testing.assert_array_equal(decode_cell(legacy[0]), [1.5, 2.5])
+        decoded = decode_cells(legacy + [encode_cell(np.array([4.5])), None])
+        self.assertEqual(decoded.dtype, object)
+        np.testing.assert_array_equal(decoded[1], [3.5])
+        np.testing.assert_array_equal(decoded[2], [4.5])
+        self.assertIsNone(decoded[3])
+
+    def test_ragged_falls_back_to_msgpack(self):
+        block = np.empty(2, dtype=object)
+        block[0] = [1, 2]
+        block[1] = [3]
+        cells = encode_cells(block)
+        self.assertFalse(any(is_binary(c) for c in cells))
+        self.assertEqual(msgpack.unpackb(cells[1]), [3])
+
+    def test_decode_columns(self):
+        ids = [0, 1, 2, 3]
+        legacy = [msgpack.packb([1.5, 2.5]) for _ in ids]
+        rows = zip(ids, encode_cells(self.block[:4]), legacy)
+        decoded = decode_columns(rows, [1, 2])
+        self.assertEqual([r[0] for r in decoded], ids)
+        np.testing.assert_array_equal([r[1] for r in decoded], self.block[:4])
+        # msgpack only columns are left as they are
+        self.assertEqual([r[2] for r in decoded], legacy)
+        # decoded columns are not decoded again
+        self.assertIs(decode_columns(decoded, [1, 2]), decoded)
+
+    def test_pack_columns(self):
+        ids = [0, 1, 2, 3]
+        legacy = [msgpack.packb([1.5, 2.5]) for _ in ids]
+        rows = zip(ids, encode_cells(self.block[:4]), legacy)
+        # binary and decoded cells are both packed, msgpack cells are passed through
+        for packed in (pack_columns(rows, [1, 2]), pack_columns(decode_columns(rows, [1, 2]), [1, 2])):
+            self.assertEqual([r[0] for r in packed], ids)
+            np.testing.assert_array_equal([msgpack.unpackb(r[1]) for r in packed], self.block[:4])
+            self.assertEqual([r[2] for r in packed], legacy)
+        # msgpack only rows are left as they are
+        legacy_rows = zip(ids, legacy)
+        self.assertIs(pack_columns(legacy_rows, [1]), legacy_rows)
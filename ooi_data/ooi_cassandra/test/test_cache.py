@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+from ..cache import LRUCache
+
+
+class LRUCacheUnitTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        # b was the least recently used
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_stats(self):
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.get_or_load('c', lambda key: key * 2)
+        cache.get_or_load('c', lambda key: key * 3)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertEqual(cache.get('c'), 'cc')
+
+    def test_single_flight(self):
+        cache = LRUCache(10)
+        calls = []
+
+        def loader(key):
+            calls.append(key)
+            time.sleep(0.1)
+            return key.upper()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('select', loader)))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, ['select'])
+        self.assertEqual(results, ['SELECT'] * 20)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 19)
+
+    def test_failed_load(self):
+        cache = LRUCache(10)
+
+        def loader(key):
+            raise ValueError(key)
+
+        self.assertRaises(ValueError, cache.get_or_load, 'a', loader)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.get_or_load('a', lambda key: 1), 1)
@@ -1,13 +1,20 @@
+import logging
 import os
+import time
 import unittest
 import uuid
+from multiprocessing.pool import ThreadPool
 
 import xarray as xr
 from cassandra.cluster import Cluster
 
+from ..cassandra_counts import CREATE_BIN_COUNT_TABLE
+from ..cassandra_index import CREATE_LAST_RECORD_TABLE
+from ..cassandra_qc import CREATE_QC_RESULTS_TABLE
 from ..cassandra_session import SessionManager
 from ..cassandra_data import insert_dataframe, fetch_bin
 
+log = logging.getLogger(__name__)
 
 DELETE_KEYSPACE = 'drop keyspace %s'
 CREATE_KEYSPACE = "create keyspace %s with replication = {'class': 'SimpleStrategy', 'replication_factor': 1}"
@@ -51,6 +58,9 @@ class CassandraDataUnitTest(unittest.TestCase):
         session.execute(CREATE_KEYSPACE % keyspace)
         session.execute(USE_KEYSPACE % keyspace)
         session.execute(CREATE_TABLE)
+        session.execute(CREATE_LAST_RECORD_TABLE)
+        session.execute(CREATE_BIN_COUNT_TABLE)
+        session.execute(CREATE_QC_RESULTS_TABLE)
         cluster.shutdown()
 
     @classmethod
@@ -89,3 +99,62 @@ class CassandraDataUnitTest(unittest.TestCase):
         df = fetch_bin('botpt_nano_sample', ['time', 'bottom_pressure'], 'test', 'test', 'test', 'test', 3682368000)
         print df
         assert False
+
+    def test_03_interleaved_numpy_and_lazy(self):
+        numpy_query = SessionManager.prepare('select time, bottom_pressure from botpt_nano_sample '
+                                             'where subsite=? and node=? and sensor=? and method=? and bin=?')
+        lazy_query = SessionManager.prepare('select time, deployment from botpt_nano_sample '
+                                            'where subsite=? and node=? and sensor=? and method=? and bin=? limit 10')
+        args = ('test', 'test', 'test', 'test', 3682368000)
+
+        def run(i):
+            if i % 2:
+                pages = list(SessionManager.execute_numpy(numpy_query, args))
+                return all(isinstance(page, dict) and hasattr(page['time'], 'dtype') for page in pages)
+            rows = list(SessionManager.execute_lazy(lazy_query, args))
+            return all(hasattr(row, 'deployment') for row in rows)
+
+        pool = ThreadPool(16)
+        try:
+            results = pool.map(run, range(400))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertTrue(all(results))
+
+    def test_04_token_aware_routing(self):
+        # Measure how often the coordinator is a replica of the queried partition when the partition key
+        # is formatted into the statement versus bound. Run against a multi-node (ccm) cluster, the literal
+        # statement has no routing key and is sent to an arbitrary node, costing an extra coordinator hop.
+        cluster = SessionManager.cluster
+        keyspace = SessionManager.session().keyspace
+        base = 'select time from botpt_nano_sample where %s limit 1'
+        bound = SessionManager.prepare(base % 'subsite=? and node=? and sensor=? and bin=? and method=?')
+        literal = SessionManager.prepare(base % "subsite='test' and node='test' and sensor='test' "
+                                                "and bin=? and method='test'")
+        bins = range(3682368000, 3682368000 + 10800 * 200, 10800)
+
+        def route(statement, make_args):
+            # returns the fraction of queries coordinated by a replica, the number of extra coordinator
+            # hops (queries coordinated by a non replica) and the mean query latency in milliseconds
+            replica_coordinated = 0
+            elapsed = 0.0
+            for bin_number in bins:
+                routing_key = bound.bind(('test', 'test', 'test', bin_number, 'test')).routing_key
+                replicas = cluster.metadata.get_replicas(keyspace, routing_key)
+                start = time.time()
+                result = SessionManager.execute_lazy(statement, make_args(bin_number))
+                elapsed += time.time() - start
+                replica_coordinated += result.response_future._current_host in replicas
+            return (float(replica_coordinated) / len(bins), len(bins) - replica_coordinated,
+                    elapsed * 1000 / len(bins))
+
+        self.assertIsNone(literal.bind((3682368000,)).routing_key)
+        literal_ratio, literal_hops, literal_latency = route(literal, lambda b: (b,))
+        bound_ratio, bound_hops, bound_latency = route(bound, lambda b: ('test', 'test', 'test', b, 'test'))
+        log.info('token aware routing over %d queries on %d hosts: literal key replica ratio %.2f, %d coordinator '
+                 'hops, %.3f ms/query; bound key replica ratio %.2f, %d coordinator hops, %.3f ms/query',
+                 len(bins), len(cluster.metadata.all_hosts()), literal_ratio, literal_hops, literal_latency,
+                 bound_ratio, bound_hops, bound_latency)
+        self.assertLessEqual(literal_ratio, bound_ratio)
+        self.assertEqual(bound_ratio, 1.0)
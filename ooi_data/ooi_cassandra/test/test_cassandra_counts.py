@@ -0,0 +1,65 @@
+import unittest
+
+from cassandra import InvalidRequest
+from mock import MagicMock, patch
+
+from ..cassandra_counts import (BinCountDrift, fetch_bin_counts, reconcile_bin_counts, update_bin_counts,
+                                verify_bin_counts)
+
+KEY = ('subsite', 'node', 'sensor', 'method', 'stream')
+
+
+def make_record(bin_number, count):
+    return MagicMock(subsite='subsite', node='node', sensor='sensor', method='method', stream='stream',
+                     bin=bin_number, count=count)
+
+
+class CassandraCountsUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.session_manager = MagicMock()
+        self.records = [make_record(0, 10), make_record(3600, 20), make_record(7200, 30)]
+
+    @patch('ooi_data.ooi_cassandra.cassandra_counts.execute_concurrent_with_args')
+    def test_update(self, execute):
+        execute.return_value = [(True, None)]
+        update_bin_counts(self.session_manager, *(KEY + ({0: 5, 3600: 0},)))
+        self.assertEqual(execute.call_args[0][2], [(5, 'subsite', 'node', 'sensor', 'method', 'stream', 0)])
+
+        # nothing to change
+        execute.reset_mock()
+        update_bin_counts(self.session_manager, *(KEY + ({0: 0},)))
+        self.assertFalse(execute.called)
+
+    def test_missing_table(self):
+        self.session_manager.prepare.side_effect = InvalidRequest('unconfigured table stream_bin_count')
+        self.assertEqual(fetch_bin_counts(self.session_manager, *(KEY + ([0],))), {})
+        update_bin_counts(self.session_manager, *(KEY + ({0: 1},)))
+        self.session_manager.session.assert_not_called()
+
+    def test_verify(self):
+        self.session_manager.execute.return_value = [(0, 10), (3600, 25)]
+        drift = verify_bin_counts(self.session_manager, self.records)
+        self.assertEqual(drift, [BinCountDrift(3600, 20, 25, None), BinCountDrift(7200, 30, 0, None)])
+
+        # a sample only checks sample_size bins
+        self.session_manager.execute.return_value = []
+        self.assertEqual(len(verify_bin_counts(self.session_manager, self.records, sample_size=2)), 2)
+
+    def test_verify_scan(self):
+        counts = [(0, 10), (3600, 20), (7200, 30)]
+        row_counts = {0: 10, 3600: 19, 7200: 30}
+
+        def execute(statement, args):
+            if len(args) == 6:
+                return counts
+            return [(row_counts[args[3]],)]
+
+        self.session_manager.execute.side_effect = execute
+        drift = verify_bin_counts(self.session_manager, self.records, scan=True)
+        self.assertEqual(drift, [BinCountDrift(3600, 20, 20, 19)])
+
+    @patch('ooi_data.ooi_cassandra.cassandra_counts.update_bin_counts')
+    def test_reconcile(self, update):
+        drift = [BinCountDrift(3600, 20, 25, None), BinCountDrift(7200, 30, 30, 29)]
+        reconcile_bin_counts(self.session_manager, self.records, drift)
+        update.assert_called_once_with(self.session_manager, *(KEY + ({3600: -5, 7200: -1},)))
@@ -1,11 +1,14 @@
 import unittest
+import uuid
 from functools import partial
 
 import itertools
+import numpy as np
 import pandas as pd
-from mock import MagicMock
+from mock import MagicMock, patch
 
-from ..cassandra_data import get_bin_number, fetch_bin
+from ..cassandra_data import get_bin_number, get_bin_numbers, make_uuids, fetch_bin, insert_dataframe, iter_bin, \
+    fetch_range, delete_dataframe, delete_range, warm_up
 from ..cassandra_session import SessionManager
 
 
@@ -25,6 +28,250 @@ class CassandraDataUnitTest(unittest.TestCase):
         self.assertEqual(get_bin_number(1009, 10), 1000)
         self.assertEqual(get_bin_number(1010, 10), 1010)
 
+    def test_bin_numbers(self):
+        times = np.array([1000, 1001, 1002, 1009, 1010, 3682368000.5, 3682378799.9])
+        expected = [get_bin_number(t, 10) for t in times]
+        self.assertEqual(get_bin_numbers(times, 10).tolist(), expected)
+
+    def test_make_uuids(self):
+        ids = make_uuids(1000)
+        self.assertEqual(len(set(ids)), 1000)
+        for each in ids:
+            self.assertIsInstance(each, uuid.UUID)
+            self.assertEqual(each.version, 4)
+            self.assertEqual(each.variant, uuid.RFC_4122)
+
+    @staticmethod
+    def make_botpt_dataframe(size):
+        # 20 Hz data spanning multiple 3 hour bins
+        times = 3682368000 + np.arange(size) / 20.0
+        return pd.DataFrame({'time': times,
+                             'bottom_pressure': np.random.random(size),
+                             'press_trans_temp': np.ones(size),
+                             'sensor_id': ['NANO'] * size,
+                             'provenance': [uuid.uuid4()] * size})
+
+    def insert(self, dataframe, columnar):
+        inserted_rows = []
+
+        def execute_concurrent(session, statement, values, **kwargs):
+            rows = list(values)
+            inserted_rows.extend(rows)
+            return [(True, None) for _ in rows]
+
+        cols = ['bin', 'time', 'deployment', 'id', 'bottom_pressure', 'press_trans_temp', 'sensor_id', 'provenance']
+        with patch.object(SessionManager, 'get_query_columns', return_value=cols), \
+                patch.object(SessionManager, 'session', return_value=None), \
+                patch('ooi_data.ooi_cassandra.cassandra_data.update_last_records') as self.update_last_records, \
+                patch('ooi_data.ooi_cassandra.cassandra_data.update_bin_counts') as self.update_bin_counts, \
+                patch('ooi_data.ooi_cassandra.cassandra_data.execute_concurrent_with_args', execute_concurrent):
+            inserted = insert_dataframe('subsite', 'node', 'sensor', 'method', 'botpt_nano_sample',
+                                        0, 3600 * 3, dataframe, columnar=columnar)
+        return inserted, inserted_rows
+
+    def test_insert_columnar(self):
+        dataframe = self.make_botpt_dataframe(1000)
+        times = dataframe.time.values.copy()
+        times[[10, 20]] = 3682368000 + 3600 * 3 + 1
+        dataframe['time'] = times
+        before = dataframe.copy()
+
+        inserted, rows = self.insert(dataframe, columnar=True)
+        self.assertTrue(dataframe.equals(before))
+
+        self.assertEqual(sorted(inserted), [3682368000, 3682378800])
+        self.assertEqual(inserted[3682368000]['count'], 998)
+        self.assertEqual(inserted[3682378800]['count'], 2)
+        self.assertEqual(inserted[3682378800]['first'], 3682378801)
+        self.assertEqual(len(rows), 1000)
+        self.assertEqual(len({row[6] for row in rows}), 1000)
+        for row in rows:
+            self.assertEqual(row[:5], ('subsite', 'node', 'sensor', 'method', 0))
+            self.assertEqual(row[5], get_bin_number(row[7], 3600 * 3))
+
+        # the last record index holds the latest row written
+        _, refdes, method, stream, records = self.update_last_records.call_args[0]
+        self.assertEqual(refdes, 'subsite-node-sensor')
+        latest = [row for row in rows if row[7] == 3682378801][-1]
+        self.assertEqual(records, [(0, 3682378801, 3682378800, latest[6])])
+        self.assertEqual(self.update_bin_counts.call_args[0][-1], {3682368000: 998, 3682378800: 2})
+
+    def test_insert_batched(self):
+        dataframe = self.make_botpt_dataframe(1000)
+        batches = []
+
+        def execute_concurrent(session, statements_and_params, **kwargs):
+            batches.extend(batch for batch, _ in statements_and_params)
+            # fail the second batch
+            return [(i != 1, None) for i, _ in enumerate(batches)]
+
+        cols = ['bin', 'time', 'deployment', 'id', 'bottom_pressure']
+        with patch.object(SessionManager, 'get_query_columns', return_value=cols), \
+                patch.object(SessionManager, 'session', return_value=None), \
+                patch('ooi_data.ooi_cassandra.cassandra_data.BatchStatement'), \
+                patch('ooi_data.ooi_cassandra.cassandra_data.update_last_records'), \
+                patch('ooi_data.ooi_cassandra.cassandra_data.update_bin_counts'), \
+                patch('ooi_data.ooi_cassandra.cassandra_data.execute_concurrent', execute_concurrent):
+            inserted = insert_dataframe('subsite', 'node', 'sensor', 'method', 'botpt_nano_sample',
+                                        0, 3600 * 3, dataframe, columnar=True, batch_size=100)
+
+        self.assertEqual(len(batches), 10)
+        self.assertEqual(inserted[3682368000]['count'], 900)
+        self.assertEqual(inserted[3682368000]['first'], dataframe.time.values[0])
+        self.assertEqual(inserted[3682368000]['last'], dataframe.time.values[-1])
+
+    def test_insert_columnar_matches_legacy(self):
+        dataframe = self.make_botpt_dataframe(10000)
+        # spill the last rows into the next bin
+        dataframe['time'] += 3600 * 3 - 400
+        legacy_inserted, legacy_rows = self.insert(dataframe, columnar=False)
+        inserted, rows = self.insert(dataframe, columnar=True)
+
+        self.assertEqual(legacy_inserted, inserted)
+        self.assertEqual(len(legacy_rows), len(rows))
+
+        # identical rows apart from the generated ids
+        def without_id(values):
+            return sorted(tuple(row[:6]) + tuple(row[7:]) for row in values)
+        self.assertEqual(without_id(legacy_rows), without_id(rows))
+
+    def test_iter_bin(self):
+        pages = [{'time': np.arange(i * 10, (i + 1) * 10, dtype=float), 'bottom_pressure': np.ones(10)}
+                 for i in range(3)]
+        statement = MagicMock()
+        with patch.object(SessionManager, 'prepare', return_value=statement), \
+                patch.object(SessionManager, 'execute_numpy', return_value=iter(pages)) as execute_numpy:
+            chunks = list(iter_bin('subsite', 'node', 'sensor', 'method', 'stream', 1,
+                                   ['time', 'bottom_pressure'], min_time=5, fetch_size=10))
+
+        statement.bind.assert_called_once_with(['subsite', 'node', 'sensor', 'method', 1, 5])
+        bound = statement.bind.return_value
+        execute_numpy.assert_called_once_with(bound)
+        self.assertEqual(bound.fetch_size, 10)
+        self.assertEqual(len(chunks), 3)
+        for chunk in chunks:
+            self.assertIsInstance(chunk, pd.DataFrame)
+            self.assertEqual(chunk.time.size, 10)
+        self.assertTrue((np.diff(pd.concat(chunks).time.values) > 0).all())
+
+    def test_fetch_range(self):
+        binsize = 3600 * 3
+        partitions = [MagicMock(bin=b, first=b + 1, last=b + binsize - 1) for b in xrange(0, binsize * 6, binsize)]
+        stream_key = MagicMock(subsite='subsite', node='node', sensor='sensor', method='method', stream='stream')
+        in_flight = []
+        max_in_flight = []
+
+        def execute_numpy_async(bound):
+            start, stop = bound.args
+            in_flight.append(bound)
+            max_in_flight.append(len(in_flight))
+
+            def result():
+                in_flight.remove(bound)
+                times = np.arange(bound.bin + 1, bound.bin + binsize, 100, dtype=float)
+                times = times[(times >= start) & (times < stop)]
+                return [{'time': times[:10]}, {'time': times[10:]}]
+
+            return MagicMock(result=result)
+
+        def bind(args):
+            return MagicMock(bin=args[4], args=args[5:])
+
+        with patch.object(SessionManager, 'prepare', return_value=MagicMock(bind=bind)), \
+                patch.object(SessionManager, 'execute_numpy_async', execute_numpy_async):
+            df = fetch_range(stream_key, binsize + 5000, binsize * 5 - 5000, ['time'], partitions + [None],
+                             max_in_flight=2)
+
+        self.assertLessEqual(max(max_in_flight), 2)
+        self.assertEqual(len(max_in_flight), 4)
+        self.assertGreaterEqual(df.time.min(), binsize + 5000)
+        self.assertLess(df.time.max(), binsize * 5 - 5000)
+        self.assertTrue((np.diff(df.time.values) > 0).all())
+
+    def test_delete_range(self):
+        record = MagicMock(subsite='subsite', node='node', sensor='sensor', method='method', stream='stream',
+                           bin=3600, first=3601, last=7100, count=500)
+        key = 'where subsite=? and node=? and sensor=? and bin=? and method=?'
+        where = key + ' and time>=? and time<=?'
+        count = 'select count(*) from stream ' + where
+        delete = 'delete from stream ' + where
+        before = 'select time from stream ' + key + ' and time<? order by method desc, time desc limit 1'
+        results = {count: [(42,)], before: [(4999.5,)]}
+
+        with patch.object(SessionManager, 'prepare', side_effect=lambda s: s), \
+                patch('ooi_data.ooi_cassandra.cassandra_data.update_bin_counts') as update_bin_counts, \
+                patch('ooi_data.ooi_cassandra.cassandra_data.invalidate_last_records') as invalidate, \
+                patch.object(SessionManager, 'execute', side_effect=lambda s, a: results.get(s, [])) as execute:
+            # outside the partition, nothing to do
+            self.assertEqual(delete_range(record, 0, 3600), (0, 3601, 7100))
+            self.assertFalse(execute.called)
+
+            # whole partition, count comes from the metadata
+            self.assertEqual(delete_range(record, 3600, 7200), (500, None, None))
+            execute.assert_called_once_with(delete, ('subsite', 'node', 'sensor', 3600, 'method', 3600, 7200))
+            execute.reset_mock()
+
+            # partial overlap, the deleted slice is counted and the last time narrowed
+            self.assertEqual(delete_range(record, 5000, 7200), (42, 3601, 4999.5))
+            self.assertEqual([c[0][0] for c in execute.call_args_list], [count, before, delete])
+            execute.reset_mock()
+
+            # within the partition, the bounds are unchanged
+            self.assertEqual(delete_range(record, 4000, 5000), (42, 3601, 7100))
+            self.assertEqual([c[0][0] for c in execute.call_args_list], [count, delete])
+
+        # the bin count is reduced by each delete
+        self.assertEqual([c[0][-1] for c in update_bin_counts.call_args_list],
+                         [{3600: -500}, {3600: -42}, {3600: -42}])
+
+        # and the last record index entries within each deleted range are invalidated
+        self.assertEqual(invalidate.call_count, 3)
+        deleted = invalidate.call_args[0][-1]
+        self.assertTrue(deleted(MagicMock(bin=3600, time=4500.0)))
+        self.assertFalse(deleted(MagicMock(bin=3600, time=5500.0)))
+        self.assertFalse(deleted(MagicMock(bin=7200, time=4500.0)))
+
+    def test_delete_dataframe(self):
+        record = MagicMock(subsite='subsite', node='node', sensor='sensor', method='method', stream='stream',
+                           bin=3600, first=3601, last=7100, count=500)
+        ids = [uuid.uuid4() for _ in range(3)]
+        dataframe = pd.DataFrame({'time': [3601.0, 3602.0, 3603.0], 'deployment': [1, 1, 1], 'id': ids})
+
+        # the second row was never written
+        existing = [(3601.0, 1, ids[0]), (3603.0, 1, ids[2])]
+        with patch.object(SessionManager, 'prepare', side_effect=lambda s: s), \
+                patch.object(SessionManager, 'execute', return_value=existing) as execute, \
+                patch.object(SessionManager, 'session'), \
+                patch('ooi_data.ooi_cassandra.cassandra_data.execute_concurrent_with_args') as execute_concurrent, \
+                patch('ooi_data.ooi_cassandra.cassandra_data.update_bin_counts') as update_bin_counts, \
+                patch('ooi_data.ooi_cassandra.cassandra_data.invalidate_last_records') as invalidate:
+            execute_concurrent.side_effect = lambda session, query, values, **kwargs: [(True, None) for _ in values]
+            self.assertEqual(delete_dataframe(dataframe, record), 2)
+
+        # the keys are read over the time span of the dataframe
+        self.assertEqual(execute.call_args[0][1], ('subsite', 'node', 'sensor', 3600, 'method', 3601.0, 3603.0))
+        # only the existing rows are deleted and counted
+        self.assertEqual(update_bin_counts.call_args[0][-1], {3600: -2})
+        deleted = invalidate.call_args[0][-1]
+        self.assertEqual([deleted(MagicMock(id=i)) for i in ids], [True, False, True])
+
+    def test_warm_up(self):
+        cols = ['bin', 'time', 'deployment', 'id', 'bottom_pressure', 'press_trans_temp', 'sensor_id', 'provenance']
+        with patch.object(SessionManager, 'get_query_columns', return_value=cols), \
+                patch.object(SessionManager, 'warm_up') as registry_warm_up:
+            warm_up(fetch={'botpt_nano_sample': ['time', 'bottom_pressure']},
+                    insert={'botpt_nano_sample': ['provenance', 'time', 'bottom_pressure', 'press_trans_temp',
+                                                  'sensor_id']},
+                    delete=['botpt_nano_sample'])
+        statements = registry_warm_up.call_args[0][0]
+        self.assertEqual(len(statements), 7)
+        self.assertIn('select time,bottom_pressure from botpt_nano_sample where subsite=? and node=? and sensor=? '
+                      'and method=? and bin=? and time >= ? and time < ?', statements)
+
+        # the insert statement is the one insert_dataframe prepares, whatever the column order
+        self.insert(self.make_botpt_dataframe(10), columnar=True)
+        self.assertIn(SessionManager.prepare.call_args_list[0][0][0], statements)
+
     def test_fetch(self):
         for dataframe in fetch_bin('stream', ['col1'], 'subsite', 'node', 'sensor', 'method', 1):
             self.assertIn('col1', dataframe)
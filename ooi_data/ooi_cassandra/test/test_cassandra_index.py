@@ -0,0 +1,69 @@
+import unittest
+import uuid
+
+from cassandra import InvalidRequest
+from mock import MagicMock, patch
+
+from ..cassandra_index import (CREATE_LAST_RECORD, DELETE_LAST_RECORD, UPDATE_LAST_RECORD, LastRecord,
+                               fetch_last_records, invalidate_last_records, last_records, make_refdes,
+                               update_last_records)
+
+
+class CassandraIndexUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = [uuid.uuid4() for _ in range(5)]
+
+    def test_last_records(self):
+        records = last_records([2, 1, 2, 1, 3], [5.0, 4.0, 7.0, 1.0, 2.0], [0, 0, 3600, 0, 0], self.ids)
+        self.assertEqual(records, [LastRecord(1, 4.0, 0, self.ids[1]),
+                                   LastRecord(2, 7.0, 3600, self.ids[2]),
+                                   LastRecord(3, 2.0, 0, self.ids[4])])
+        self.assertEqual(last_records([], [], [], []), [])
+
+    @patch('ooi_data.ooi_cassandra.cassandra_index.execute_concurrent_with_args')
+    def test_update_conditional_on_time(self, execute):
+        session_manager = MagicMock()
+        session_manager.prepare.side_effect = lambda statement: statement
+        # the entry for deployment 2 already exists and is only replaced by a later record
+        execute.side_effect = [[(True, [(True,)]), (True, [(False, 2, 3692142100.0)])],
+                               [(True, [(False, 3692142100.0)])]]
+        records = [LastRecord(1, 3692142000.5, 3692142000, self.ids[0]),
+                   LastRecord(2, 3692142001.5, 3692142000, self.ids[1])]
+        update_last_records(session_manager, make_refdes('RS03CCAL', 'MJ03F', '05-BOTPTA301'), 'streamed',
+                            'botpt_nano_sample', records)
+        (create_call, update_call) = execute.call_args_list
+        self.assertEqual(create_call[0][1], CREATE_LAST_RECORD)
+        self.assertEqual(create_call[0][2][0], ('RS03CCAL-MJ03F-05-BOTPTA301', 'streamed', 'botpt_nano_sample', 1,
+                                                3692142000.5, 3692142000, self.ids[0]))
+        self.assertEqual(update_call[0][1], UPDATE_LAST_RECORD)
+        self.assertEqual(update_call[0][2], [(3692142001.5, 3692142000, self.ids[1], 'RS03CCAL-MJ03F-05-BOTPTA301',
+                                              'streamed', 'botpt_nano_sample', 2, 3692142001.5)])
+
+    def test_missing_table(self):
+        session_manager = MagicMock()
+        session_manager.prepare.side_effect = InvalidRequest('unconfigured table stream_last_record')
+        self.assertEqual(fetch_last_records(session_manager, 'refdes', 'streamed', 'stream', [1]), {})
+        update_last_records(session_manager, 'refdes', 'streamed', 'stream', [LastRecord(1, 1.0, 0, self.ids[0])])
+        session_manager.session.assert_not_called()
+
+    def test_fetch(self):
+        session_manager = MagicMock()
+        session_manager.execute.return_value = [(1, 4.0, 0, self.ids[1])]
+        records = fetch_last_records(session_manager, 'refdes', 'streamed', 'stream', {1, 2})
+        self.assertEqual(records, {1: LastRecord(1, 4.0, 0, self.ids[1])})
+
+    @patch('ooi_data.ooi_cassandra.cassandra_index.execute_concurrent_with_args')
+    def test_invalidate(self, execute):
+        session_manager = MagicMock()
+        session_manager.prepare.side_effect = lambda statement: statement
+        session_manager.execute.return_value = [(1, 4.0, 0, self.ids[1]), (2, 7.0, 3600, self.ids[2])]
+        execute.return_value = [(True, [(True,)])]
+        invalidate_last_records(session_manager, 'refdes', 'streamed', 'stream', lambda r: r.bin == 3600)
+        # only the entry of the deleted row is removed, and only if it was not replaced meanwhile
+        execute.assert_called_once_with(session_manager.session(), DELETE_LAST_RECORD,
+                                        [('refdes', 'streamed', 'stream', 2, self.ids[2])],
+                                        raise_on_first_error=False)
+
+        execute.reset_mock()
+        invalidate_last_records(session_manager, 'refdes', 'streamed', 'stream', lambda r: False)
+        execute.assert_not_called()
@@ -0,0 +1,210 @@
+import unittest
+import uuid
+
+from cassandra import InvalidRequest
+from mock import MagicMock, patch
+
+from .. import cassandra_provenance
+from ..cassandra_provenance import (COMPRESSED_PREFIX, L0_DATASET, L0_DATASET_IN, L0_STREAM_ONE,
+                                    ProvenanceIntervals, ProvTuple, _query_l0_provenance, content_provenance_id,
+                                    decode_provenance_filename, encode_provenance_filename,
+                                    insert_l0_provenance_once, lookup_l0_provenance, provenance_cache,
+                                    provenance_cache_stats, resolve_streaming_provenance,
+                                    streaming_provenance_cache)
+
+PARTITION = ('subsite', 'node', 'sensor', 'streamed', 0)
+
+
+class ProvenanceCacheUnitTest(unittest.TestCase):
+    def setUp(self):
+        provenance_cache.clear()
+        self.ids = [uuid.uuid4() for _ in range(3)]
+        self.stored = {self.ids[0]: PARTITION + (self.ids[0], 'file0', 'parser', '1'),
+                       self.ids[1]: PARTITION + (self.ids[1], 'file1', 'parser', '1')}
+        self.queried = []
+        self.failed = set()
+
+    def query(self, session_manager, partition, prov_ids):
+        self.queried.append(list(prov_ids))
+        return {i: self.stored[i] for i in prov_ids if i in self.stored}, self.failed & set(prov_ids)
+
+    def lookup(self, prov_ids):
+        with patch.object(cassandra_provenance, '_query_l0_provenance', self.query):
+            return lookup_l0_provenance(MagicMock(), *(PARTITION + (prov_ids,)))
+
+    def test_cached_across_calls(self):
+        found = self.lookup(self.ids)
+        self.assertEqual(found, self.stored)
+        # the second bin with the same parser files needs no queries, including the missing id
+        self.assertEqual(self.lookup(self.ids), self.stored)
+        self.assertEqual(self.queried, [self.ids])
+        stats = provenance_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 3))
+
+    def test_negative_entries_expire(self):
+        missing = self.ids[2:]
+        self.lookup(missing)
+        self.stored[self.ids[2]] = PARTITION + (self.ids[2], 'file2', 'parser', '1')
+        # still cached as missing
+        self.assertEqual(self.lookup(missing), {})
+        self.assertEqual(len(self.queried), 1)
+
+        provenance_cache.clear()
+        with patch.object(cassandra_provenance, 'PROVENANCE_NEGATIVE_TTL', -1):
+            self.stored.pop(self.ids[2])
+            self.lookup(missing)
+            self.stored[self.ids[2]] = PARTITION + (self.ids[2], 'file2', 'parser', '1')
+            # the expired miss is looked up again
+            self.assertEqual(self.lookup(missing), {self.ids[2]: self.stored[self.ids[2]]})
+            self.assertEqual(self.lookup(missing), {self.ids[2]: self.stored[self.ids[2]]})
+        self.assertEqual(len(self.queried), 3)
+
+    def test_failed_not_cached(self):
+        self.failed.add(self.ids[2])
+        self.assertEqual(self.lookup(self.ids), self.stored)
+        self.failed.clear()
+        self.stored[self.ids[2]] = PARTITION + (self.ids[2], 'file2', 'parser', '1')
+        # only the id whose query failed is looked up again
+        self.assertEqual(self.lookup(self.ids), self.stored)
+        self.assertEqual(self.queried, [self.ids, self.ids[2:]])
+
+    def test_partitions_are_separate(self):
+        self.lookup(self.ids[:1])
+        with patch.object(cassandra_provenance, '_query_l0_provenance', self.query):
+            lookup_l0_provenance(MagicMock(), 'subsite', 'node', 'sensor', 'streamed', 1, self.ids[:1])
+        self.assertEqual(len(self.queried), 2)
+
+
+class ProvenanceQueryUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = [uuid.uuid4() for _ in range(250)]
+        self.session_manager = MagicMock()
+        self.session_manager.prepare.side_effect = lambda statement: statement
+
+    def test_in_chunks(self):
+        calls = []
+
+        def execute(session, query, args, **kwargs):
+            calls.append((query, args))
+            # the last id is missing and the second chunk fails
+            return [(True, [PARTITION + (i, 'file', 'parser', '1') for i in args[0][-1]]),
+                    (False, Exception('timed out')),
+                    (True, [PARTITION + (i, 'file', 'parser', '1') for i in args[2][-1] if i != self.ids[-1]])]
+
+        with patch('ooi_data.ooi_cassandra.cassandra_provenance.execute_concurrent_with_args', execute):
+            found, failed = _query_l0_provenance(self.session_manager, PARTITION, self.ids)
+
+        self.assertEqual(len(calls), 1)
+        query, args = calls[0]
+        self.assertEqual(query, L0_DATASET_IN)
+        self.assertEqual([len(a[-1]) for a in args], [100, 100, 50])
+        self.assertEqual(args[0][:-1], PARTITION)
+        self.assertEqual(sorted(found), sorted(self.ids[:100] + self.ids[200:-1]))
+        self.assertEqual(failed, set(self.ids[100:200]))
+        self.assertEqual(found[self.ids[0]][6], 'file')
+
+    def test_point_read_fallback(self):
+        def prepare(statement):
+            if statement == L0_DATASET_IN:
+                raise InvalidRequest('IN restrictions are not supported')
+            return statement
+
+        self.session_manager.prepare.side_effect = prepare
+        execute = MagicMock(return_value=[(True, [PARTITION + (i, 'file', 'parser', '1')]) for i in self.ids[:2]] +
+                                         [(True, []), (False, Exception('timed out'))])
+        with patch('ooi_data.ooi_cassandra.cassandra_provenance.execute_concurrent_with_args', execute):
+            found, failed = _query_l0_provenance(self.session_manager, PARTITION, self.ids[:4])
+        self.assertEqual(execute.call_args[0][1], L0_DATASET)
+        self.assertEqual(len(execute.call_args[0][2]), 4)
+        self.assertEqual(sorted(found), sorted(self.ids[:2]))
+        self.assertEqual(failed, {self.ids[3]})
+
+
+def stream_record(t):
+    return (t, uuid.uuid4(), 'driver', 'host', 'module', '1', '{}')
+
+
+class StreamingProvenanceUnitTest(unittest.TestCase):
+    def setUp(self):
+        streaming_provenance_cache.clear()
+        self.records = [stream_record(t) for t in (10.0, 20.0, 30.0)]
+
+        def execute(statement, args):
+            if statement == L0_STREAM_ONE:
+                before = [r for r in self.records if r[0] <= args[2]]
+                return before[-1:]
+            return [r for r in self.records if args[2] <= r[0] <= args[3]]
+
+        self.session_manager = MagicMock()
+        self.session_manager.prepare.side_effect = lambda statement: statement
+        self.session_manager.session.return_value.execute.side_effect = execute
+
+    def test_assign(self):
+        intervals = ProvenanceIntervals(0, 40, self.records[::-1])
+        index = intervals.assign([5.0, 10.0, 15.0, 20.0, 35.0])
+        self.assertEqual(index.tolist(), [-1, 0, 0, 1, 2])
+
+    def test_resolve(self):
+        intervals, index = resolve_streaming_provenance(self.session_manager, 'refdes', 'streamed', [15.0, 25.0, 35.0])
+        # the record in effect at the start and those within the range
+        self.assertEqual([r.time for r in intervals.records], [10.0, 20.0, 30.0])
+        self.assertEqual([intervals.records[i].id for i in index], [r[1] for r in self.records])
+        self.assertEqual(self.session_manager.session.return_value.execute.call_count, 2)
+
+    def test_cached_per_stream(self):
+        resolve_streaming_provenance(self.session_manager, 'refdes', 'streamed', [15.0, 35.0])
+        intervals, index = resolve_streaming_provenance(self.session_manager, 'refdes', 'streamed', [20.0, 25.0])
+        self.assertEqual(index.tolist(), [1, 1])
+        self.assertEqual(self.session_manager.session.return_value.execute.call_count, 2)
+
+        # outside the cached range the table is reloaded over the combined range
+        intervals, index = resolve_streaming_provenance(self.session_manager, 'refdes', 'streamed', [30.0, 50.0])
+        self.assertEqual((intervals.start, intervals.stop), (15.0, 50.0))
+        self.assertEqual(self.session_manager.session.return_value.execute.call_count, 4)
+
+        resolve_streaming_provenance(self.session_manager, 'refdes', 'telemetered', [20.0])
+        self.assertEqual(self.session_manager.session.return_value.execute.call_count, 6)
+
+    def test_expired(self):
+        resolve_streaming_provenance(self.session_manager, 'refdes', 'streamed', [15.0, 35.0])
+        with patch.object(cassandra_provenance, 'PROVENANCE_STREAM_TTL', -1):
+            resolve_streaming_provenance(self.session_manager, 'refdes', 'streamed', [15.0, 35.0])
+        self.assertEqual(self.session_manager.session.return_value.execute.call_count, 4)
+
+
+class ContentProvenanceUnitTest(unittest.TestCase):
+    def setUp(self):
+        provenance_cache.clear()
+        self.provenance = {str(uuid.uuid4()): {'filename': 'file%d' % i, 'parsername': 'parser',
+                                               'parserversion': '1'} for i in range(200)}
+
+    def test_deterministic_id(self):
+        prov_id = content_provenance_id(self.provenance, '1.0')
+        self.assertEqual(prov_id, content_provenance_id(dict(reversed(self.provenance.items())), '1.0'))
+        self.assertNotEqual(prov_id, content_provenance_id(self.provenance, '1.1'))
+        self.assertNotEqual(prov_id, content_provenance_id({}, '1.0'))
+
+    def test_compression(self):
+        plain = encode_provenance_filename(self.provenance)
+        compressed = encode_provenance_filename(self.provenance, compress=True)
+        self.assertFalse(plain.startswith(COMPRESSED_PREFIX))
+        self.assertTrue(compressed.startswith(COMPRESSED_PREFIX))
+        self.assertLess(len(compressed), len(plain))
+        self.assertEqual(decode_provenance_filename(compressed), plain)
+        self.assertEqual(decode_provenance_filename(plain), plain)
+        # small payloads are not worth compressing
+        self.assertEqual(encode_provenance_filename({}, compress=True), '{}')
+
+    @patch.object(cassandra_provenance, 'SessionManager')
+    def test_insert_once(self, session_manager):
+        session_manager.session.return_value.execute.return_value = []
+        prov_id = content_provenance_id(self.provenance, '1.0')
+        record = ProvTuple(*(PARTITION[:1] + (PARTITION[2], PARTITION[1]) + PARTITION[3:] +
+                             (prov_id, encode_provenance_filename(self.provenance), 'parser', '1.0')))
+
+        with patch.object(cassandra_provenance, '_query_l0_provenance', return_value=({}, set())) as query:
+            self.assertTrue(insert_l0_provenance_once(record))
+            # the inserted record is cached, reprocessing the same inputs writes nothing
+            self.assertFalse(insert_l0_provenance_once(record))
+            self.assertEqual(query.call_count, 1)
+        self.assertEqual(session_manager.execute_lazy.call_count, 1)
@@ -0,0 +1,51 @@
+import unittest
+import uuid
+
+from mock import MagicMock, patch
+
+from ..cassandra_qc import QcResultsWriter
+
+
+class FakeBatch(object):
+    def __init__(self, batch_type=None):
+        self.rows = []
+
+    def add(self, statement, values):
+        self.rows.append(values)
+
+
+class QcResultsWriterUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.pk = {'subsite': 'subsite', 'node': 'node', 'sensor': 'sensor', 'stream': 'stream'}
+        self.ids = [str(uuid.uuid4()) for _ in range(250)]
+        # particles from two partitions, interleaved
+        self.bins = [3600 * (i % 2) for i in range(250)]
+        self.batches = []
+
+    def execute(self, session, statements_and_params, concurrency, raise_on_first_error):
+        self.concurrency = concurrency
+        self.batches = [batch for batch, _ in statements_and_params]
+        # fail the last batch
+        return [(i != len(self.batches) - 1, None) for i in range(len(self.batches))]
+
+    def test_write(self):
+        writer = QcResultsWriter(MagicMock(), self.pk, batch_size=50, max_in_flight=4)
+        with patch('ooi_data.ooi_cassandra.cassandra_qc.BatchStatement', FakeBatch), \
+                patch('ooi_data.ooi_cassandra.cassandra_qc.execute_concurrent', self.execute):
+            written = writer.write('temperature', range(250), self.ids, self.bins, [1] * 250)
+            writer.write('pressure', range(250), self.ids, self.bins, [1] * 250)
+
+        self.assertEqual(self.concurrency, 4)
+        # 125 particles per partition in batches of at most 50
+        self.assertEqual([len(b.rows) for b in self.batches], [50, 50, 25, 50, 50, 25])
+        for batch in self.batches:
+            # each batch holds a single partition
+            self.assertEqual(len({row[2:6] for row in batch.rows}), 1)
+
+        param, flags, subsite, node, sensor, bin_number, stream, deployment, particle_id = self.batches[0].rows[1]
+        self.assertEqual((param, flags, bin_number, deployment), ('pressure', 2, 0, 1))
+        self.assertEqual(particle_id, uuid.UUID(self.ids[2]))
+
+        self.assertEqual(written, 225)
+        self.assertEqual(writer.counts, {'temperature': {'success': 225, 'failed': 25},
+                                         'pressure': {'success': 225, 'failed': 25}})
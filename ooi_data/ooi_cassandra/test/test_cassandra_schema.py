@@ -0,0 +1,42 @@
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+from mock import MagicMock
+
+from ..cassandra_schema import SchemaRegistry
+
+
+def make_table(**extra):
+    columns = OrderedDict()
+    for name, cql_type in [('subsite', 'text'), ('node', 'text'), ('sensor', 'text'), ('bin', 'bigint'),
+                           ('method', 'text'), ('time', 'double'), ('deployment', 'int'), ('id', 'uuid'),
+                           ('bottom_pressure', 'float'), ('spectra', 'blob')] + list(extra.items()):
+        columns[name] = MagicMock(cql_type=cql_type)
+    return MagicMock(columns=columns)
+
+
+class SchemaRegistryUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.cluster = MagicMock()
+        self.tables = {'stream': make_table()}
+        self.cluster.metadata.keyspaces = {'ooi': MagicMock(tables=self.tables)}
+        self.registry = SchemaRegistry(self.cluster, 'ooi')
+
+    def test_schema(self):
+        schema = self.registry.get('stream')
+        self.assertEqual(schema.columns[:4], ['subsite', 'node', 'sensor', 'bin'])
+        self.assertEqual(schema.cql_types[-1], 'blob')
+        self.assertEqual(self.registry.dtypes('stream', ['bin', 'time', 'deployment', 'id', 'bottom_pressure']),
+                         [np.int64, np.float64, np.int32, object, np.float32])
+        self.assertEqual(schema.encoded_arrays, {'spectra'})
+        self.assertEqual(self.registry.query_columns('stream'),
+                         ['bin', 'time', 'deployment', 'id', 'bottom_pressure', 'spectra'])
+
+    def test_cached_until_schema_change(self):
+        schema = self.registry.get('stream')
+        self.assertIs(self.registry.get('stream'), schema)
+        # the driver replaces the table metadata on a schema change
+        self.tables['stream'] = make_table(new_column='double')
+        self.assertIn('new_column', self.registry.get('stream').columns)
+
@@ -0,0 +1,74 @@
+import os
+import unittest
+
+from cassandra import InvalidRequest
+from mock import MagicMock, patch
+
+from ..cassandra_session import SessionManager, StatementRegistry, cluster_settings, make_cluster, prepare_if_exists
+
+
+def session_pid(bin_number):
+    # runs in a worker process, each worker has its own session
+    SessionManager.session().execute('select * from stream where bin=?', (bin_number,))
+    return bin_number, os.getpid()
+
+
+class SessionManagerUnitTest(unittest.TestCase):
+    def test_map_bins_pool(self):
+        cluster = MagicMock(contact_points=['127.0.0.1'], port=9042, protocol_version=3, compression=True)
+        with patch('ooi_data.ooi_cassandra.cassandra_session.Cluster') as cluster_class:
+            SessionManager.create_pool(cluster, 'unittest', process_count=2)
+            try:
+                results = SessionManager.map_bins(session_pid, range(20))
+            finally:
+                SessionManager.close_pool()
+
+        self.assertEqual([bin_number for bin_number, _ in results], list(range(20)))
+        self.assertNotIn(os.getpid(), {pid for _, pid in results})
+        # workers build their own clusters, only the parent connected the passed cluster
+        self.assertFalse(cluster_class.called)
+        self.assertEqual(cluster.connect.call_count, 2)
+
+    def test_worker_cluster_settings(self):
+        auth_provider = MagicMock()
+        cluster = MagicMock(spec=['contact_points', 'port', 'auth_provider', 'ssl_options', 'connect_timeout'],
+                            port=9142, auth_provider=auth_provider, ssl_options={'ca_certs': 'ca.pem'},
+                            connect_timeout=10)
+        settings = cluster_settings(cluster)
+        self.assertEqual(settings, {'port': 9142, 'auth_provider': auth_provider,
+                                    'ssl_options': {'ca_certs': 'ca.pem'}, 'connect_timeout': 10})
+
+        with patch('ooi_data.ooi_cassandra.cassandra_session.Cluster') as cluster_class:
+            make_cluster(['127.0.0.1'], settings)
+        args, kwargs = cluster_class.call_args
+        self.assertEqual(args, (['127.0.0.1'],))
+        self.assertIs(kwargs['auth_provider'], auth_provider)
+        self.assertEqual(kwargs['ssl_options'], {'ca_certs': 'ca.pem'})
+        self.assertIn('load_balancing_policy', kwargs)
+        # the settings passed in are not modified
+        self.assertNotIn('load_balancing_policy', settings)
+
+    def test_map_bins_no_pool(self):
+        cluster = MagicMock()
+        SessionManager.create_pool(cluster, 'unittest')
+        results = SessionManager.map_bins(session_pid, range(5))
+        self.assertEqual(results, [(i, os.getpid()) for i in range(5)])
+
+    def test_statement_registry(self):
+        session = MagicMock()
+        registry = StatementRegistry(session.prepare, maxsize=2)
+        registry.warm_up(['a', 'b'])
+        registry.prepare('a')
+        registry.prepare('c')
+        self.assertIn('a', registry)
+        self.assertNotIn('b', registry)
+        self.assertEqual(session.prepare.call_count, 3)
+        stats = registry.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 3, 2))
+
+    def test_prepare_if_exists(self):
+        session_manager = MagicMock()
+        self.assertIs(prepare_if_exists(session_manager, 'select * from stream_bin_count', 'stream_bin_count'),
+                      session_manager.prepare.return_value)
+        session_manager.prepare.side_effect = InvalidRequest('unconfigured table stream_bin_count')
+        self.assertIsNone(prepare_if_exists(session_manager, 'select * from stream_bin_count', 'stream_bin_count'))
@@ -0,0 +1,78 @@
+import json
+import unittest
+import uuid
+
+import msgpack
+import numpy as np
+from mock import MagicMock, patch
+
+from .. import existing
+from ..array_codec import encode_cells
+from ..cassandra_provenance import COMPRESSED_PREFIX, encode_provenance_filename
+
+
+class FetchProvenanceUnitTest(unittest.TestCase):
+    def test_compressed_file_name(self):
+        prov_id = uuid.uuid4()
+        file_names = {'bin': 3682368000, 'inputs': ['botpt_nano_sample_%d.nc' % i for i in range(200)]}
+        row = ('RS03CCAL', 'MJ03F', '05-BOTPTA301', 'streamed', 0, prov_id,
+               encode_provenance_filename(file_names, compress=True), 'botpt_precompute', '1.0')
+        self.assertTrue(row[6].startswith(COMPRESSED_PREFIX))
+        stream_key = MagicMock(method='streamed')
+
+        with patch.object(existing, 'lookup_l0_provenance', return_value={prov_id: row}) as lookup:
+            prov_dict = existing.fetch_l0_provenance(stream_key, [str(prov_id), 'None'], 1)
+
+        # streamed provenance is stored under deployment 0
+        self.assertEqual(lookup.call_args[0][5:], (0, [prov_id]))
+        self.assertEqual(prov_dict, {str(prov_id): {'file_name': json.dumps(file_names, sort_keys=True),
+                                                    'parser_name': 'botpt_precompute',
+                                                    'parser_version': '1.0'}})
+
+
+class FetchAllDataUnitTest(unittest.TestCase):
+    def test_failed_bin_raises(self):
+        stream_key = MagicMock(subsite='RS03CCAL', node='MJ03F', sensor='05-BOTPTA301', method='streamed')
+        location_metadata = MagicMock(bin_list=[3682368000, 3682378800])
+        time_range = MagicMock(start=3682368000.0, stop=3682389600.0)
+        error = Exception('read timeout')
+
+        with patch.object(existing, 'SessionManager') as session_manager, \
+                patch.object(existing, 'engine') as engine, \
+                patch.object(existing, 'execute_concurrent_with_args') as execute:
+            session_manager.get_query_columns.return_value = ['time']
+            session_manager.get_schema.return_value = MagicMock(encoded_arrays=set())
+            engine.app.config = {}
+            execute.return_value = [(True, [(3682368000.5,)]), (True, [(3682378800.5,)])]
+            self.assertEqual(existing.fetch_all_data(stream_key, time_range, location_metadata),
+                             (['time'], [(3682368000.5,), (3682378800.5,)]))
+
+            execute.return_value = [(True, [(3682368000.5,)]), (False, error)]
+            with self.assertRaises(Exception) as context:
+                existing.fetch_all_data(stream_key, time_range, location_metadata)
+            self.assertIs(context.exception, error)
+
+
+class XrayDatasetUnitTest(unittest.TestCase):
+    def test_binary_cells_packed(self):
+        stream_key = MagicMock(subsite='RS03CCAL', node='MJ03F', sensor='05-BOTPTA301', method='streamed')
+        location_metadata = MagicMock(bin_list=[3682368000])
+        time_range = MagicMock(start=3682368000.0, stop=3682389600.0)
+        block = np.arange(6, dtype=np.float32).reshape((2, 3))
+        legacy = msgpack.packb([1.5, 2.5])
+        rows = [(3682368000.5, encode_cells(block)[0], legacy), (3682368001.5, encode_cells(block)[1], legacy)]
+
+        with patch.object(existing, 'SessionManager') as session_manager, \
+                patch.object(existing, 'engine') as engine, \
+                patch.object(existing, 'execute_concurrent_with_args', return_value=[(True, rows)]), \
+                patch.object(existing, 'to_xray_dataset') as to_xray_dataset:
+            session_manager.get_query_columns.return_value = ['time', 'spectrum', 'legacy']
+            session_manager.get_schema.return_value = MagicMock(encoded_arrays={'spectrum', 'legacy'})
+            engine.app.config = {}
+            existing.get_full_cass_dataset(stream_key, time_range, location_metadata)
+
+        # to_xray_dataset unpacks array cells with msgpack, decoded cells must reach it packed
+        cols, data = to_xray_dataset.call_args[0][:2]
+        self.assertEqual(cols, ['time', 'spectrum', 'legacy'])
+        np.testing.assert_array_equal([msgpack.unpackb(row[1]) for row in data], block)
+        self.assertEqual([row[2] for row in data], [legacy, legacy])
@@ -0,0 +1,174 @@
+import os
+import unittest
+import uuid
+
+import numpy as np
+import xarray as xr
+
+from ..sampling import (StreamingDecimator, bin_bounds, decimate, dedup_rows, format_plan, lttb_indices,
+                        plan_sample_points, sort_rows, MINMAX, LTTB)
+
+HERE = os.path.dirname(__file__)
+
+
+def linspace_indices(size, num_points):
+    # the existing sample_full_bins strategy
+    return np.linspace(0, size - 1, num_points).astype(int)
+
+
+def envelope_error(times, values, indices, pixels):
+    """
+    Sum over plot columns of the distance between the true min/max envelope and the
+    envelope of the sampled points, normalized by the data range
+    """
+    edges = np.linspace(times[0], np.nextafter(times[-1], np.inf), pixels + 1)
+    columns = np.searchsorted(edges, times, side='right') - 1
+    sampled = np.zeros(times.size, dtype=bool)
+    sampled[indices] = True
+    error = 0.0
+    for column in xrange(pixels):
+        mask = columns == column
+        if not mask.any():
+            continue
+        true_values = values[mask]
+        sampled_values = values[mask & sampled]
+        if not sampled_values.size:
+            error += true_values.max() - true_values.min()
+        else:
+            error += (true_values.max() - sampled_values.max()) + (sampled_values.min() - true_values.min())
+    return error / (values.max() - values.min()) / pixels
+
+
+class RowsUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = [uuid.uuid4() for _ in range(5)]
+        self.rows = [(3.0, self.ids[0]), (1.0, self.ids[1]), (2.0, self.ids[0]),
+                     (1.0, self.ids[2]), (0.5, self.ids[1])]
+
+    def test_dedup_rows(self):
+        self.assertEqual(dedup_rows(self.rows, 1), [self.rows[0], self.rows[1], self.rows[3]])
+        self.assertEqual(dedup_rows([], 1), [])
+
+    def test_sort_rows(self):
+        # stable, equal times keep their original order
+        self.assertEqual(sort_rows(self.rows, 0), [self.rows[4], self.rows[1], self.rows[3],
+                                                   self.rows[2], self.rows[0]])
+        self.assertEqual(sort_rows([], 0), [])
+
+
+class SamplePlanUnitTest(unittest.TestCase):
+    def setUp(self):
+        # (count, first, last) for three bins of 1 Hz data with a gap after bin 2
+        self.bin_information = {3: (100, 300, 399), 1: (100, 100, 199), 2: (51, 200, 250)}
+        self.bounds = bin_bounds(self.bin_information, self.bin_information.keys())
+
+    def test_bin_bounds(self):
+        bins, counts, firsts, lasts = self.bounds
+        np.testing.assert_array_equal(bins, [1, 2, 3])
+        np.testing.assert_array_equal(counts, [100, 51, 100])
+        np.testing.assert_array_equal(firsts, [100, 200, 300])
+        np.testing.assert_array_equal(lasts, [199, 250, 399])
+
+    def test_plan(self):
+        times = [50, 150, 150.5, 220, 260, 270, 280, 310, 398.5, 500]
+        plan = plan_sample_points(times, *self.bounds)
+        # 50 is before any data, 150.5 returns the same row as 150, 260-280 fall in the gap
+        # and all read the last row of bin 2, 500 reads the last row of bin 3
+        self.assertEqual(plan.queries, [(1, 150.5), (2, 220), (2, 250), (3, 310), (3, 398.5), (3, 399)])
+        np.testing.assert_array_equal(plan.bins, [1, 2, 3])
+        np.testing.assert_array_equal(plan.points, [2, 4, 3])
+        np.testing.assert_array_equal(plan.query_counts, [1, 2, 3])
+        np.testing.assert_array_equal(plan.estimated_rows, [100, 51, 100])
+        self.assertEqual(plan.merged, 3)
+        self.assertEqual(plan.gaps, 4)
+        self.assertEqual(format_plan(plan).splitlines()[1], '1 2 1 100')
+
+    def test_plan_many_bins(self):
+        # ten years of daily bins sampled at midday of every fourth day and once after the last bin
+        size = 3650
+        bins = np.arange(size, dtype=np.int64)
+        firsts = bins * 86400.0
+        lasts = firsts + 86000
+        counts = np.full(size, 86000)
+        times = np.append(firsts[::4] + 43200, lasts[-1] + 100)
+        plan = plan_sample_points(times, bins, counts, firsts, lasts)
+        expected = zip(bins[::4].tolist(), (firsts[::4] + 43200).tolist()) + [(size - 1, lasts[-1])]
+        self.assertEqual(plan.queries, expected)
+        np.testing.assert_array_equal(plan.bins, np.append(bins[::4], size - 1))
+        self.assertTrue((plan.points == 1).all())
+        self.assertTrue((plan.query_counts == 1).all())
+        self.assertEqual(plan.merged, 0)
+        self.assertEqual(plan.gaps, 1)
+
+class DecimationUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.times = np.arange(100000, dtype=np.float64)
+        self.values = np.sin(self.times / 5000.0)
+        # isolated spikes which linear sampling will miss
+        self.values[12345] = 10
+        self.values[67891] = -10
+
+    def test_minmax_keeps_spikes(self):
+        indices = decimate(self.times, self.values, 200, MINMAX)
+        self.assertLessEqual(indices.size, 200)
+        self.assertIn(12345, indices)
+        self.assertIn(67891, indices)
+        np.testing.assert_array_equal(indices, np.sort(indices))
+
+        lin = linspace_indices(self.times.size, 200)
+        self.assertNotIn(12345, lin)
+
+    def test_lttb_keeps_spikes(self):
+        indices = decimate(self.times, self.values, 200, LTTB)
+        self.assertEqual(indices.size, 200)
+        self.assertIn(12345, indices)
+        self.assertIn(67891, indices)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], self.times.size - 1)
+
+    def test_lttb_small(self):
+        times = np.arange(10, dtype=np.float64)
+        np.testing.assert_array_equal(lttb_indices(times, times, 20), np.arange(10))
+        np.testing.assert_array_equal(lttb_indices(times, times, 2), [0, 9])
+
+    def test_streaming_matches_single_chunk(self):
+        rows = np.arange(self.times.size)
+        decimator = StreamingDecimator(0, self.times.size, 200, MINMAX)
+        # add out of order chunks, as bins may arrive
+        for chunk in reversed(np.array_split(rows, 37)):
+            decimator.add(self.times[chunk], self.values[chunk], chunk)
+        self.assertEqual(decimator.rows(), decimate(self.times, self.values, 200, MINMAX).tolist())
+        self.assertEqual(decimator.rows_added, self.times.size)
+
+    def test_nan_and_out_of_range(self):
+        decimator = StreamingDecimator(10, 20, 10, MINMAX)
+        decimator.add([5, 12, 13, 25], [100, np.nan, 1, -100], ['a', 'b', 'c', 'd'])
+        self.assertEqual(decimator.rows(), ['c'])
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            StreamingDecimator(0, 1, 10, 'bogus')
+
+
+class DecimationQualityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ds = xr.open_dataset(os.path.join(HERE, 'botpt_nano_sample_bin_3682368000.nc'), decode_times=False)
+        cls.times = ds.time.values.astype(np.float64)
+        cls.values = ds.bottom_pressure.values.astype(np.float64)
+
+    def test_envelope_error(self):
+        num_points = 1000
+        pixels = num_points // 2
+        lin = linspace_indices(self.times.size, num_points)
+        lin_error = envelope_error(self.times, self.values, lin, pixels)
+
+        for method in [MINMAX, LTTB]:
+            indices = decimate(self.times, self.values, num_points, method)
+            error = envelope_error(self.times, self.values, indices, pixels)
+            self.assertLessEqual(indices.size, num_points)
+            self.assertLess(error, lin_error)
+            if method == MINMAX:
+                # the extremes are always part of the result
+                self.assertEqual(self.values[indices].max(), self.values.max())
+                self.assertEqual(self.values[indices].min(), self.values.min())
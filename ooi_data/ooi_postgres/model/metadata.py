@@ -75,3 +75,17 @@ class ProcessedMetadatum(Base):
     processed_time = Column(DateTime, nullable=False)
     partition_id = Column(Integer, ForeignKey('partition_metadata.id', ondelete='CASCADE'))
     partition = relationship(PartitionMetadatum)
+
+
+class WorkLease(Base):
+    __tablename__ = 'work_lease'
+    __table_args__ = (
+        UniqueConstraint('processor_name', 'partition_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    processor_name = Column(String, nullable=False)
+    partition_id = Column(Integer, ForeignKey('partition_metadata.id', ondelete='CASCADE'), nullable=False)
+    worker = Column(String, nullable=False)
+    claimed = Column(DateTime, nullable=False)
+    expires = Column(DateTime, nullable=False)
+    partition = relationship(PartitionMetadatum)
@@ -1,13 +1,20 @@
 import datetime
-from sqlalchemy import and_, func, or_
+from collections import namedtuple
+
+from sqlalchemy import and_, func, or_, true, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import aliased
 
-from .model import PartitionMetadatum, ProcessedMetadatum, StreamMetadatum
+from .model import PartitionMetadatum, ProcessedMetadatum, StreamMetadatum, WorkLease
 
+# Lightweight, detached copies of PartitionMetadatum records
+PartitionSummary = namedtuple('PartitionSummary', ['id', 'subsite', 'node', 'sensor', 'method', 'stream', 'store',
+                                                   'bin', 'first', 'last', 'count'])
+# A bin with its previous and next bins (PartitionSummary or None) and the seconds between them
+BinNeighbors = namedtuple('BinNeighbors', ['record', 'previous', 'next', 'previous_gap', 'next_gap', 'modified'])
 
-def find_modified_bins_by_jobname(session, job_name, subsite=None, node=None, sensor=None,
-                                  method=None, stream=None):
 
+def _partition_filters(subsite=None, node=None, sensor=None, method=None, stream=None):
     filter_constraints = []
     if subsite:
         filter_constraints.append(PartitionMetadatum.subsite == subsite)
@@ -19,7 +26,13 @@ def find_modified_bins_by_jobname(session, job_name, subsite=None, node=None, se
         filter_constraints.append(PartitionMetadatum.method == method)
     if stream:
         filter_constraints.append(PartitionMetadatum.stream == stream)
+    return filter_constraints
+
+
+def find_modified_bins_by_jobname(session, job_name, subsite=None, node=None, sensor=None,
+                                  method=None, stream=None):
 
+    filter_constraints = _partition_filters(subsite, node, sensor, method, stream)
     query = session.query(PartitionMetadatum)
 
     if job_name:
@@ -36,6 +49,88 @@ def find_modified_bins_by_jobname(session, job_name, subsite=None, node=None, se
     return query
 
 
+def _neighbor(row, prefix, gap, max_elapsed_seconds):
+    values = [getattr(row, prefix + name) for name in PartitionSummary._fields]
+    if values[0] is None or (max_elapsed_seconds is not None and not gap < max_elapsed_seconds):
+        return None
+    return PartitionSummary(*values)
+
+
+def _find_bins_with_neighbors(query, selected, max_elapsed_seconds, adjacent):
+    """
+    Find the neighbors of each bin with window functions over the bins of query, then keep the
+    bins where selected is true (and their neighbors if adjacent is True)
+    """
+    window = dict(partition_by=[PartitionMetadatum.subsite, PartitionMetadatum.node, PartitionMetadatum.sensor,
+                                PartitionMetadatum.method, PartitionMetadatum.stream],
+                  order_by=PartitionMetadatum.bin)
+    summary = [getattr(PartitionMetadatum, name) for name in PartitionSummary._fields]
+    columns = summary + [selected.label('modified')]
+    for prefix, function in (('prev_', func.lag), ('next_', func.lead)):
+        columns.extend(function(c).over(**window).label(prefix + c.key) for c in summary)
+        columns.append(function(selected).over(**window).label(prefix + 'modified'))
+
+    # the neighbors must be found before filtering on modified
+    bins = query.with_entities(*columns).subquery()
+    selected = bins.c.modified
+    if adjacent:
+        near_previous = bins.c.prev_id.isnot(None)
+        near_next = bins.c.next_id.isnot(None)
+        if max_elapsed_seconds is not None:
+            near_previous = bins.c.first - bins.c.prev_last < max_elapsed_seconds
+            near_next = bins.c.next_first - bins.c.last < max_elapsed_seconds
+        selected = or_(selected, and_(bins.c.prev_modified, near_previous), and_(bins.c.next_modified, near_next))
+    query = query.session.query(bins).filter(selected).order_by(bins.c.bin)
+
+    results = []
+    for row in query:
+        previous_gap = None if row.prev_id is None else row.first - row.prev_last
+        next_gap = None if row.next_id is None else row.next_first - row.last
+        results.append(BinNeighbors(PartitionSummary(*(getattr(row, name) for name in PartitionSummary._fields)),
+                                    _neighbor(row, 'prev_', previous_gap, max_elapsed_seconds),
+                                    _neighbor(row, 'next_', next_gap, max_elapsed_seconds),
+                                    previous_gap, next_gap, bool(row.modified)))
+    return results
+
+
+def find_modified_bins_with_neighbors(session, job_name, max_elapsed_seconds=None, adjacent=False, subsite=None,
+                                      node=None, sensor=None, method=None, stream=None):
+    """
+    Return a BinNeighbors for each bin modified since it was last processed by job_name (every bin
+    if job_name is None) in a single query. The previous and next bins of each stream are found with
+    window functions ordered by bin, neighbors max_elapsed_seconds or more away are returned as None.
+    If adjacent is True the unmodified bins within max_elapsed_seconds of a modified bin are also returned.
+    """
+    query = session.query(PartitionMetadatum)
+    if job_name:
+        subquery = session.query(ProcessedMetadatum).filter(ProcessedMetadatum.processor_name == job_name).subquery()
+        alias = aliased(ProcessedMetadatum, subquery)
+        query = query.outerjoin(alias, alias.partition_id == PartitionMetadatum.id)
+        modified = or_(PartitionMetadatum.modified > alias.processed_time, alias.processed_time.is_(None))
+    else:
+        modified = true()
+
+    filter_constraints = _partition_filters(subsite, node, sensor, method, stream)
+    if filter_constraints:
+        query = query.filter(and_(*filter_constraints))
+    return _find_bins_with_neighbors(query, modified, max_elapsed_seconds, adjacent)
+
+
+def find_bins_with_neighbors(session, record_ids, max_elapsed_seconds=None, adjacent=False):
+    """
+    Return a BinNeighbors for each of the partitions record_ids (e.g. bins claimed with claim_bins),
+    see find_modified_bins_with_neighbors. BinNeighbors.modified is True for the requested bins.
+    """
+    record_ids = list(record_ids)
+    if not record_ids:
+        return []
+    stream_key = [PartitionMetadatum.subsite, PartitionMetadatum.node, PartitionMetadatum.sensor,
+                  PartitionMetadatum.method, PartitionMetadatum.stream]
+    streams = session.query(*stream_key).filter(PartitionMetadatum.id.in_(record_ids)).distinct()
+    query = session.query(PartitionMetadatum).filter(tuple_(*stream_key).in_(streams))
+    return _find_bins_with_neighbors(query, PartitionMetadatum.id.in_(record_ids), max_elapsed_seconds, adjacent)
+
+
 def find_bins_by_time(session, subsite, node, sensor, method, stream, store, min_time, max_time):
     query = session.query(PartitionMetadatum)
     query = query.filter(
@@ -165,6 +260,91 @@ def set_partition(session, subsite, node, sensor, method, stream, store, bin_num
     session.commit()
 
 
+def _merge_deltas(deltas):
+    merged = {}
+    for bin_number, first, last, count in deltas:
+        if bin_number in merged:
+            merged_first, merged_last, merged_count = merged[bin_number]
+            merged[bin_number] = (min(first, merged_first), max(last, merged_last), merged_count + count)
+        else:
+            merged[bin_number] = (first, last, count)
+    return merged
+
+
+def _partition_rows(subsite, node, sensor, method, stream, store, values):
+    return [dict(subsite=subsite, node=node, sensor=sensor, method=method, stream=stream, store=store,
+                 bin=bin_number, first=first, last=last, count=count)
+            for bin_number, (first, last, count) in sorted(values.iteritems())]
+
+
+def _upsert_partitions(session, rows, accumulate):
+    table = PartitionMetadatum.__table__
+    statement = insert(table).values(rows)
+    if accumulate:
+        values = dict(first=func.least(table.c.first, statement.excluded.first),
+                      last=func.greatest(table.c.last, statement.excluded.last),
+                      count=table.c.count + statement.excluded.count)
+    else:
+        values = dict(first=statement.excluded.first, last=statement.excluded.last, count=statement.excluded.count)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.subsite, table.c.node, table.c.sensor, table.c.method, table.c.stream,
+                        table.c.bin, table.c.store],
+        set_=values)
+    session.execute(statement)
+
+
+def _upsert_stream_metadata(session, subsite, node, sensor, method, stream, first, last, count):
+    table = StreamMetadatum.__table__
+    statement = insert(table).values(subsite=subsite, node=node, sensor=sensor, method=method, stream=stream,
+                                     first=first, last=last, count=count)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.subsite, table.c.node, table.c.sensor, table.c.method, table.c.stream],
+        set_=dict(first=func.least(table.c.first, statement.excluded.first),
+                  last=func.greatest(table.c.last, statement.excluded.last),
+                  count=table.c.count + statement.excluded.count))
+    session.execute(statement)
+
+
+def update_partitions(session, subsite, node, sensor, method, stream, store, deltas, update_stream=True):
+    """
+    Bulk update_partition, apply a list of (bin, first, last, count) deltas with a single upsert.
+    If update_stream is True the stream metadata is updated with the combined deltas in the same commit.
+    """
+    merged = _merge_deltas(deltas)
+    if not merged:
+        return
+    _upsert_partitions(session, _partition_rows(subsite, node, sensor, method, stream, store, merged), True)
+    if update_stream:
+        firsts, lasts, counts = zip(*merged.itervalues())
+        _upsert_stream_metadata(session, subsite, node, sensor, method, stream, min(firsts), max(lasts), sum(counts))
+    session.commit()
+
+
+def set_partitions(session, subsite, node, sensor, method, stream, store, values):
+    """
+    Bulk set_partition, set each partition from a list of (bin, first, last, count) values.
+    Partitions with a count of zero are deleted.
+    """
+    values = {v[0]: tuple(v[1:]) for v in values}
+    if not values:
+        return
+    empty = [bin_number for bin_number, (_, _, count) in values.iteritems() if count == 0]
+    remaining = {bin_number: v for bin_number, v in values.iteritems() if v[2] != 0}
+    if empty:
+        session.query(PartitionMetadatum).filter(
+            PartitionMetadatum.subsite == subsite,
+            PartitionMetadatum.node == node,
+            PartitionMetadatum.sensor == sensor,
+            PartitionMetadatum.method == method,
+            PartitionMetadatum.stream == stream,
+            PartitionMetadatum.store == store,
+            PartitionMetadatum.bin.in_(empty)
+        ).delete(synchronize_session=False)
+    if remaining:
+        _upsert_partitions(session, _partition_rows(subsite, node, sensor, method, stream, store, remaining), False)
+    session.commit()
+
+
 def recreate_stream_metadata(session, subsite, node, sensor, method, stream):
     with session.begin_nested():
         sm = get_stream(session, subsite, node, sensor, method, stream, for_update=True)
@@ -217,16 +397,160 @@ def get_processing_metadata(session, record_id, job_name):
 
 
 def record_processing_metadata(session, record_id, job_name):
-    with session.begin_nested():
-        processed = get_processing_metadata(session, record_id, job_name)
+    record_processing_metadata_bulk(session, [record_id], job_name)
 
-        if processed is None:
-            processed = ProcessedMetadatum(processor_name=job_name,
-                                           partition_id=record_id,
-                                           processed_time=func.now())
-            session.add(processed)
 
-        else:
-            processed.processed_time = func.now()
+def record_processing_metadata_bulk(session, record_ids, job_name):
+    """
+    Mark the partitions record_ids as processed by job_name now with a single upsert
+    """
+    record_ids = set(record_ids)
+    if not record_ids:
+        return
+    _upsert_processed(session, job_name, {record_id: func.now() for record_id in record_ids})
+    session.commit()
 
+
+def _upsert_processed(session, job_name, processed_times):
+    table = ProcessedMetadatum.__table__
+    statement = insert(table).values([dict(processor_name=job_name, partition_id=record_id, processed_time=t)
+                                      for record_id, t in sorted(processed_times.iteritems())])
+    statement = statement.on_conflict_do_update(index_elements=[table.c.processor_name, table.c.partition_id],
+                                                set_=dict(processed_time=statement.excluded.processed_time))
+    session.execute(statement)
+
+
+def _claim_candidates(session, job_name, limit, subsite, node, sensor, method, stream, exclude=()):
+    # bins leased to any worker are skipped, bins being claimed concurrently are skipped by the row locks
+    active = session.query(WorkLease.id).filter(WorkLease.processor_name == job_name,
+                                                WorkLease.partition_id == PartitionMetadatum.id,
+                                                WorkLease.expires > func.now())
+    query = find_modified_bins_by_jobname(session, job_name, subsite, node, sensor, method, stream)
+    query = query.filter(~active.exists())
+    if exclude:
+        query = query.filter(~PartitionMetadatum.id.in_(sorted(exclude)))
+    query = query.with_for_update(skip_locked=True, of=PartitionMetadatum).limit(limit)
+    return {record.id: PartitionSummary(*(getattr(record, name) for name in PartitionSummary._fields))
+            for record in query}
+
+
+def _lease_bins(session, job_name, worker, record_ids, lease_seconds):
+    """
+    Lease record_ids to worker, returning the ids leased. An existing lease is only taken over once it has expired.
+    """
+    table = WorkLease.__table__
+    expires = func.now() + datetime.timedelta(seconds=lease_seconds)
+    statement = insert(table).values([dict(processor_name=job_name, partition_id=record_id, worker=worker,
+                                           claimed=func.now(), expires=expires) for record_id in sorted(record_ids)])
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.processor_name, table.c.partition_id],
+        set_=dict(worker=statement.excluded.worker, claimed=statement.excluded.claimed,
+                  expires=statement.excluded.expires),
+        where=table.c.expires <= func.now())
+    return {row[0] for row in session.execute(statement.returning(table.c.partition_id))}
+
+
+def claim_bins(session, job_name, worker, limit=100, lease_seconds=3600, subsite=None, node=None, sensor=None,
+               method=None, stream=None):
+    """
+    Claim up to limit bins modified since they were last processed by job_name for worker.
+    Bins are locked with SKIP LOCKED while claiming so concurrent workers claim different bins,
+    each claim is a lease which expires after lease_seconds unless completed or released.
+    Returns the claimed bins as PartitionSummary tuples in bin order.
+    """
+    candidates = _claim_candidates(session, job_name, limit, subsite, node, sensor, method, stream)
+    if not candidates:
+        session.commit()
+        return []
+
+    claimed = _lease_bins(session, job_name, worker, candidates, lease_seconds)
+    session.commit()
+    return sorted((candidates[record_id] for record_id in claimed), key=lambda record: record.bin)
+
+
+def claim_bins_with_neighbors(session, job_name, worker, max_elapsed_seconds=None, limit=100, lease_seconds=3600,
+                              subsite=None, node=None, sensor=None, method=None, stream=None):
+    """
+    Claim up to limit modified bins as claim_bins does, for jobs which also reprocess the bins adjacent
+    to a modified bin (see find_bins_with_neighbors). The adjacent bins are leased in the same transaction
+    so no two workers process the same bin. A bin is only claimed if all of its adjacent bins were leased
+    too, otherwise it is left for a later claim and may only be returned as the neighbor of a claimed bin.
+    When none of the candidates can be claimed the next candidates are tried, an empty list is only
+    returned once no modified bins are left to claim.
+    Returns a BinNeighbors for each leased bin in bin order, BinNeighbors.modified is True for the claimed
+    bins. Only the claimed bins should be completed, the leases of the other bins released once processed.
+    """
+    skipped = set()
+    while True:
+        candidates = _claim_candidates(session, job_name, limit, subsite, node, sensor, method, stream, skipped)
+        if not candidates:
+            session.commit()
+            return []
+
+        bins = find_bins_with_neighbors(session, list(candidates), max_elapsed_seconds, adjacent=True)
+        leased = _lease_bins(session, job_name, worker, [b.record.id for b in bins], lease_seconds)
+        claimed = set()
+        needed = set()
+        for b in bins:
+            if b.modified:
+                record_ids = {r.id for r in (b.record, b.previous, b.next) if r is not None}
+                if record_ids <= leased:
+                    claimed.add(b.record.id)
+                    needed |= record_ids
+
+        unused = leased - needed
+        if unused:
+            _worker_leases(session, job_name, worker, sorted(unused)).delete(synchronize_session=False)
+        if claimed:
+            session.commit()
+            return [b._replace(modified=b.record.id in claimed) for b in bins if b.record.id in needed]
+        # every candidate borders a bin leased to another worker
+        skipped.update(candidates)
+
+
+def _worker_leases(session, job_name, worker, record_ids):
+    return session.query(WorkLease).filter(WorkLease.processor_name == job_name,
+                                           WorkLease.worker == worker,
+                                           WorkLease.partition_id.in_(record_ids))
+
+
+def complete_bins(session, job_name, worker, record_ids):
+    """
+    Mark bins claimed by worker as processed and drop their leases. The processed time is the
+    time the bin was claimed so bins modified while being processed are claimed again.
+    Returns the number of bins completed, bins no longer leased to worker are skipped.
+    """
+    record_ids = list(record_ids)
+    if not record_ids:
+        return 0
+    leases = _worker_leases(session, job_name, worker, record_ids).with_for_update().all()
+    if leases:
+        _upsert_processed(session, job_name, {lease.partition_id: lease.claimed for lease in leases})
+        _worker_leases(session, job_name, worker, [lease.partition_id for lease in leases]).delete(
+            synchronize_session=False)
+    session.commit()
+    return len(leases)
+
+
+def release_bins(session, job_name, worker, record_ids):
+    """
+    Drop the leases of worker on bins it will not process so they can be claimed again
+    """
+    record_ids = list(record_ids)
+    if not record_ids:
+        return 0
+    count = _worker_leases(session, job_name, worker, record_ids).delete(synchronize_session=False)
+    session.commit()
+    return count
+
+
+def reclaim_expired_leases(session, job_name=None):
+    """
+    Drop expired leases (e.g. of crashed workers), returns the number dropped
+    """
+    query = session.query(WorkLease).filter(WorkLease.expires <= func.now())
+    if job_name:
+        query = query.filter(WorkLease.processor_name == job_name)
+    count = query.delete(synchronize_session=False)
     session.commit()
+    return count
@@ -5,8 +5,13 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy_utils import database_exists, create_database, drop_database
 
-from ooi_data.data import find_modified_bins_by_jobname
+from ooi_data.data import find_modified_bins_by_jobname, find_modified_bins_with_neighbors
 from ooi_data.ooi_postgres.model import Base, Parameter, Stream, PartitionMetadatum
+from ooi_data.ooi_postgres.postgres_data import (claim_bins, claim_bins_with_neighbors, complete_bins,
+                                                  find_bins_with_neighbors, get_bin, get_processing_metadata,
+                                                  get_stream, reclaim_expired_leases, record_processing_metadata,
+                                                  record_processing_metadata_bulk, release_bins, set_partitions,
+                                                  update_partitions)
 from ooi_data.preload_database.load_preload import read_csv_data, update_db
 
 connection_url = 'postgresql://postgres@localhost:5432/unittest'
@@ -85,4 +90,118 @@ class OoiDataUnitTest(unittest.TestCase):
         self.assertEqual(len(bins), 20)
         bins = find_modified_bins_by_jobname(session, modified_time=datetime.datetime(2000, 1, 2),
                                              subsite=subsite, node=node, sensor=sensor, method=method, stream=stream).all()
-        self.assertEqual(len(bins), 0)
\ No newline at end of file
+        self.assertEqual(len(bins), 0)
+
+    def test_find_modified_bins_with_neighbors(self):
+        session = self.Session()
+        subsite = node = sensor = method = 'test'
+        stream = 'botpt_nano_sample'
+        job_name = 'neighbors_test'
+        bins = find_modified_bins_with_neighbors(session, job_name, subsite=subsite, node=node, sensor=sensor,
+                                                 method=method, stream=stream)
+        self.assertEqual(len(bins), 20)
+        self.assertIsNone(bins[0].previous)
+        self.assertIsNone(bins[-1].next)
+        self.assertEqual(bins[1].previous, bins[0].record)
+        self.assertEqual(bins[1].next, bins[2].record)
+        self.assertAlmostEqual(bins[1].previous_gap, 1.0 / 20)
+
+        # only the 11th bin remains modified
+        for each in bins[:10] + bins[11:]:
+            record_processing_metadata(session, each.record.id, job_name)
+        modified = find_modified_bins_with_neighbors(session, job_name, stream=stream)
+        self.assertEqual([b.record for b in modified], [bins[10].record])
+        adjacent = find_modified_bins_with_neighbors(session, job_name, max_elapsed_seconds=1200, adjacent=True,
+                                                     stream=stream)
+        self.assertEqual([b.record for b in adjacent], [b.record for b in bins[9:12]])
+        self.assertEqual([b.modified for b in adjacent], [False, True, False])
+        # neighbors further away than max_elapsed_seconds are not returned
+        distant = find_modified_bins_with_neighbors(session, job_name, max_elapsed_seconds=0.01, adjacent=True,
+                                                    stream=stream)
+        self.assertEqual([(b.record, b.previous, b.next) for b in distant], [(bins[10].record, None, None)])
+
+    def test_bulk_metadata_updates(self):
+        session = self.Session()
+        key = ('test', 'test', 'test', 'test', 'bulk_stream')
+        update_partitions(session, *(key + ('cass', [(0, 1.0, 2.0, 10), (100, 101.0, 102.0, 5), (0, 0.5, 1.5, 1)])))
+        update_partitions(session, *(key + ('cass', [(100, 100.5, 103.0, 2)])))
+
+        first_bin = get_bin(session, *(key + ('cass', 0)))
+        self.assertEqual((first_bin.first, first_bin.last, first_bin.count), (0.5, 2.0, 11))
+        second_bin = get_bin(session, *(key + ('cass', 100)))
+        self.assertEqual((second_bin.first, second_bin.last, second_bin.count), (100.5, 103.0, 7))
+        stream = get_stream(session, *key)
+        self.assertEqual((stream.first, stream.last, stream.count), (0.5, 103.0, 18))
+
+        set_partitions(session, *(key + ('cass', [(0, 1.0, 2.0, 0), (100, 101.0, 102.0, 3)])))
+        self.assertIsNone(get_bin(session, *(key + ('cass', 0))))
+        second_bin = get_bin(session, *(key + ('cass', 100)))
+        self.assertEqual((second_bin.first, second_bin.last, second_bin.count), (101.0, 102.0, 3))
+
+        record_processing_metadata_bulk(session, [second_bin.id, second_bin.id], 'bulk_test')
+        processed_time = get_processing_metadata(session, second_bin.id, 'bulk_test').processed_time
+        record_processing_metadata(session, second_bin.id, 'bulk_test')
+        self.assertGreaterEqual(get_processing_metadata(session, second_bin.id, 'bulk_test').processed_time,
+                                processed_time)
+
+    def test_work_queue(self):
+        session = self.Session()
+        other_session = self.Session()
+        stream = 'botpt_nano_sample'
+        job_name = 'queue_test'
+
+        first = claim_bins(session, job_name, 'worker1', limit=5, stream=stream)
+        second = claim_bins(other_session, job_name, 'worker2', limit=5, stream=stream)
+        self.assertEqual(len(first), 5)
+        self.assertEqual(len(second), 5)
+        self.assertFalse({r.id for r in first} & {r.id for r in second})
+
+        neighbors = find_bins_with_neighbors(session, [first[2].id], max_elapsed_seconds=1200, adjacent=True)
+        self.assertEqual([n.record for n in neighbors], first[1:4])
+        self.assertEqual([n.modified for n in neighbors], [False, True, False])
+
+        # only the worker holding the lease can complete a bin
+        self.assertEqual(complete_bins(other_session, job_name, 'worker2', [first[0].id]), 0)
+        self.assertEqual(complete_bins(session, job_name, 'worker1', [r.id for r in first[:4]]), 4)
+        self.assertIsNotNone(get_processing_metadata(session, first[0].id, job_name))
+        self.assertEqual(release_bins(session, job_name, 'worker1', [first[4].id]), 1)
+
+        # the released bin is claimed again, expired leases are taken over
+        third = claim_bins(session, job_name, 'worker3', limit=20, lease_seconds=-1, stream=stream)
+        self.assertEqual(len(third), 11)
+        self.assertIn(first[4].id, {r.id for r in third})
+        fourth = claim_bins(other_session, job_name, 'worker4', limit=20, lease_seconds=-1, stream=stream)
+        self.assertEqual({r.id for r in fourth}, {r.id for r in third})
+        self.assertEqual(complete_bins(session, job_name, 'worker3', [r.id for r in third]), 0)
+        self.assertEqual(reclaim_expired_leases(session, job_name), 11)
+
+    def test_work_queue_neighbors(self):
+        session = self.Session()
+        other_session = self.Session()
+        stream = 'botpt_nano_sample'
+        job_name = 'neighbor_queue_test'
+
+        first = claim_bins_with_neighbors(session, job_name, 'worker1', max_elapsed_seconds=1200, limit=2,
+                                          stream=stream)
+        self.assertEqual([n.modified for n in first], [True, True, False])
+
+        # adjacent claims never lease the same bin. The first candidate borders a bin leased to worker1 so
+        # the next candidate is claimed and the bin between them is only leased as its neighbor
+        second = claim_bins_with_neighbors(other_session, job_name, 'worker2', max_elapsed_seconds=1200, limit=1,
+                                           stream=stream)
+        self.assertEqual([n.modified for n in second], [False, True, False])
+        self.assertEqual(second[0].previous, first[-1].record)
+        self.assertFalse({n.record.id for n in first} & {n.record.id for n in second})
+
+        self.assertEqual(complete_bins(session, job_name, 'worker1', [n.record.id for n in first if n.modified]), 2)
+        self.assertEqual(release_bins(session, job_name, 'worker1', [first[-1].record.id]), 1)
+        self.assertEqual(complete_bins(other_session, job_name, 'worker2', [second[1].record.id]), 1)
+        self.assertEqual(release_bins(other_session, job_name, 'worker2',
+                                      [second[0].record.id, second[2].record.id]), 2)
+
+        # bins processed only as neighbors are claimed again
+        third = claim_bins_with_neighbors(session, job_name, 'worker3', max_elapsed_seconds=1200, limit=1,
+                                          stream=stream)
+        self.assertEqual([n.record for n in third], [first[1].record, first[2].record, second[0].record])
+        self.assertEqual([n.modified for n in third], [False, True, False])
+        self.assertEqual(release_bins(session, job_name, 'worker3', [n.record.id for n in third]), 3)
@@ -1,22 +1,19 @@
 import os
-import json
 import logging
-import uuid
-from operator import attrgetter
+import socket
 
 import ion_functions
-import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from ooi_data.data import find_modified_bins_by_jobname, find_previous_bin, find_next_bin
-from ooi_data.ooi_cassandra.cassandra_data import fetch_bin, insert_dataframe, delete_dataframe
-from ooi_data.ooi_cassandra.cassandra_provenance import insert_l0_provenance, fetch_l0_provenance, ProvTuple
+from ooi_data.ooi_cassandra.cassandra_data import fetch_range, insert_dataframe, delete_range, warm_up
+from ooi_data.ooi_cassandra.cassandra_provenance import insert_l0_provenance_once, fetch_l0_provenance, ProvTuple, \
+    content_provenance_id, encode_provenance_filename
 from ooi_data.ooi_cassandra.cassandra_session import SessionManager
 from ooi_data.ooi_postgres.model import Base
-from ooi_data.ooi_postgres.postgres_data import find_bins_by_time, update_partition, update_stream_metadata, \
-    set_partition, recreate_stream_metadata, record_processing_metadata
+from ooi_data.ooi_postgres.postgres_data import find_bins_by_time, update_partitions, set_partitions, \
+    recreate_stream_metadata, claim_bins_with_neighbors, complete_bins, release_bins, reclaim_expired_leases
 from ooi_data_groom.functions.botpt import make_15s
 
 
@@ -45,23 +42,21 @@ log.addHandler(ch)
 pd.set_option('display.width', 160)
 ION_VERSION = getattr(ion_functions, '__version__', 'unversioned')
 L0_STREAM = 'botpt_nano_sample'
+L0_COLUMNS = ['time', 'bottom_pressure', 'provenance']
+PRECOMPUTED_STREAM = 'botpt_nano_15s_precomputed'
+PRECOMPUTED_COLUMNS = ['time', 'botsflu_time15s', 'botsflu_meanpres', 'botsflu_meandepth', 'botsflu_5minrate',
+                       'botsflu_10minrate', 'botsflu_predtide', 'provenance']
 JOB_NAME = 'botpt_precompute'
-
-
-def find_bins(session):
-    bins_to_process = set()
-
-    log.info('Finding modified bins for job: %s', JOB_NAME)
-    for metadata_record in find_modified_bins_by_jobname(session, JOB_NAME, stream=L0_STREAM):
-        # If a botpt bin has been modified both it and the surrounding bins (up to 5 mins overlap) must be recalculated
-        bins_to_process.add(metadata_record)
-        next_record = find_next_bin(session, metadata_record, max_elapsed_seconds=1200)
-        if next_record is not None:
-            bins_to_process.add(next_record)
-        prev_record = find_previous_bin(session, metadata_record, max_elapsed_seconds=1200)
-        if prev_record is not None:
-            bins_to_process.add(prev_record)
-    return sorted(bins_to_process, key=attrgetter('sensor', 'bin'))
+# store the (potentially large) input provenance compressed
+COMPRESS_PROVENANCE = True
+# modified bins are claimed CLAIM_SIZE at a time, workers which do not complete
+# their bins within LEASE_SECONDS lose them to other workers
+WORKER = '%s-%d' % (socket.gethostname(), os.getpid())
+CLAIM_SIZE = 50
+LEASE_SECONDS = 3600
+# If a botpt bin has been modified both it and the surrounding bins (up to 5 mins overlap) must be recalculated,
+# the surrounding bins are leased with the modified bins
+NEIGHBOR_SECONDS = 1200
 
 
 def trim_data_to_bin(dataframe, metadata_record):
@@ -72,45 +67,32 @@ def trim_data_to_bin(dataframe, metadata_record):
     return trimmed_dataframe
 
 
-def process_bin(session, metadata_record):
+def process_bin(neighbors):
+    metadata_record = neighbors.record
     log.info('Processing bin: %r', metadata_record)
-    cols = ['time', 'bottom_pressure', 'provenance']
-    previous_bin = find_previous_bin(session, metadata_record, max_elapsed_seconds=1200)
-    next_bin = find_next_bin(session, metadata_record, max_elapsed_seconds=1200)
-
-    dataframe = fetch_bin(metadata_record.subsite, metadata_record.node, metadata_record.sensor,
-                          metadata_record.method, metadata_record.stream, metadata_record.bin, cols)
-    prov_values = set(dataframe.provenance.values)
-    prov_values.discard(None)
-    provenance = fetch_l0_provenance(metadata_record, prov_values, 0)
-
-    dataframes = []
+    cols = L0_COLUMNS
+    previous_bin = neighbors.previous
+    next_bin = neighbors.next
 
     # We need twenty minutes of data from the surrounding bins
     # fetch if available
     twenty_minutes = 60 * 20
 
-    if previous_bin is not None:
-        previous_dataframe = fetch_bin(previous_bin.subsite, previous_bin.node, previous_bin.sensor,
-                                       previous_bin.method, previous_bin.stream, previous_bin.bin, cols,
-                                       min_time=metadata_record.first-twenty_minutes)
-        dataframes.append(previous_dataframe)
+    dataframe = fetch_range(metadata_record, metadata_record.first - twenty_minutes,
+                            metadata_record.last + twenty_minutes, cols, [previous_bin, metadata_record, next_bin])
 
-    dataframes.append(dataframe)
-
-    if next_bin is not None:
-        next_dataframe = fetch_bin(next_bin.subsite, next_bin.node, next_bin.sensor,
-                                   next_bin.method, next_bin.stream, next_bin.bin, cols,
-                                   max_time=metadata_record.last+twenty_minutes)
-        dataframes.append(next_dataframe)
+    in_bin = (dataframe.time.values >= metadata_record.first) & (dataframe.time.values <= metadata_record.last)
+    prov_values = set(dataframe.provenance.values[in_bin])
+    prov_values.discard(None)
+    provenance = fetch_l0_provenance(metadata_record, prov_values, 0)
 
-    dataframe = pd.concat(dataframes).sort_values('time')
     return trim_data_to_bin(make_15s(dataframe), metadata_record), provenance
 
 
 def generate_provenance(metadata_record, provenance):
-    prov_id = uuid.uuid4()
-    file_name = json.dumps(provenance)
+    # identical inputs processed by the same ion_functions version produce the same provenance record
+    prov_id = content_provenance_id(provenance, ION_VERSION)
+    file_name = encode_provenance_filename(provenance, compress=COMPRESS_PROVENANCE)
 
     parser_name = 'precomputed using ion_functions.data.prs_functions'
     parser_version = 'precomputed using ion_functions version %s' % ION_VERSION
@@ -136,12 +118,11 @@ def insert_precomputed_botpt_15s_data(session, dataframe, metadata_record, compu
     :param computed_provenance:
     :return:
     """
-    cols = ['time', 'deployment', 'id']
     store = 'cass'
-    precomputed_stream = 'botpt_nano_15s_precomputed'
+    precomputed_stream = PRECOMPUTED_STREAM
     precomputed_binsize = 86400
 
-    insert_l0_provenance(computed_provenance)
+    insert_l0_provenance_once(computed_provenance)
     # assign provenance values to each data point
     dataframe['provenance'] = [computed_provenance.id for _ in dataframe.time.values]
 
@@ -152,65 +133,80 @@ def insert_precomputed_botpt_15s_data(session, dataframe, metadata_record, compu
                              metadata_record.method, precomputed_stream, 'cass', first, last)
 
     delete_count = 0
+    remaining = []
     for each in bins:
-        # fetch ALL existing data from this bin
-        current_data = fetch_bin(each.subsite, each.node, each.sensor, each.method, each.stream,
-                                 each.bin, cols=cols)
-        # subset data where we plan on replacing data
-        delete_mask = (current_data.time >= first) & (current_data.time <= last)
-        to_delete = current_data[delete_mask]
-        remaining = current_data[np.logical_not(delete_mask)]
-
-        size = to_delete.time.size
-        if size:
-            # delete the existing data
-            delete_dataframe(to_delete, each)
-            # find new bin bounds and size
-            post_delete_count = remaining.time.size
-            post_delete_first = remaining.time.min()
-            post_delete_last = remaining.time.max()
-
-            # update the partition metadata
-            set_partition(session, each.subsite, each.node, each.sensor, each.method, each.stream, each.store,
-                          each.bin, post_delete_first, post_delete_last, post_delete_count)
-            delete_count += size
-
-    # recreate the stream metadata from the aggregate partitions (if we deleted anything)
+        # delete the existing data where we plan on replacing data
+        deleted = delete_range(each, first, last)
+        if deleted.count:
+            remaining.append((each.bin, deleted.first, deleted.last, each.count - deleted.count))
+            delete_count += deleted.count
+
+    # update the partition metadata and recreate the stream metadata
+    # from the aggregate partitions (if we deleted anything)
     if delete_count:
+        set_partitions(session, metadata_record.subsite, metadata_record.node, metadata_record.sensor,
+                       metadata_record.method, precomputed_stream, store, remaining)
         recreate_stream_metadata(session, metadata_record.subsite, metadata_record.node,
                                  metadata_record.sensor, metadata_record.method, precomputed_stream)
 
     # insert our new data
     results = insert_dataframe(metadata_record.subsite, metadata_record.node, metadata_record.sensor,
-                               metadata_record.method, precomputed_stream, 0, precomputed_binsize, dataframe)
+                               metadata_record.method, precomputed_stream, 0, precomputed_binsize, dataframe,
+                               columnar=True)
 
-    # update the metadata records
-    for bin_number in results:
-        first = results[bin_number]['first']
-        last = results[bin_number]['last']
-        count = results[bin_number]['count']
-        update_partition(session, metadata_record.subsite, metadata_record.node, metadata_record.sensor,
-                         metadata_record.method, precomputed_stream, store, bin_number, first, last, count)
-        update_stream_metadata(session, metadata_record.subsite, metadata_record.node, metadata_record.sensor,
-                               metadata_record.method, precomputed_stream, first, last, count)
+    # update the partition and stream metadata records
+    deltas = [(bin_number, r['first'], r['last'], r['count']) for bin_number, r in results.iteritems()]
+    update_partitions(session, metadata_record.subsite, metadata_record.node, metadata_record.sensor,
+                      metadata_record.method, precomputed_stream, store, deltas)
 
-    record_processing_metadata(session, metadata_record.id, JOB_NAME)
+
+def process_claimed_bins(session, bins, completed):
+    """
+    Process the claimed bins and their leased neighbors, appending the id of each claimed bin
+    processed successfully to completed. Failed bins stay leased until the lease expires.
+    """
+    for neighbors in sorted(bins, key=lambda b: (b.record.sensor, b.record.bin)):
+        metadata_record = neighbors.record
+        try:
+            result, provenance = process_bin(neighbors)
+            computed_provenance = generate_provenance(metadata_record, provenance)
+            insert_precomputed_botpt_15s_data(session, result, metadata_record, computed_provenance)
+        except StandardError:
+            log.exception('')
+            continue
+        if neighbors.modified:
+            completed.append(metadata_record.id)
 
 
 def main():
     log.info('Creating database sessions')
     SessionManager.init(['localhost'], 'ooi')
+    # prepare the statements executed for each bin
+    warm_up(fetch={L0_STREAM: L0_COLUMNS}, insert={PRECOMPUTED_STREAM: PRECOMPUTED_COLUMNS},
+            delete=[PRECOMPUTED_STREAM])
     session = Session()
 
-    for metadata_record in find_bins(session):
+    reclaimed = reclaim_expired_leases(session, JOB_NAME)
+    if reclaimed:
+        log.info('Reclaimed %d expired leases for job: %s', reclaimed, JOB_NAME)
+
+    while True:
+        log.info('Claiming modified bins for job: %s worker: %s', JOB_NAME, WORKER)
+        bins = claim_bins_with_neighbors(session, JOB_NAME, WORKER, max_elapsed_seconds=NEIGHBOR_SECONDS,
+                                         limit=CLAIM_SIZE, lease_seconds=LEASE_SECONDS, stream=L0_STREAM)
+        if not bins:
+            break
+
+        completed = []
         try:
-            result, provenance = process_bin(session, metadata_record)
-            computed_provenance = generate_provenance(metadata_record, provenance)
-            insert_precomputed_botpt_15s_data(session, result, metadata_record, computed_provenance)
+            process_claimed_bins(session, bins, completed)
         except KeyboardInterrupt:
+            complete_bins(session, JOB_NAME, WORKER, completed)
+            release_bins(session, JOB_NAME, WORKER, [b.record.id for b in bins if b.record.id not in completed])
             break
-        except StandardError:
-            log.exception('')
+        complete_bins(session, JOB_NAME, WORKER, completed)
+        # the neighbors were only leased so no other worker processes them at the same time
+        release_bins(session, JOB_NAME, WORKER, [b.record.id for b in bins if not b.modified])
 
 
 if __name__ == '__main__':